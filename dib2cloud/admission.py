@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+
+from dib2cloud import process
+
+
+def read_meminfo(path='/proc/meminfo'):
+    """Return /proc/meminfo as a dict of byte counts"""
+    ret = {}
+    with open(path, 'r') as fh:
+        for line in fh:
+            key, _, value = line.partition(':')
+            fields = value.split()
+            if not fields:
+                continue
+            amount = int(fields[0])
+            if len(fields) > 1 and fields[1] == 'kB':
+                amount *= 1024
+            ret[key] = amount
+    return ret
+
+
+def free_bytes(path):
+    # The directory may not have been created yet, look at the closest
+    # parent which exists
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+class Admission(object):
+    """Decide whether the host has room to start another build
+
+    A build needs as much memory and disk as the largest previous build of
+    the same diskimage used, or the configured defaults when there is no
+    history. Running builds which were admitted less than ramp_seconds ago
+    probably have not reached their peak yet, so what they reserved is
+    taken off what the host currently reports as free.
+    """
+
+    def __init__(self, config, build_pf_dir):
+        self.config = config
+        self.build_pf_dir = build_pf_dir
+
+    @property
+    def policy(self):
+        return self.config.get('admission_policy')
+
+    def _records(self):
+        if not os.path.exists(self.build_pf_dir):
+            return
+        for pf in os.listdir(self.build_pf_dir):
+            if pf.endswith('processfile'):
+                record = process.load_record(
+                    os.path.join(self.build_pf_dir, pf))
+                if record is not None:
+                    yield record
+
+    def estimate(self, name):
+        memory = None
+        disk = None
+        for record in self._records():
+            if record['image_config']['name'] != name:
+                continue
+            resources = record.get('resources') or {}
+            if resources.get('max_rss'):
+                memory = max(memory or 0, resources['max_rss'])
+            if record.get('output_bytes'):
+                disk = max(disk or 0, record['output_bytes'])
+        return {
+            'memory': memory or self.config.get('admission_default_memory'),
+            'disk': disk or self.config.get('admission_default_disk')
+        }
+
+    def _reserved(self, exclude_uuid):
+        memory = 0
+        disk = 0
+        cutoff = time.time() - self.config.get('admission_ramp_seconds')
+        for record in self._records():
+            admission = record.get('admission') or {}
+            if record['uuid'] == exclude_uuid:
+                continue
+            if admission.get('state') != 'admitted':
+                continue
+            if admission.get('time', 0) < cutoff:
+                continue
+            if not process.pid_alive(record.get('pid')):
+                continue
+            memory += admission['memory']
+            disk += admission['disk']
+        return memory, disk
+
+    def check(self, build_uuid, estimate):
+        """Return None if the build fits or a reason why it does not"""
+        reserved_memory, reserved_disk = self._reserved(build_uuid)
+        available = read_meminfo().get('MemAvailable', 0) - reserved_memory
+        needed = estimate['memory'] + self.config.get(
+            'admission_min_free_memory')
+        if available < needed:
+            return ('Not enough memory: need %d bytes, %d available' %
+                    (needed, available))
+        for path in (self.config.get('images_dir'), tempfile.gettempdir()):
+            available = free_bytes(path) - reserved_disk
+            needed = estimate['disk'] + self.config.get(
+                'admission_min_free_disk')
+            if available < needed:
+                return ('Not enough disk in %s: need %d bytes, %d available' %
+                        (path, needed, available))
+        return None
@@ -1,26 +1,85 @@
 import errno
 import os
+import random
+import signal
+import time
 import uuid
 
 import shade
 
+from dib2cloud import admission
+from dib2cloud import compression
 import dib2cloud.config
+from dib2cloud import dedup
+from dib2cloud import dibcache
+from dib2cloud import failure
+from dib2cloud import glance
+from dib2cloud import metrics
+from dib2cloud import prepare
 from dib2cloud import process
+from dib2cloud import retention
+from dib2cloud import scheduling
+from dib2cloud import snapshot
+from dib2cloud import staleness
+from dib2cloud import throttle
+from dib2cloud import tracing
+from dib2cloud import tuning
+from dib2cloud import uploadqueue
 from dib2cloud import util
+from dib2cloud import watchdog
+
+
+REBUILD_POLL_INTERVAL = 5
 
 
 def gen_uuid():
     return uuid.uuid4().hex
 
 
+def _created_since(record, since):
+    if since is None:
+        return True
+    created_at = record.get('created_at')
+    return created_at is not None and created_at >= since
+
+
+def _watchdog(limits, progress):
+    return watchdog.Watchdog(limits.get('timeout'),
+                             limits.get('stall_timeout'),
+                             progress,
+                             limits.get('interval', 10))
+
+
 class Upload(process.ProcessTracker):
+    worker_kind = 'upload'
     process_properties = [
         'build_uuid',
         'build_name',
         'image_format',
         'image_path',
         'cloud_name',
-        'glance_uuid'
+        'provider_name',
+        'glance_uuid',
+        'bandwidth_buckets',
+        'throughput',
+        'resources',
+        'limits',
+        'stopped',
+        'compression',
+        'image_size',
+        'send_compressed',
+        'deleted',
+        'chunk_size',
+        'prepare',
+        'prepared',
+        'priority',
+        'deadline',
+        'expected_seconds',
+        'queue',
+        'progress',
+        'progress_interval',
+        'error',
+        'stream'
     ]
 
     @staticmethod
@@ -28,6 +87,11 @@ class Upload(process.ProcessTracker):
         return process.ProcessTracker.get_all(Upload, pf_dir,
                                               build_pf_dir=build_pf_dir)
 
+    @staticmethod
+    def iter_all(pf_dir, build_pf_dir, record_filter=None):
+        return process.ProcessTracker.iter_all(Upload, pf_dir, record_filter,
+                                               build_pf_dir=build_pf_dir)
+
     @staticmethod
     def from_uuid(upload_pf_dir, uuid, build_pf_dir):
         return process.ProcessTracker.from_uuid(Upload, upload_pf_dir, uuid,
@@ -35,51 +99,291 @@ class Upload(process.ProcessTracker):
 
     def __init__(self, pf_dir, build_pf_dir, uuid, build_uuid,
                  image_format, cloud_name, build_name=None, image_path=None,
-                 glance_uuid=None, pid=None):
-        super(Upload, self).__init__(uuid, pf_dir, pid)
+                 glance_uuid=None, pid=None, bandwidth_buckets=None,
+                 throughput=None, resources=None, provider_name=None,
+                 metrics=None, created_at=None, config_path=None,
+                 limits=None, stopped=None, compression=None,
+                 image_size=None, send_compressed=False, deleted=None,
+                 chunk_size=glance.DEFAULT_CHUNK_SIZE, prepare=None,
+                 prepared=None, priority=0, deadline=None,
+                 expected_seconds=None, queue=None, upload_queue=None,
+                 progress=None, progress_interval=5, error=None,
+                 stream=False):
+        super(Upload, self).__init__(uuid, pf_dir, pid, created_at,
+                                     config_path)
         self.build_uuid = build_uuid
         self.image_format = image_format
         self.cloud_name = cloud_name
+        self.provider_name = provider_name or cloud_name
         self.glance_uuid = glance_uuid
         self.image_path = image_path
         self.build_name = build_name
+        self.bandwidth_buckets = bandwidth_buckets or []
+        self.throughput = throughput
+        self.resources = resources
+        self.metrics = metrics
+        self.limits = limits or {}
+        self.stopped = stopped
+        self.compression = compression
+        self.image_size = image_size
+        self.send_compressed = send_compressed
+        self.deleted = deleted
+        self.chunk_size = chunk_size
+        self.prepare = prepare
+        self.prepared = prepared
+        self.priority = priority
+        self.deadline = deadline
+        self.expected_seconds = expected_seconds
+        self.queue = queue
+        self.upload_queue = upload_queue
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.error = error
+        self.stream = stream
         self._client_config = None
+        self._cloud = None
+        self._reader = None
+        self._image_id = None
+        self._watchdog = None
 
     @property
     def upload_name(self):
         return '%s-%s' % (self.build_name, self.uuid)
 
-    def _get_process(self):
-        # Do some init so we can fail in the calling process if needed
+    def _connect(self):
         self._cloud = shade.openstack_cloud(cloud=self.cloud_name)
-        return process.PythonProcess(self._do_upload)
+
+    def _get_process(self, blocking=False):
+        # Do some init so we can fail in the calling process if needed
+        self._connect()
+        return super(Upload, self)._get_process(blocking)
+
+    def _job(self):
+        if self._cloud is None:
+            self._connect()
+        tracing.emit('upload_start', name=self.build_name, uuid=self.uuid,
+                     provider=self.provider_name)
+        try:
+            self._do_upload()
+        finally:
+            tracing.emit('upload_end', name=self.build_name, uuid=self.uuid,
+                         provider=self.provider_name,
+                         glance_uuid=self.glance_uuid)
 
     def _do_upload(self):
-        image = self._cloud.create_image(self.upload_name,
-                                         filename=self.image_path,
+        usage = process.SelfUsage()
+        if self.metrics:
+            self.metrics.upload_started(self.build_name, self.provider_name,
+                                        self.uuid)
+        status = 'error'
+        try:
+            with _watchdog(self.limits, self._progress) as self._watchdog:
+                self._wait_turn()
+                self._prepare_image()
+                self._send_image()
+            status = 'completed'
+        except watchdog.Expired as e:
+            self.stopped = e.to_dict()
+            status = e.state
+            self._remove_partial_image(self.stopped)
+        except Exception as e:
+            self.error = {'type': type(e).__name__, 'message': str(e),
+                          'time': time.time()}
+            self._remove_partial_image(self.error)
+            raise
+        finally:
+            if self.queue:
+                self.upload_queue.set_state(self, 'done')
+            self._report_progress(force=True)
+            self.resources = usage.summary()
+            self.update_processfile()
+            if self.metrics:
+                self.metrics.upload_finished(self.build_name,
+                                             self.provider_name, status,
+                                             self.resources['wall_time'],
+                                             self.throughput, self.uuid)
+
+    def _wait_turn(self):
+        """Wait in the upload queue until we may start sending"""
+        if self.upload_queue is None:
+            return
+        self.upload_queue.set_state(self, 'queued')
+        with self._watchdog.paused(), tracing.span('upload_queued',
+                                                   uuid=self.uuid):
+            while not self.upload_queue.acquire(self):
+                time.sleep(self.upload_queue.poll_interval)
+
+    def _report_progress(self, force=False):
+        """Record bytes sent, throughput and ETA, at most every interval"""
+        if self._reader is None or self._reader.start_time is None:
+            return
+        now = time.time()
+        last = self.progress or {}
+        elapsed = now - last.get('updated_at', self._reader.start_time)
+        if not force and elapsed < self.progress_interval:
+            return
+        sent = self._reader.bytes_read
+        delta = sent - last.get('bytes_sent', 0)
+        current = None
+        if elapsed > 0:
+            current = delta / elapsed
+        total = self._reader.size
+        rate = current or self._reader.throughput
+        self.progress = {
+            'bytes_sent': sent,
+            'total_bytes': total,
+            'percent': 100.0 * sent / total if total else None,
+            'current_rate': current,
+            'average_rate': self._reader.throughput,
+            'eta': (total - sent) / rate if total and rate else None,
+            'updated_at': now
+        }
+        if self.metrics and delta:
+            self.metrics.upload_progress(self.build_name, self.provider_name,
+                                         delta)
+        # The final progress is written with the rest of the outcome
+        if not force:
+            self.update_processfile()
+
+    def _bytes_read(self):
+        if self._reader is None:
+            return 0
+        return self._reader.bytes_read
+
+    def _progress(self):
+        progress = self._bytes_read()
+        if self.prepare:
+            # Preparing writes these before anything is sent
+            for suffix in ('.raw', '.tmp'):
+                progress += util.file_size(self.prepare['path'] + suffix)
+        return progress
+
+    def _prepare_image(self):
+        if not self.prepare:
+            return
+        log_path = self.worker_log_path
+        with open(log_path, 'a') as log_fh, tracing.span('prepare_image'):
+            try:
+                self.prepared = prepare.ensure_prepared(
+                    self.prepare, self.image_path, self.compression, log_fh)
+            except prepare.PrepareError as e:
+                # Sending the image as it is still works, just slower
+                self.prepared = {'error': str(e)}
+
+    def _send_image(self):
+        weight = throttle.priority_weight(self.priority)
+        buckets = [throttle.TokenBucket(owner=self.uuid, weight=weight, **x)
+                   for x in self.bandwidth_buckets]
+        path = self.image_path
+        compression = self.compression
+        container_format = 'bare'
+        if self.prepared and self.prepared.get('path'):
+            path = self.prepared['path']
+            compression = None
+        elif self.compression and self.send_compressed:
+            # The cloud takes our compressed bytes as they are
+            container_format = 'compressed'
+            compression = None
+        paced = buckets or compression or container_format != 'bare'
+        if paced or self.stream:
+            self._stream_image(path, buckets, compression, container_format)
+        else:
+            self._create_image(path)
+
+    def _create_image(self, path):
+        # shade knows every glance version and how each cloud wants images
+        # imported, but not how far it has got
+        if self._watchdog is not None:
+            self._watchdog.progress = None
+        start = time.time()
+        image = self._cloud.create_image(self.upload_name, filename=path,
                                          disk_format=self.image_format,
-                                         conatiner_format='bare')
+                                         container_format='bare', wait=True)
+        elapsed = time.time() - start
         self.glance_uuid = image.id
-        self.update_processfile()
+        if elapsed > 0:
+            self.throughput = util.file_size(path) / elapsed
+
+    def _stream_image(self, path, buckets, compression, container_format):
+        """Send the image ourselves, paced and decompressed as we go"""
+        image_service = glance.ImageService.from_cloud(self._cloud)
+        if image_service.version != 2:
+            raise glance.GlanceError(
+                'Bandwidth limits, compressed images and streamed uploads '
+                'need glance v2, %s is not' % image_service.root)
+        size = None
+        if compression:
+            size = self.image_size
+        self._reader = glance.ImageReader(path, buckets, self.chunk_size,
+                                          compression=compression, size=size,
+                                          gate=self._report_progress)
+        self._image_id = image_service.create_image(
+            self.upload_name, disk_format=self.image_format,
+            container_format=container_format)
+        image_service.upload_image_data(self._image_id, self._reader.body)
+        self.throughput = self._reader.throughput
+        image_service.wait_for_active(self._image_id)
+        self.glance_uuid = self._image_id
+
+    def _remove_partial_image(self, outcome):
+        if self._image_id is None:
+            return
+        try:
+            glance.ImageService.from_cloud(self._cloud).delete_image(
+                self._image_id)
+        except Exception as e:
+            # Keep the reason we stopped, the image can be deleted by hand
+            outcome['cleanup_error'] = str(e)
 
 
 class DibError(object):
     OutputMissing = 0
     StillRunning = 1
+    ExitStatus = 2
+    Rejected = 3
+    Stopped = 4
+    Exception = 5
 
 
 class Build(process.ProcessTracker):
+    worker_kind = 'build'
     process_properties = [
         'log_dir',
         'images_dir',
         'image_config',
-        'output_formats'
+        'output_formats',
+        'resources',
+        'upload_to',
+        'upload_ids',
+        'keep_local',
+        'outputs_removed',
+        'admission',
+        'output_bytes',
+        'scheduling',
+        'limits',
+        'stopped',
+        'dedup',
+        'snapshot',
+        'cache_artifacts',
+        'cache_fetches',
+        'compress',
+        'compression',
+        'raw_sizes',
+        'failure',
+        'layers',
+        'inputs',
+        'tuning',
+        'dib_pgid'
     ]
 
     @staticmethod
     def get_all(pf_dir):
         return process.ProcessTracker.get_all(Build, pf_dir)
 
+    @staticmethod
+    def iter_all(pf_dir, record_filter=None):
+        return process.ProcessTracker.iter_all(Build, pf_dir, record_filter)
+
     @staticmethod
     def from_processfile(pf):
         return process.ProcessTracker.from_processfile(Build, pf)
@@ -89,13 +393,58 @@ class Build(process.ProcessTracker):
         return process.ProcessTracker.from_uuid(Build, pf_dir, uuid)
 
     def __init__(self, log_dir, pf_dir, images_dir,
-                 image_config, uuid, output_formats, pid=None):
-        super(Build, self).__init__(uuid, pf_dir, pid)
+                 image_config, uuid, output_formats, pid=None,
+                 resources=None, metrics=None, created_at=None,
+                 config_path=None, upload_to=None, upload_ids=None,
+                 keep_local=True, outputs_removed=False, admission=None,
+                 output_bytes=None, admission_control=None,
+                 scheduling=None, limits=None, stopped=None, dedup=None,
+                 deduplicator=None, snapshot=None, snapshot_cache=None,
+                 cache_artifacts=None, cache_fetches=None, dib_cache=None,
+                 compress=None, compression=None, raw_sizes=None,
+                 failure=None, layers=None, inputs=None, tuning=None,
+                 tuner=None, dib_pgid=None):
+        super(Build, self).__init__(uuid, pf_dir, pid, created_at,
+                                    config_path)
         self.name = image_config.get('name')
         self.log_dir = log_dir
         self.images_dir = images_dir
         self.image_config = image_config
         self.output_formats = output_formats
+        self.resources = resources
+        self.metrics = metrics
+        self.upload_to = upload_to or []
+        self.upload_ids = upload_ids or []
+        self.keep_local = keep_local
+        self.outputs_removed = outputs_removed
+        self.admission = admission
+        self.output_bytes = output_bytes
+        self.admission_control = admission_control
+        self.scheduling = scheduling or {}
+        self.limits = limits or {}
+        self.stopped = stopped
+        self.dedup = dedup
+        self.deduplicator = deduplicator
+        self.snapshot = snapshot
+        self.snapshot_cache = snapshot_cache
+        self.cache_artifacts = cache_artifacts or []
+        self.cache_fetches = cache_fetches
+        self.dib_cache = dib_cache
+        self.compress = compress
+        self.compression = compression
+        self.raw_sizes = raw_sizes
+        self.failure = failure
+        # Element prefixes to seed the build from, shallowest first
+        self.layers = layers
+        if layers is None:
+            base_elements = image_config.get('base_elements')
+            self.layers = [base_elements] if base_elements else []
+        # What the build was made from, to tell later when it is stale
+        self.inputs = inputs
+        self.tuning = tuning
+        self.tuner = tuner
+        # DIB runs in a session of its own, which cancel has to reach too
+        self.dib_pgid = dib_pgid
 
     @property
     def dib_cmd(self):
@@ -122,42 +471,536 @@ class Build(process.ProcessTracker):
     def dest_paths(self):
         return [self.dest_path_for_format(x) for x in self.output_formats]
 
-    def dest_path_for_format(self, img_format):
+    def raw_path_for_format(self, img_format):
         return os.path.join(self.dest_dir, '%s.%s' % (self.uuid, img_format))
 
-    def _get_process(self):
-        log_fh = open(self.log_path, 'w')
-        return process.CmdProcess(self.dib_cmd, stdout=log_fh, stderr=log_fh)
+    def dest_path_for_format(self, img_format):
+        path = self.raw_path_for_format(img_format)
+        if self.compression:
+            path += compression.SUFFIXES[self.compression]
+        return path
+
+    def _job(self):
+        # disk-image-create is supervised from our own process so we can reap
+        # it and record what it cost once it exits
+        tracing.emit('build_start', name=self.name, uuid=self.uuid)
+        try:
+            self._do_build()
+        finally:
+            tracing.emit('build_end', name=self.name, uuid=self.uuid,
+                         succeeded=self._check_result()[0])
+
+    @property
+    def outputs_size(self):
+        return sum(map(util.file_size, self.dest_paths))
+
+    def _set_admission(self, state, estimate, reason=None):
+        self.admission = dict(estimate, state=state, reason=reason,
+                              time=time.time())
+        self.update_processfile()
+
+    def _admit(self):
+        control = self.admission_control
+        estimate = control.estimate(self.name)
+        deadline = time.time() + control.config.get('admission_hold_timeout')
+        lock_path = os.path.join(self.pf_dir, 'admission.lock')
+        while True:
+            # Decide one build at a time so two builds can't both be given
+            # the same free memory
+            with process.LockedFile(lock_path):
+                reason = control.check(self.uuid, estimate)
+                if reason is None:
+                    self._set_admission('admitted', estimate)
+                    return True
+                if control.policy == 'reject' or time.time() >= deadline:
+                    self._set_admission('rejected', estimate, reason)
+                    return False
+                self._set_admission('held', estimate, reason)
+            time.sleep(control.config.get('admission_poll_interval'))
+
+    def _pick_cpu_set(self):
+        cpu_sets = self.scheduling.get('cpu_affinity')
+        if not isinstance(cpu_sets, list):
+            return
+        with process.LockedFile(os.path.join(self.pf_dir, 'cpu_set.lock')):
+            self.scheduling['cpu_affinity'] = scheduling.pick_cpu_set(
+                cpu_sets, self.pf_dir, self.uuid)
+            self.update_processfile()
+
+    @property
+    def spawn_cmd(self):
+        return scheduling.command_prefix(self.scheduling) + self.dib_cmd
+
+    def _tune(self):
+        if self.tuner is None:
+            return
+        self.tuning = self.tuner.tune(self.name)
+        if self.compress and not self.compress.get('threads'):
+            self.compress['threads'] = self.tuning['compress_threads']
+        self.update_processfile()
+
+    def _dib_env(self):
+        """Return the diskimage's env_vars over any tuned settings"""
+        env = dict((self.tuning or {}).get('env') or {})
+        env_vars = tuning.env_dict(self.image_config.get('env_vars'))
+        if self.tuning:
+            self.tuning['overridden'] = sorted(set(env) & set(env_vars))
+        env.update(env_vars)
+        return env
+
+    def _dib_process(self, cmd, log_fh, env=None):
+        if env:
+            env = dict(os.environ, **env)
+        # DIB gets its own process group so all of it can be stopped
+        return process.CmdProcess(
+            cmd, stdout=log_fh, stderr=log_fh, setsid=True,
+            kill_grace=self.limits.get('kill_grace', 30), env=env,
+            track=self._track_dib)
+
+    def _track_dib(self, pid):
+        self.dib_pgid = pid
+        self.update_processfile()
+
+    def _cache_env(self, log_fh):
+        """Return the environment pointing DIB at the shared cache
+
+        Our base artifacts are fetched into the cache first, or waited for if
+        another build is already fetching them.
+        """
+        if self.dib_cache is None:
+            return {}
+        if self.cache_artifacts:
+            log_fh.write('Warming image cache %s\n' % self.dib_cache.path)
+            log_fh.flush()
+            self.cache_fetches = self.dib_cache.warm(self.cache_artifacts)
+            self.update_processfile()
+        return {'DIB_IMAGE_CACHE': self.dib_cache.path}
+
+    def _seed_env(self, log_fh, env=None):
+        """Return the environment which seeds DIB from a root snapshot
+
+        Each layer's snapshot is built, seeded from the layer before it, if
+        there is not one yet. The build is seeded from the deepest layer
+        which could be built, and runs in full if none could.
+        """
+        cache = self.snapshot_cache
+        if cache is None or not self.layers:
+            return {}
+        seed = {}
+        for layer in self.layers:
+            key = snapshot.fingerprint(layer,
+                                       self.image_config.get('env_vars'),
+                                       (self.inputs or {}).get('upstream'),
+                                       self._layer_hashes(layer))
+            with cache.lock(key):
+                path = cache.get(key, self.uuid)
+                hit = path is not None
+                if not hit:
+                    path = self._build_snapshot(cache, key, layer, log_fh,
+                                                dict(env or {}, **seed))
+            if path is None:
+                break
+            seed = {cache.env_var: path}
+            self.snapshot = {'key': key, 'hit': hit, 'path': path,
+                             'elements': layer}
+            self.update_processfile()
+        return seed
+
+    def _layer_hashes(self, layer):
+        """Return the tree hashes of a layer's elements and their deps"""
+        inputs = self.inputs or {}
+        hashes = inputs.get('elements') or {}
+        if 'element_deps' not in inputs:
+            # Without knowing which elements a layer pulls in, all of them
+            # decide its snapshot
+            return hashes
+        return dict((x, hashes.get(x)) for x in staleness.with_deps(
+            layer, inputs['element_deps']))
+
+    def _build_snapshot(self, cache, key, base_elements, log_fh, env=None):
+        dest = os.path.join(self.dest_dir, '%s.snapshot' % self.uuid)
+        cmd = ['disk-image-create', '-t', 'tar', '-o', dest] + base_elements
+        cmd = scheduling.command_prefix(self.scheduling) + cmd
+        snapshot_proc = self._dib_process(cmd, log_fh, env)
+        try:
+            snapshot_proc.start(blocking=True)
+            if snapshot_proc.exit_code or not os.path.exists(dest + '.tar'):
+                return None
+            return cache.add(key, dest + '.tar', self.uuid)
+        finally:
+            try:
+                os.unlink(dest + '.tar')
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _do_build(self):
+        if self.admission_control is not None and not self._admit():
+            return
+        self._pick_cpu_set()
+        self._tune()
+        if self.metrics:
+            self.metrics.build_started(self.name, self.uuid)
+        start_time = time.time()
+        dib_proc = None
+        try:
+            log_path = self.log_path
+            with open(log_path, 'w') as log_fh:
+                try:
+                    with _watchdog(self.limits,
+                                   lambda: util.file_size(log_path)):
+                        with tracing.span('prepare_build'):
+                            env = self._dib_env()
+                            env.update(self._cache_env(log_fh))
+                            env.update(self._seed_env(log_fh, env))
+                        dib_proc = self._dib_process(self.spawn_cmd, log_fh,
+                                                     env)
+                        with tracing.span('disk_image_create'):
+                            dib_proc.start(blocking=True)
+                except watchdog.Expired as e:
+                    self.stopped = e.to_dict()
+                    # Partial outputs are useless, give the space back
+                    self._unlink_outputs()
+            self.resources = getattr(dib_proc, 'usage', None)
+            # This is how much disk the build needs, before any compression
+            self.output_bytes = self.outputs_size
+            if self.compress and self._check_result()[0]:
+                with tracing.span('compress'):
+                    self._compress_outputs()
+            if self.deduplicator is not None and self._check_result()[0]:
+                with tracing.span('dedup'):
+                    self.dedup_outputs(self.deduplicator)
+            if self._check_result()[1] in (DibError.ExitStatus,
+                                           DibError.OutputMissing):
+                self._record_failure()
+        except Exception as e:
+            # We failed to run the build at all, which is a failure too
+            self._record_failure(e)
+            raise
+        finally:
+            if self.snapshot_cache is not None and self.layers:
+                self.snapshot_cache.release(self.uuid)
+            if self.resources is None:
+                self.resources = process.usage_summary(
+                    None, time.time() - start_time)
+            self.update_processfile()
+            if self.metrics:
+                status = 'error'
+                if self._check_result()[0]:
+                    status = 'completed'
+                self.metrics.build_finished(self.name, status,
+                                            self.resources['wall_time'],
+                                            self.outputs_size, self.uuid)
+
+    @property
+    def failure_index(self):
+        return failure.FailureIndex(os.path.join(self.pf_dir,
+                                                 'failures.json'))
+
+    def _record_failure(self, exc=None):
+        # Summarised once now so triage never has to read the log again
+        if exc is None:
+            self.failure = failure.extract(self.log_path)
+        else:
+            self.failure = failure.from_exception(exc, self.log_path)
+        self.failure_index.add(self.uuid, self.name, self.created_at,
+                               self.failure)
+
+    def _compress_outputs(self):
+        method = compression.resolve(self.compress['method'])
+        raw_sizes = {}
+        for fmt in self.output_formats:
+            path = self.raw_path_for_format(fmt)
+            raw_sizes[fmt] = util.file_size(path)
+            compression.compress_in_place(path, method,
+                                          self.compress.get('level'),
+                                          self.compress.get('threads', 0))
+        self.raw_sizes = raw_sizes
+        self.compression = method
+
+    def dedup_outputs(self, deduplicator):
+        self.dedup = dict((fmt, deduplicator.dedup(
+            self.dest_path_for_format(fmt))) for fmt in self.output_formats)
+
+    @property
+    def saved_bytes(self):
+        if not self.dedup:
+            return 0
+        return sum(x['saved_bytes'] for x in self.dedup.values())
 
     def succeeded(self):
         if self.is_running():
             return False, DibError.StillRunning
+        return self._check_result()
+
+    def _check_result(self):
+        if self.stopped:
+            return False, DibError.Stopped
+        if self.admission and self.admission['state'] == 'rejected':
+            return False, DibError.Rejected
+        if self.failure and self.failure.get('exception'):
+            return False, DibError.Exception
+        if self.resources and self.resources.get('exit_code'):
+            return False, DibError.ExitStatus
+        if self.outputs_removed:
+            return True, None
         if not all(map(os.path.exists, self.dest_paths)):
             return False, DibError.OutputMissing
         return True, None
 
+    def remove_outputs(self):
+        if self.metrics:
+            self.metrics.build_deleted(self.outputs_size)
+        self._unlink_outputs()
+
+    def _unlink_outputs(self):
+        paths = set(self.dest_paths)
+        # Including any left behind by an interrupted compression
+        for fmt in self.output_formats:
+            raw_path = self.raw_path_for_format(fmt)
+            paths.add(raw_path)
+            for suffix in compression.SUFFIXES.values():
+                paths.add('%s%s.tmp' % (raw_path, suffix))
+            # And the copy prepared for uploading over slow links
+            prepared_path = prepare.prepared_path(raw_path)
+            for suffix in ('', '.lock', '.tmp', '.raw'):
+                paths.add(prepared_path + suffix)
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
 
 class App(object):
     def __init__(self, config_path):
+        self.config_path = os.path.abspath(config_path)
         self.config = dib2cloud.config.Config.from_yaml_file(config_path)
+        self.metrics = metrics.MetricsStore(self.config.get('metrics_file'))
+        self.admission = None
+        if self.config.get('admission_policy') != 'off':
+            self.admission = admission.Admission(
+                self.config, self.config.get('build_processfile_dir'))
+        self.snapshot_cache = None
+        if self.config.get('snapshot_cache_size'):
+            self.snapshot_cache = snapshot.SnapshotCache(
+                self.config.get('snapshot_dir'),
+                self.config.get('snapshot_cache_size'),
+                self.config.get('snapshot_env_var'))
+        self.dib_cache = None
+        if self.config.get('dib_cache_dir'):
+            self.dib_cache = dibcache.DibCache(
+                self.config.get('dib_cache_dir'),
+                self.config.get('dib_cache_max_age'),
+                self.config.get('dib_cache_timeout'))
+        self.deduplicator = None
+        if self.config.get('dedup_mode') != 'off':
+            self.deduplicator = dedup.Deduplicator(
+                self.config.get('images_dir'), self.config.get('dedup_mode'))
+        self.tuner = None
+        if self.config.get('dib_tuning') != 'off':
+            self.tuner = tuning.Tuner(
+                self.config, self.config.get('build_processfile_dir'))
+        self.upload_queue = uploadqueue.UploadQueue(
+            self.config.get('upload_processfile_dir'),
+            self.config.get('upload_slots'),
+            self.config.get('upload_queue_poll_interval'))
 
-    def build(self, name, blocking=False):
+    def build(self, name, blocking=False, upload_to=None, keep_local=True,
+              inputs=None):
         # TODO(greghaynes) determine output_formats based on provider
         output_formats = ['qcow2']
         config = self.config.get('diskimages').get_one('name', name)
+        limits = self._limits('build')
+        for key in ('timeout', 'stall_timeout'):
+            if config.get(key) is not None:
+                limits[key] = config.get(key)
+        build_scheduling = scheduling.merge(
+            self.config.get('build_scheduling'), config.get('scheduling'))
+        scheduling.validate(build_scheduling)
 
         build = Build(self.config.get('buildlog_dir'),
                       self.config.get('build_processfile_dir'),
                       self.config.get('images_dir'),
                       config,
                       gen_uuid(),
-                      output_formats)
+                      output_formats,
+                      metrics=self.metrics,
+                      config_path=self.config_path,
+                      upload_to=upload_to,
+                      keep_local=keep_local,
+                      admission_control=self.admission,
+                      scheduling=build_scheduling,
+                      limits=limits,
+                      deduplicator=self.deduplicator,
+                      snapshot_cache=self.snapshot_cache,
+                      cache_artifacts=self.cache_artifacts([name]),
+                      dib_cache=self.dib_cache,
+                      compress=self._compress_settings(),
+                      inputs=inputs or self.build_inputs(name),
+                      tuner=self.tuner)
         build.run(blocking)
+        if blocking:
+            self._chain_uploads(build, blocking=True)
         return build
 
+    def build_inputs(self, name):
+        elements_path = self.config.get('elements_path')
+        if elements_path is None:
+            elements_path = [x for x in os.environ.get(
+                'ELEMENTS_PATH', '').split(':') if x]
+        return staleness.inputs(
+            self.config.get('diskimages').get_one('name', name),
+            elements_path, self.cache_artifacts([name]))
+
+    def stale(self, names=None):
+        """Return the diskimages which need rebuilding and why
+
+        A diskimage is stale when its config, its elements or the upstream
+        artifacts it is built from have changed since its latest successful
+        build, or that build is older than its max age. Diskimages with a
+        build already running are never stale.
+        """
+        now = time.time()
+        latest = {}
+        running = set()
+        for build in self.iter_builds():
+            if build.is_running():
+                running.add(build.name)
+            elif build.succeeded()[0]:
+                last = latest.get(build.name)
+                # Builds from before created_at was kept count as oldest
+                if last is None or (
+                        (build.created_at or 0) > (last.created_at or 0)):
+                    latest[build.name] = build
+        ret = []
+        for diskimage in self.config.get('diskimages').to_list():
+            name = diskimage.get('name')
+            if names is not None and name not in names:
+                continue
+            if name in running:
+                continue
+            max_age = diskimage.get('max_age')
+            if max_age is None:
+                max_age = self.config.get('rebuild_max_age')
+            inputs = self.build_inputs(name)
+            last_build = latest.get(name)
+            reasons = staleness.stale_reasons(inputs, last_build, max_age,
+                                              now)
+            if reasons:
+                ret.append({
+                    'name': name,
+                    'reasons': reasons,
+                    'last_build': last_build and last_build.uuid,
+                    'inputs': inputs
+                })
+        return ret
+
+    def running_builds(self):
+        return len([x for x in self.iter_builds() if x.is_running()])
+
+    def rebuild_stale(self, names=None, blocking=False, upload_to=None,
+                      dry_run=False):
+        """Rebuild only the diskimages which are stale
+
+        Each build starts after a random delay of up to rebuild_jitter
+        seconds and only once fewer than rebuild_concurrency builds are
+        running on this host, so many stale diskimages don't saturate it.
+        """
+        stale = self.stale(names)
+        if dry_run:
+            return stale
+        for item in stale:
+            jitter = self.config.get('rebuild_jitter')
+            if jitter:
+                time.sleep(random.uniform(0, jitter))
+            while self.running_builds() >= self.config.get(
+                    'rebuild_concurrency'):
+                time.sleep(REBUILD_POLL_INTERVAL)
+            build = self.build(item['name'], blocking=blocking,
+                               upload_to=upload_to, inputs=item['inputs'])
+            item['build'] = build.uuid
+        return stale
+
+    def _chain_uploads(self, build, blocking=False):
+        """Upload a just finished build to the providers it asked for
+
+        Uploads run in parallel unless blocking is set. If the build does not
+        want a local copy kept it is removed once every upload succeeded.
+        """
+        if not build.upload_to or not build._check_result()[0]:
+            return []
+        uploads = [self.upload(build.uuid, x, blocking=blocking)
+                   for x in build.upload_to]
+        build.upload_ids = [x.uuid for x in uploads]
+        build.update_processfile()
+        for upload in uploads:
+            upload.wait()
+        uploads = [self.get_upload(x.uuid) for x in uploads]
+        uploaded = all(x.glance_uuid is not None for x in uploads)
+        if uploaded and not build.keep_local:
+            build.remove_outputs()
+            build.outputs_removed = True
+            build.update_processfile()
+        return uploads
+
+    def _compress_settings(self):
+        if self.config.get('compress_outputs') == 'off':
+            return None
+        return {
+            'method': self.config.get('compress_outputs'),
+            'level': self.config.get('compress_level'),
+            'threads': self.config.get('compress_threads')
+        }
+
+    def _limits(self, kind):
+        return {
+            'timeout': self.config.get('%s_timeout' % kind),
+            'stall_timeout': self.config.get('%s_stall_timeout' % kind),
+            'interval': self.config.get('watchdog_interval'),
+            'kill_grace': self.config.get('kill_grace_seconds')
+        }
+
+    def cache_artifacts(self, names=None):
+        """Return the artifacts builds of the named diskimages need
+
+        These are the globally configured artifacts followed by those of each
+        diskimage, or of every diskimage if names is not given.
+        """
+        artifacts = list(self.config.get('cache_artifacts'))
+        for diskimage in self.config.get('diskimages').to_list():
+            if names is None or diskimage.get('name') in names:
+                artifacts.extend(diskimage.get('cache_artifacts'))
+        ret = []
+        for artifact in artifacts:
+            if artifact not in ret:
+                ret.append(artifact)
+        return ret
+
+    def warm_cache(self, names=None):
+        """Fetch the artifacts needed by the named diskimages"""
+        if self.dib_cache is None:
+            raise ValueError('dib_cache_dir is not configured')
+        return self.dib_cache.warm(self.cache_artifacts(names))
+
     def get_builds(self):
         return Build.get_all(self.config.get('build_processfile_dir'))
 
+    def iter_builds(self, name=None, since=None):
+        def record_filter(record):
+            if name is not None and record['image_config']['name'] != name:
+                return False
+            return _created_since(record, since)
+        return Build.iter_all(self.config.get('build_processfile_dir'),
+                              record_filter)
+
+    def failure_groups(self, name=None, since=None):
+        """Return failed builds grouped by cause, the most common first"""
+        return failure.FailureIndex(os.path.join(
+            self.config.get('build_processfile_dir'),
+            'failures.json')).groups(name, since)
+
     def delete_build(self, build_uuid):
         pf_path = os.path.join(self.config.get('build_processfile_dir'),
                                '%s.processfile' % build_uuid)
@@ -167,30 +1010,344 @@ class App(object):
         if build.is_running():
             raise ValueError('Cannot delete build %s while it is running' %
                              build_uuid)
-        for path in build.dest_paths:
-            try:
-                os.unlink(path)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
-        os.unlink(pf_path)
+        build.metrics = self.metrics
+        build.remove_outputs()
+        if build.failure is not None:
+            build.failure_index.remove(build.uuid)
+        if self.deduplicator is not None:
+            for path in build.dest_paths:
+                self.deduplicator.forget(path)
+        try:
+            os.unlink(build.worker_log_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        build.remove_processfile()
         return build
 
-    def upload(self, build_uuid, provider_name, blocking=False):
+    def dedup(self):
+        """Deduplicate finished builds which have not been yet
+
+        Returns how many builds were deduplicated and how many bytes all
+        current builds save.
+        """
+        deduplicator = self.deduplicator or dedup.Deduplicator(
+            self.config.get('images_dir'))
+        deduped = 0
+        saved_bytes = 0
+        for build in self.iter_builds():
+            pending = build.dedup is None and not build.outputs_removed
+            if pending and build.succeeded()[0]:
+                build.dedup_outputs(deduplicator)
+                build.update_processfile()
+                deduped += 1
+            saved_bytes += build.saved_bytes
+        return {'deduplicated': deduped, 'saved_bytes': saved_bytes}
+
+    def get_job(self, job_uuid):
+        """Return the build or upload with the given id"""
+        build_pf_dir = self.config.get('build_processfile_dir')
+        if os.path.exists(process.processfile_for_uuid(build_pf_dir,
+                                                       job_uuid)):
+            return Build.from_uuid(build_pf_dir, job_uuid)
+        upload_pf_dir = self.config.get('upload_processfile_dir')
+        if os.path.exists(process.processfile_for_uuid(upload_pf_dir,
+                                                       job_uuid)):
+            return self.get_upload(job_uuid)
+        raise ValueError('No build or upload with id %s found' % job_uuid)
+
+    def cancel(self, job_uuid):
+        """Stop a running build or upload and clean up after it
+
+        The job's process is asked to stop first so it can stop everything it
+        started, remove partial outputs and record that it was cancelled. If
+        it has not exited after twice the kill grace period its process group
+        is killed and we clean up for it.
+        """
+        job = self.get_job(job_uuid)
+        if not job.is_running():
+            raise ValueError('%s is not running' % job_uuid)
+        if isinstance(job, Build) and job.resources is not None and (
+                job._check_result()[0]):
+            # Only its uploads are left, which are reading the outputs
+            raise ValueError('%s has already been built, cancel its uploads '
+                             'instead' % job_uuid)
+        os.kill(job.pid, signal.SIGTERM)
+        grace = self.config.get('kill_grace_seconds')
+        if not process.wait_exit(job.pid, grace * 2):
+            pgids = [job.pid]
+            if isinstance(job, Build):
+                pgids.append(self.get_job(job_uuid).dib_pgid)
+            for pgid in pgids:
+                if pgid is None:
+                    continue
+                try:
+                    os.killpg(pgid, signal.SIGKILL)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+            process.wait_exit(job.pid, grace)
+        job = self.get_job(job_uuid)
+        if job.stopped is None:
+            job.stopped = watchdog.Expired('cancelled', 'Cancelled').to_dict()
+            if isinstance(job, Build):
+                job._unlink_outputs()
+            if job.resources is None:
+                # Killed before it could finish up, so we do it for it
+                self._finish_killed(job)
+            job.update_processfile()
+        return job
+
+    def _finish_killed(self, job):
+        wall_time = None
+        if job.created_at is not None:
+            wall_time = time.time() - job.created_at
+        job.resources = process.usage_summary(None, wall_time)
+        if isinstance(job, Build):
+            self.metrics.build_finished(job.name, 'error', wall_time,
+                                        job.outputs_size, job.uuid)
+        else:
+            self.metrics.upload_finished(job.build_name, job.provider_name,
+                                         'cancelled', wall_time, None,
+                                         job.uuid)
+
+    def get_provider(self, name):
+        try:
+            return self.config.get('providers').get_one('name', name)
+        except dib2cloud.config.ConfigItemNotFoundError:
+            return None
+
+    def _bandwidth_bucket(self, name, config):
+        limit = config.get('bandwidth_limit')
+        profiles = config.get('bandwidth_profiles')
+        if limit is None and not profiles:
+            return None
+        return {
+            'path': os.path.join(self.config.get('throttle_dir'),
+                                 '%s.bucket' % name),
+            'limit': limit,
+            'profiles': profiles
+        }
+
+    def upload(self, build_uuid, provider_name, blocking=False,
+               priority=None, deadline=None):
+        """Upload a build to a provider, once the upload queue lets it
+
+        Waiting uploads with a higher priority start first, and those of the
+        same priority go by earliest deadline. Uploads which have started are
+        never paused. Without a priority the provider's is used.
+        """
         build_pf_dir = self.config.get('build_processfile_dir')
         build = Build.from_uuid(build_pf_dir, build_uuid)
         image_format = 'qcow2'
+
+        # Providers from our config map onto an os-client-config cloud, any
+        # other name is taken to be a cloud name directly
+        cloud_name = provider_name
+        buckets = [self._bandwidth_bucket('global', self.config)]
+        send_compressed = False
+        provider = self.get_provider(provider_name)
+        if provider is not None:
+            cloud_name = provider.get('cloud')
+            buckets.append(self._bandwidth_bucket(
+                'provider-%s' % provider_name, provider))
+            send_compressed = provider.get('accept_compressed')
+            if priority is None:
+                priority = provider.get('priority')
+        if priority is None:
+            priority = self.config.get('upload_priority')
+
         upload = Upload(self.config.get('upload_processfile_dir'),
                         build_pf_dir,
                         gen_uuid(),
                         build_uuid,
                         image_format,
-                        provider_name,
+                        cloud_name,
                         build.name,
-                        build.dest_path_for_format(image_format))
+                        build.dest_path_for_format(image_format),
+                        bandwidth_buckets=[x for x in buckets if x],
+                        provider_name=provider_name,
+                        metrics=self.metrics,
+                        config_path=self.config_path,
+                        limits=self._limits('upload'),
+                        compression=build.compression,
+                        image_size=(build.raw_sizes or {}).get(image_format),
+                        send_compressed=send_compressed,
+                        chunk_size=self.config.get('upload_chunk_size'),
+                        prepare=self._prepare_settings(
+                            build, provider_name, provider, image_format),
+                        priority=priority,
+                        deadline=deadline,
+                        expected_seconds=self._expected_seconds(
+                            build, provider_name, image_format),
+                        upload_queue=self.upload_queue,
+                        progress_interval=self.config.get(
+                            'upload_progress_interval'),
+                        stream=self.config.get('upload_stream'))
         upload.run(blocking)
         return upload
 
+    def _expected_seconds(self, build, provider_name, image_format):
+        link_rate = prepare.estimate(self.iter_uploads(),
+                                     provider_name)['link_rate']
+        size = (build.raw_sizes or {}).get(image_format) or util.file_size(
+            build.dest_path_for_format(image_format))
+        if not link_rate or not size:
+            return None
+        return size / float(link_rate)
+
+    def upload_queue_plan(self):
+        """Return the queue position and expected start of waiting uploads"""
+        return self.upload_queue.plan()
+
+    def _retention(self, provider_name, name):
+        policy = dict(self.config.get('upload_retention'))
+        provider = self.get_provider(provider_name)
+        if provider is not None:
+            policy.update(provider.get('retention'))
+        try:
+            diskimage = self.config.get('diskimages').get_one('name', name)
+        except dib2cloud.config.ConfigItemNotFoundError:
+            pass
+        else:
+            policy.update(diskimage.get('retention'))
+        return policy
+
+    def prune_uploads(self, providers=None, dry_run=False):
+        """Delete uploaded images the retention policies don't keep
+
+        Policies are given globally, per provider and per diskimage, later
+        ones overriding earlier ones. Images used by a server in their cloud
+        are always kept. Deletes go out in parallel batches of
+        prune_batch_size, paced to prune_rate deletes a second, and each
+        deleted image is recorded on its upload.
+        """
+        groups = {}
+        for upload in self.iter_uploads():
+            if upload.glance_uuid is None or upload.deleted:
+                continue
+            if providers is not None and upload.provider_name not in providers:
+                continue
+            key = (upload.cloud_name, upload.provider_name, upload.build_name)
+            groups.setdefault(key, []).append(upload)
+
+        clouds = {}
+        in_use = {}
+        pruned = {}
+        now = time.time()
+        for key in sorted(groups):
+            cloud_name, provider_name, name = key
+            policy = self._retention(provider_name, name)
+            if not policy:
+                continue
+            if cloud_name not in clouds:
+                clouds[cloud_name] = shade.openstack_cloud(cloud=cloud_name)
+                in_use[cloud_name] = set(
+                    x['image']['id'] for x in clouds[cloud_name].list_servers()
+                    if x.get('image'))
+            selected = retention.select(groups[key], policy,
+                                        in_use[cloud_name], now)
+            pruned.setdefault((cloud_name, provider_name), []).extend(
+                selected)
+
+        ret = []
+        for (cloud_name, provider_name), selected in sorted(pruned.items()):
+            errors = {}
+            if not dry_run:
+                errors = self._delete_images(
+                    clouds[cloud_name], provider_name,
+                    [x[0].glance_uuid for x in selected])
+            for upload, reason in selected:
+                error = errors.get(upload.glance_uuid)
+                status = 'would delete'
+                if not dry_run:
+                    status = 'error' if error else 'deleted'
+                if status == 'deleted':
+                    upload.deleted = {'time': time.time(), 'reason': reason}
+                    upload.update_processfile()
+                ret.append({
+                    'id': upload.uuid,
+                    'glance_uuid': upload.glance_uuid,
+                    'name': upload.build_name,
+                    'provider': provider_name,
+                    'reason': reason,
+                    'status': status,
+                    'error': error
+                })
+        return ret
+
+    def _delete_images(self, cloud, provider_name, image_ids):
+        bucket = None
+        if self.config.get('prune_rate'):
+            bucket = throttle.TokenBucket(
+                os.path.join(self.config.get('throttle_dir'),
+                             'prune-%s.bucket' % provider_name),
+                self.config.get('prune_rate'))
+        image_service = glance.ImageService.from_cloud(cloud)
+        return retention.delete_batched(image_service.delete_image,
+                                        image_ids,
+                                        self.config.get('prune_batch_size'),
+                                        bucket)
+
+    def _prepare_settings(self, build, provider_name, provider,
+                          image_format):
+        """Return how to prepare the build's image for the provider, if at all
+
+        In auto mode an image is prepared when the provider's link is slow
+        enough that sparsifying and compressing it first gets it there
+        sooner, going by earlier uploads. An image which has already been
+        prepared is always used.
+        """
+        policy = self.config.get('prepare_uploads')
+        if provider is not None and provider.get('prepare') is not None:
+            policy = provider.get('prepare')
+        if policy == 'off':
+            return None
+        raw_size = (build.raw_sizes or {}).get(image_format)
+        if raw_size is None:
+            raw_size = util.file_size(build.dest_path_for_format(image_format))
+        settings = {
+            'qemu_img': self.config.get('qemu_img'),
+            'path': prepare.prepared_path(
+                build.raw_path_for_format(image_format)),
+            'format': image_format,
+            'raw_size': raw_size
+        }
+        if policy == 'always' or os.path.exists(settings['path']):
+            return settings
+        estimate = prepare.estimate(self.iter_uploads(), provider_name)
+        if estimate['prepare_rate'] is None:
+            estimate['prepare_rate'] = self.config.get('prepare_default_rate')
+        if estimate['ratio'] is None:
+            estimate['ratio'] = self.config.get('prepare_default_ratio')
+        settings['estimate'] = estimate
+        if prepare.worthwhile(raw_size, **estimate):
+            return settings
+        return None
+
+    def run_job(self, kind, job_uuid):
+        """Run a build or upload which was handed to us by a worker"""
+        build_pf_dir = self.config.get('build_processfile_dir')
+        if kind == 'build':
+            job = Build.from_uuid(build_pf_dir, job_uuid)
+        elif kind == 'upload':
+            job = self.get_upload(job_uuid)
+        else:
+            raise ValueError('Unknown job kind %s' % kind)
+        job.metrics = self.metrics
+        if kind == 'build':
+            job.admission_control = self.admission
+            job.deduplicator = self.deduplicator
+            job.snapshot_cache = self.snapshot_cache
+            job.dib_cache = self.dib_cache
+            job.tuner = self.tuner
+        else:
+            job.upload_queue = self.upload_queue
+        job.run_in_worker()
+        if kind == 'build':
+            self._chain_uploads(job)
+        return job
+
     def get_upload(self, upload_uuid):
         return Upload.from_uuid(self.config.get('upload_processfile_dir'),
                                 upload_uuid,
@@ -199,3 +1356,15 @@ class App(object):
     def get_uploads(self):
         return Upload.get_all(self.config.get('upload_processfile_dir'),
                               self.config.get('build_processfile_dir'))
+
+    def iter_uploads(self, name=None, cloud=None, since=None):
+        def record_filter(record):
+            if name is not None and record['build_name'] != name:
+                return False
+            if cloud is not None and cloud not in (
+                    record['cloud_name'], record.get('provider_name')):
+                return False
+            return _created_since(record, since)
+        return Upload.iter_all(self.config.get('upload_processfile_dir'),
+                               self.config.get('build_processfile_dir'),
+                               record_filter)
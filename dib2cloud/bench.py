@@ -0,0 +1,175 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import requests
+
+import dib2cloud
+from dib2cloud import app
+from dib2cloud import fakeglance
+from dib2cloud import process
+
+
+IMAGE_KINDS = ('dense', 'sparse', 'compressible')
+
+
+def make_image(path, kind, size):
+    """Write a synthetic image of the given kind and size to path"""
+    block = 1024 * 1024
+    with open(path, 'wb') as fh:
+        if kind == 'sparse':
+            # A little data at the start of every 64M and holes otherwise,
+            # much like a freshly built filesystem
+            fh.truncate(size)
+            for offset in range(0, size, 64 * block):
+                fh.seek(offset)
+                fh.write(os.urandom(min(4096, size - offset)))
+            return
+        if kind == 'compressible':
+            pattern = b'dib2cloud ' * (block // 10)
+        elif kind != 'dense':
+            raise ValueError('Unknown image kind %s' % kind)
+        written = 0
+        while written < size:
+            amount = min(block, size - written)
+            if kind == 'dense':
+                fh.write(os.urandom(amount))
+            else:
+                fh.write(pattern[:amount])
+            written += amount
+
+
+def read_proc_io(path='/proc/self/io'):
+    ret = {}
+    try:
+        with open(path, 'r') as fh:
+            for line in fh:
+                key, _, value = line.partition(':')
+                ret[key] = int(value)
+    except IOError:
+        pass
+    return ret
+
+
+class LocalCloud(object):
+    """Stands in for a shade cloud whose image endpoint is FakeGlance"""
+
+    def __init__(self, endpoint):
+        self.keystone_session = requests.Session()
+        self.endpoint = endpoint
+
+    def get_session_endpoint(self, service_key):
+        return self.endpoint
+
+
+def _upload(endpoint, image_path, chunk_size, pf_dir, result_fd):
+    start_io = read_proc_io()
+    upload = app.Upload(pf_dir, pf_dir, app.gen_uuid(), 'bench', 'raw',
+                        'bench', 'bench', image_path, chunk_size=chunk_size,
+                        stream=True)
+    upload._cloud = LocalCloud(endpoint)
+    upload._do_upload()
+    end_io = read_proc_io()
+    result = {
+        'bytes': upload._bytes_read(),
+        'syscr': end_io.get('syscr', 0) - start_io.get('syscr', 0),
+        'syscw': end_io.get('syscw', 0) - start_io.get('syscw', 0)
+    }
+    with os.fdopen(result_fd, 'w') as fh:
+        fh.write(json.dumps(result))
+
+
+def run_case(endpoint, image_path, chunk_size, concurrency, pf_dir):
+    """Upload image_path concurrency times at once through Upload
+
+    Each upload runs in its own process, as uploads normally do, so its CPU
+    time and peak memory can be measured on its own and apart from the
+    server's.
+    """
+    children = []
+    start_time = time.time()
+    with process.default_sigchld():
+        for _ in range(concurrency):
+            read_fd, write_fd = os.pipe()
+            pid = process.PythonProcess(_upload, endpoint, image_path,
+                                        chunk_size, pf_dir, write_fd).start()
+            os.close(write_fd)
+            children.append((pid, read_fd))
+        results = []
+        for pid, read_fd in children:
+            with os.fdopen(read_fd, 'r') as fh:
+                data = fh.read()
+            _, status, rusage = os.wait4(pid, 0)
+            if not data or os.WEXITSTATUS(status):
+                raise RuntimeError('Benchmark upload failed')
+            result = json.loads(data)
+            result['cpu'] = rusage.ru_utime + rusage.ru_stime
+            result['max_rss'] = rusage.ru_maxrss * 1024
+            results.append(result)
+    wall_time = time.time() - start_time
+    total_bytes = sum(x['bytes'] for x in results)
+    gigabytes = total_bytes / float(1024 ** 3)
+    megabytes = total_bytes / float(1024 ** 2)
+    cpu = sum(x['cpu'] for x in results)
+    syscalls = sum(x['syscr'] + x['syscw'] for x in results)
+    return {
+        'chunk_size': chunk_size,
+        'concurrency': concurrency,
+        'bytes': total_bytes,
+        'wall_time': wall_time,
+        'mb_per_second': megabytes / wall_time if wall_time else None,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_gb': cpu / gigabytes if gigabytes else None,
+        'read_syscalls': sum(x['syscr'] for x in results),
+        'write_syscalls': sum(x['syscw'] for x in results),
+        'syscalls_per_mb': syscalls / megabytes if megabytes else None,
+        'peak_rss': max(x['max_rss'] for x in results)
+    }
+
+
+def run(size, kinds=IMAGE_KINDS, chunk_sizes=(1024 * 1024,),
+        concurrency=(1,), work_dir=None):
+    """Benchmark uploads against a local FakeGlance and return a report
+
+    Every combination of image kind, chunk size and concurrency is run once.
+    Syscall counts are the read and write family calls the kernel counts in
+    /proc/<pid>/io.
+    """
+    made_work_dir = work_dir is None
+    if made_work_dir:
+        work_dir = tempfile.mkdtemp(prefix='dib2cloud-bench-')
+    try:
+        results = _run_all(work_dir, size, kinds, chunk_sizes, concurrency)
+    finally:
+        if made_work_dir:
+            shutil.rmtree(work_dir)
+    return {
+        'version': dib2cloud.__version__,
+        'python': platform.python_version(),
+        'time': time.time(),
+        'image_size': size,
+        'results': results
+    }
+
+
+def _run_all(work_dir, size, kinds, chunk_sizes, concurrency):
+    results = []
+    with fakeglance.FakeGlance() as glance:
+        for kind in kinds:
+            image_path = os.path.join(work_dir, '%s.img' % kind)
+            make_image(image_path, kind, size)
+            try:
+                for chunk_size in chunk_sizes:
+                    for count in concurrency:
+                        result = run_case(glance.endpoint, image_path,
+                                          chunk_size, count, work_dir)
+                        result['image'] = kind
+                        results.append(result)
+                        # Keep the server's memory flat between cases
+                        glance.images.clear()
+            finally:
+                os.unlink(image_path)
+    return results
@@ -1,25 +1,98 @@
 import argparse
 import json
+import re
 import sys
+import time
 
 from dib2cloud import app
+from dib2cloud import bench
+from dib2cloud import farm
+from dib2cloud import metrics
+from dib2cloud import tracing
+from dib2cloud import uploadqueue
 
 
 # This gives us a convenient place to monkeypatch for testing
 def output(out):
+    if isinstance(out, bytes):
+        out = out.decode('utf-8')
     print(out)
+    sys.stdout.flush()
 
 
-def upload_summary_dict(upload):
+SINCE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_since(value, sign=-1):
+    """Parse a relative age (30m, 12h, 7d) or a local date/time"""
+    match = re.match(r'^(\d+)([smhd])$', value)
+    if match:
+        return time.time() + sign * int(match.group(1)) * SINCE_UNITS[
+            match.group(2)]
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Invalid time: %s' % value)
+
+
+def parse_deadline(value):
+    """Parse a time from now (30m, 12h, 7d) or a local date/time"""
+    return parse_since(value, sign=1)
+
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(value):
+    """Parse a byte count with an optional K, M or G suffix"""
+    match = re.match(r'^(\d+)([kmg]?)$', value.lower())
+    if not match:
+        raise argparse.ArgumentTypeError('Invalid size: %s' % value)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def parse_list(item_type):
+    def parse(value):
+        return [item_type(x) for x in value.split(',')]
+    return parse
+
+
+def upload_summary_dict(upload, queued=None):
     status = 'uploading'
-    if upload.glance_uuid is not None:
+    if upload.deleted:
+        status = 'deleted'
+    elif upload.glance_uuid is not None:
         status = 'completed'
+    elif upload.stopped:
+        status = upload.stopped['state']
+    elif upload.error:
+        status = 'error'
+    elif queued is not None:
+        status = upload.queue['state']
+    elif upload.pid is not None and not upload.is_running():
+        # The worker died without saying why. Blocking uploads run in the
+        # process which asked for them and have no pid to go by.
+        status = 'error'
 
-    return {
+    ret = {
         'upload_name': upload.upload_name,
         'glance_uuid': upload.glance_uuid,
-        'status': status
+        'status': status,
+        'resources': upload.resources,
+        'progress': upload.progress,
+        'error': upload.error
     }
+    if queued is not None:
+        ret.update({
+            'priority': upload.priority,
+            'deadline': upload.deadline,
+            'queue_position': queued['position'],
+            'expected_start': queued['expected_start'],
+            'deadline_at_risk': queued['deadline_at_risk']
+        })
+    return ret
 
 
 def dib_summary_dict(dib, status_str=None):
@@ -30,6 +103,12 @@ def dib_summary_dict(dib, status_str=None):
         else:
             if status[1] == app.DibError.StillRunning:
                 status_str = 'building'
+                if dib.admission and dib.admission['state'] == 'held':
+                    status_str = 'held'
+            elif status[1] == app.DibError.Rejected:
+                status_str = 'rejected'
+            elif status[1] == app.DibError.Stopped:
+                status_str = dib.stopped['state']
             else:
                 status_str = 'error'
 
@@ -44,18 +123,69 @@ def dib_summary_dict(dib, status_str=None):
         'id': dib.uuid,
         'pid': pid,
         'log': dib.log_path,
-        'destinations': dib.dest_paths
+        'destinations': dib.dest_paths,
+        'resources': dib.resources,
+        'uploads': dib.upload_ids,
+        'admission': dib.admission,
+        'failure': dib.failure
     }
 
 
 def cmd_build(d2c, args):
-    dib = d2c.build(args.image_name)
+    upload_to = None
+    if args.upload_to:
+        upload_to = args.upload_to.split(',')
+    dib = d2c.build(args.image_name, upload_to=upload_to,
+                    keep_local=args.keep_local)
     output(json.dumps(dib_summary_dict(dib)).encode('utf-8'))
 
 
+def cmd_rebuild_stale(d2c, args):
+    upload_to = None
+    if args.upload_to:
+        upload_to = args.upload_to.split(',')
+    while True:
+        stale = d2c.rebuild_stale(args.image_names or None,
+                                  upload_to=upload_to,
+                                  dry_run=args.dry_run)
+        for item in stale:
+            # Too noisy to print and already recorded on the build
+            del item['inputs']
+        output(json.dumps(stale).encode('utf-8'))
+        if not args.every:
+            return
+        time.sleep(args.every)
+
+
+def output_records(records, args):
+    records = filter_records(records, args)
+    if args.format == 'ndjson':
+        for record in records:
+            output(json.dumps(record).encode('utf-8'))
+    else:
+        output(json.dumps(list(records)).encode('utf-8'))
+
+
+def filter_records(records, args):
+    count = 0
+    for record in records:
+        if args.limit is not None and count >= args.limit:
+            return
+        if args.status is not None and record['status'] != args.status:
+            continue
+        count += 1
+        yield record
+
+
 def cmd_list_builds(d2c, args):
-    dibs = d2c.get_builds()
-    output(json.dumps(list(map(dib_summary_dict, dibs))).encode('utf-8'))
+    if args.group_by_cause:
+        # Only failed builds have a cause
+        groups = d2c.failure_groups(name=args.name, since=args.since)
+        args.status = None
+        output_records(groups, args)
+        return
+    dibs = d2c.iter_builds(name=args.name, since=args.since)
+    output_records(map(dib_summary_dict, dibs), args)
 
 
 def cmd_delete_build(d2c, args):
@@ -63,14 +193,123 @@ def cmd_delete_build(d2c, args):
     output(json.dumps(dib_summary_dict(dib, 'deleted')).encode('utf-8'))
 
 
+def cmd_cancel(d2c, args):
+    job = d2c.cancel(args.id)
+    if isinstance(job, app.Build):
+        summary = dib_summary_dict(job)
+    else:
+        summary = upload_summary_dict(job)
+    output(json.dumps(summary).encode('utf-8'))
+
+
+def cmd_dedup(d2c, args):
+    output(json.dumps(d2c.dedup()).encode('utf-8'))
+
+
+def cmd_warm_cache(d2c, args):
+    fetched = d2c.warm_cache(args.image_names or None)
+    output(json.dumps(fetched).encode('utf-8'))
+
+
 def cmd_upload(d2c, args):
-    upload = d2c.upload(args.build_id, args.cloud_name)
+    upload = d2c.upload(args.build_id, args.cloud_name,
+                        priority=args.priority, deadline=args.deadline)
     output(json.dumps(upload_summary_dict(upload)).encode('utf-8'))
 
 
 def cmd_list_uploads(d2c, args):
-    uploads = d2c.get_uploads()
-    output(json.dumps(list(map(upload_summary_dict, uploads))).encode('utf-8'))
+    uploads = d2c.iter_uploads(name=args.name, cloud=args.cloud,
+                               since=args.since)
+    output_records(upload_summaries(d2c, uploads), args)
+
+
+def upload_summaries(d2c, uploads):
+    """Summarise uploads, working out the queue once one is waiting"""
+    plan = None
+    for upload in uploads:
+        queued = None
+        if (upload.queue or {}).get('state') in uploadqueue.WAITING:
+            if plan is None:
+                plan = d2c.upload_queue_plan()
+            queued = plan.get(upload.uuid)
+        yield upload_summary_dict(upload, queued)
+
+
+def cmd_prune_uploads(d2c, args):
+    providers = None
+    if args.provider:
+        providers = args.provider.split(',')
+    pruned = d2c.prune_uploads(providers, dry_run=args.dry_run)
+    output(json.dumps(pruned).encode('utf-8'))
+
+
+def cmd_bench_upload(d2c, args):
+    report = bench.run(args.size, args.images, args.chunk_sizes,
+                       args.concurrency)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(data)
+    output(data.encode('utf-8'))
+
+
+def cmd_farm_coordinator(d2c, args):
+    host, _, port = args.listen.rpartition(':')
+    coordinator = farm.Coordinator(d2c.config.get('farm_dir'),
+                                   d2c.config.get('farm_lease_seconds'),
+                                   d2c.config.get('farm_max_attempts'))
+    farm.make_server(coordinator, host or '127.0.0.1', int(port),
+                     d2c.config.get('farm_token')).serve_forever()
+
+
+def cmd_farm_agent(d2c, args):
+    agent = farm.Agent(d2c, args.url, worker=args.worker,
+                       slots=args.slots or d2c.config.get('farm_slots'),
+                       publish_dir=d2c.config.get('farm_publish_dir'),
+                       token=d2c.config.get('farm_token'))
+    agent.serve_forever(d2c.config.get('farm_poll_interval'))
+
+
+def cmd_farm_submit(d2c, args):
+    upload_to = None
+    if args.upload_to:
+        upload_to = args.upload_to.split(',')
+    client = farm.Client(args.url, d2c.config.get('farm_token'))
+    jobs = [client.request('/jobs', {'name': x, 'upload_to': upload_to})
+            for x in args.image_names]
+    output(json.dumps(jobs).encode('utf-8'))
+
+
+def cmd_farm_jobs(d2c, args):
+    client = farm.Client(args.url, d2c.config.get('farm_token'))
+    output(json.dumps(client.request('/jobs')).encode('utf-8'))
+
+
+def add_list_arguments(subparser):
+    subparser.add_argument('--format', choices=['json', 'ndjson'],
+                           default='json',
+                           help='ndjson prints one record per line as soon '
+                                'as it is read')
+    subparser.add_argument('--name', type=str, default=None,
+                           help='Only show this diskimage')
+    subparser.add_argument('--status', type=str, default=None)
+    subparser.add_argument('--since', type=parse_since, default=None,
+                           help='Only show records created since a time '
+                                '(YYYY-MM-DD[THH:MM[:SS]]) or an age such as '
+                                '30m, 12h or 7d')
+    subparser.add_argument('--limit', type=int, default=None)
+
+
+def cmd_metrics(d2c, args):
+    if args.textfile:
+        d2c.metrics.write_textfile(args.textfile)
+    elif args.listen:
+        host, _, port = args.listen.rpartition(':')
+        server = metrics.make_server(d2c.metrics, host or '127.0.0.1',
+                                     int(port))
+        server.serve_forever()
+    else:
+        output(d2c.metrics.render().encode('utf-8'))
 
 
 def main(argv=None):
@@ -79,26 +318,172 @@ def main(argv=None):
     parser = argparse.ArgumentParser(prog='dib2cloud')
     parser.add_argument('--config', dest='config_path', type=str,
                         default='/etc/dib2cloud.conf')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Write cProfile and tracemalloc output for the '
+                             'command and any workers it starts, and a '
+                             'trace of them, to this directory')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='Append timed spans of the command and its '
+                             'workers to this Chrome trace file')
     subparsers = parser.add_subparsers(help='sub-command help')
 
     build_subparser = subparsers.add_parser('build')
     build_subparser.set_defaults(func=cmd_build)
     build_subparser.add_argument('image_name', type=str)
+    build_subparser.add_argument('--upload-to', type=str, default=None,
+                                 help='Comma separated providers to upload '
+                                      'to once the build finishes')
+    build_subparser.add_argument('--no-keep-local', dest='keep_local',
+                                 action='store_false',
+                                 help='Remove the local image once every '
+                                      'upload has succeeded')
+
+    rebuild_stale_subparser = subparsers.add_parser(
+        'rebuild-stale', help='Rebuild diskimages whose inputs changed')
+    rebuild_stale_subparser.set_defaults(func=cmd_rebuild_stale)
+    rebuild_stale_subparser.add_argument('image_names', type=str, nargs='*',
+                                         help='Only consider these '
+                                              'diskimages')
+    rebuild_stale_subparser.add_argument('--dry-run', action='store_true',
+                                         help='Only report what is stale')
+    rebuild_stale_subparser.add_argument('--every', type=int, default=None,
+                                         help='Keep checking every this '
+                                              'many seconds')
+    rebuild_stale_subparser.add_argument('--upload-to', type=str,
+                                         default=None,
+                                         help='Comma separated providers to '
+                                              'upload to once each build '
+                                              'finishes')
 
     list_builds_subparser = subparsers.add_parser('list-builds')
     list_builds_subparser.set_defaults(func=cmd_list_builds)
+    add_list_arguments(list_builds_subparser)
+    list_builds_subparser.add_argument('--group-by-cause',
+                                       action='store_true',
+                                       help='Group failed builds by the '
+                                            'cause of their failure')
 
     delete_build_subparser = subparsers.add_parser('delete-build')
     delete_build_subparser.set_defaults(func=cmd_delete_build)
     delete_build_subparser.add_argument('build_id', type=str)
 
+    dedup_subparser = subparsers.add_parser(
+        'dedup', help='Link identical build outputs together')
+    dedup_subparser.set_defaults(func=cmd_dedup)
+
+    warm_cache_subparser = subparsers.add_parser(
+        'warm-cache', help='Fetch base artifacts into the image cache')
+    warm_cache_subparser.set_defaults(func=cmd_warm_cache)
+    warm_cache_subparser.add_argument('image_names', type=str, nargs='*',
+                                      help='Only fetch what these '
+                                           'diskimages need')
+
+    cancel_subparser = subparsers.add_parser('cancel')
+    cancel_subparser.set_defaults(func=cmd_cancel)
+    cancel_subparser.add_argument('id', type=str,
+                                  help='Build or upload id')
+
     upload_subparser = subparsers.add_parser('upload')
     upload_subparser.set_defaults(func=cmd_upload)
     upload_subparser.add_argument('build_id', type=str)
     upload_subparser.add_argument('cloud_name', type=str)
+    upload_subparser.add_argument('--priority', type=int, default=None,
+                                  help='Higher priorities start first')
+    upload_subparser.add_argument('--deadline', type=parse_deadline,
+                                  default=None,
+                                  help='When the upload is needed by, a '
+                                       'local date/time or a time from now '
+                                       'such as 30m or 2h')
 
     list_uploads_subparser = subparsers.add_parser('list-uploads')
     list_uploads_subparser.set_defaults(func=cmd_list_uploads)
+    add_list_arguments(list_uploads_subparser)
+    list_uploads_subparser.add_argument('--cloud', type=str, default=None,
+                                        help='Only show uploads to this '
+                                             'provider or cloud')
+
+    prune_uploads_subparser = subparsers.add_parser(
+        'prune-uploads', help='Delete uploaded images past their retention')
+    prune_uploads_subparser.set_defaults(func=cmd_prune_uploads)
+    prune_uploads_subparser.add_argument('--provider', type=str,
+                                         default=None,
+                                         help='Comma separated providers to '
+                                              'prune, all by default')
+    prune_uploads_subparser.add_argument('--dry-run', action='store_true',
+                                         help='Only report what would be '
+                                              'deleted')
+
+    bench_upload_subparser = subparsers.add_parser(
+        'bench-upload', help='Benchmark uploads against a local fake glance')
+    bench_upload_subparser.set_defaults(func=cmd_bench_upload)
+    bench_upload_subparser.add_argument('--size', type=parse_size,
+                                        default=256 * 1024 ** 2,
+                                        help='Size of each synthetic image')
+    bench_upload_subparser.add_argument('--images', type=parse_list(str),
+                                        default=list(bench.IMAGE_KINDS),
+                                        help='Comma separated image kinds: '
+                                             'dense, sparse, compressible')
+    bench_upload_subparser.add_argument('--chunk-sizes',
+                                        type=parse_list(parse_size),
+                                        default=[64 * 1024, 1024 ** 2,
+                                                 8 * 1024 ** 2])
+    bench_upload_subparser.add_argument('--concurrency',
+                                        type=parse_list(int),
+                                        default=[1, 4],
+                                        help='Comma separated numbers of '
+                                             'parallel uploads')
+    bench_upload_subparser.add_argument('--output', type=str, default=None,
+                                        help='Also write the JSON report '
+                                             'to this file')
+
+    farm_coordinator_subparser = subparsers.add_parser(
+        'farm-coordinator', help='Queue builds for farm agents')
+    farm_coordinator_subparser.set_defaults(func=cmd_farm_coordinator)
+    farm_coordinator_subparser.add_argument('--listen', type=str,
+                                            default='127.0.0.1:8470',
+                                            help='[host:]port to serve on')
+
+    farm_agent_subparser = subparsers.add_parser(
+        'farm-agent', help='Run builds queued on a farm coordinator')
+    farm_agent_subparser.set_defaults(func=cmd_farm_agent)
+    farm_agent_subparser.add_argument('url', type=str)
+    farm_agent_subparser.add_argument('--slots', type=int, default=None,
+                                      help='How many builds to run at once')
+    farm_agent_subparser.add_argument('--worker', type=str, default=None,
+                                      help='Name to lease builds as, the '
+                                           'hostname by default')
+
+    farm_submit_subparser = subparsers.add_parser(
+        'farm-submit', help='Queue builds on a farm coordinator')
+    farm_submit_subparser.set_defaults(func=cmd_farm_submit)
+    farm_submit_subparser.add_argument('url', type=str)
+    farm_submit_subparser.add_argument('image_names', type=str, nargs='+')
+    farm_submit_subparser.add_argument('--upload-to', type=str,
+                                       default=None,
+                                       help='Comma separated providers to '
+                                            'upload to once each build '
+                                            'finishes')
+
+    farm_jobs_subparser = subparsers.add_parser(
+        'farm-jobs', help='List the builds queued on a farm coordinator')
+    farm_jobs_subparser.set_defaults(func=cmd_farm_jobs)
+    farm_jobs_subparser.add_argument('url', type=str)
+
+    metrics_subparser = subparsers.add_parser('metrics')
+    metrics_subparser.set_defaults(func=cmd_metrics)
+    metrics_subparser.add_argument('--textfile', type=str, default=None,
+                                   help='Write metrics to this file for the '
+                                        'node_exporter textfile collector')
+    metrics_subparser.add_argument('--listen', type=str, default=None,
+                                   help='Serve metrics over HTTP on '
+                                        '[host:]port')
 
     args = parser.parse_args(argv[1:])
-    args.func(app.App(config_path=args.config_path), args)
+    command = args.func.__name__[len('cmd_'):].replace('_', '-')
+    if args.trace:
+        tracing.enable(args.trace, 'dib2cloud %s' % command)
+    profiler = tracing.profile_from_environ(command)
+    if args.profile:
+        profiler = tracing.profile(args.profile, command)
+    with profiler, tracing.span('command', command=command):
+        args.func(app.App(config_path=args.config_path), args)
@@ -0,0 +1,92 @@
+import contextlib
+import gzip
+import os
+import shutil
+import subprocess
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+from dib2cloud import process
+
+
+METHODS = ('auto', 'zstd', 'gzip')
+SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+CHUNK_SIZE = 1024 * 1024
+
+
+def resolve(method):
+    """Return the compression method to use for a configured one"""
+    if method == 'auto':
+        if which('zstd'):
+            return 'zstd'
+        return 'gzip'
+    return method
+
+
+def compress(src, dest, method, level=None, threads=0):
+    """Write a compressed copy of src to dest"""
+    if method == 'zstd':
+        # zstd spreads the work over threads, 0 meaning one per core
+        cmd = ['zstd', '-q', '-f', '-T%d' % threads]
+        if level is not None:
+            cmd.append('-%d' % level)
+        with process.default_sigchld():
+            subprocess.check_call(cmd + [src, '-o', dest])
+    elif method == 'gzip':
+        with open(src, 'rb') as src_fh:
+            with open(dest, 'wb') as raw:
+                # A fixed header keeps identical outputs identical once
+                # compressed so they can still be deduplicated
+                with gzip.GzipFile(filename='', mode='wb', fileobj=raw,
+                                   compresslevel=level or 6,
+                                   mtime=0) as dest_fh:
+                    shutil.copyfileobj(src_fh, dest_fh, CHUNK_SIZE)
+    else:
+        raise ValueError('Unknown compression method %s' % method)
+
+
+@contextlib.contextmanager
+def open_decompressed(path, method=None):
+    """Yield a file object reading the decompressed contents of path
+
+    Nothing is written to disk, zstd decompresses into a pipe we read from.
+    """
+    if method is None:
+        with open(path, 'rb') as fh:
+            yield fh
+    elif method == 'gzip':
+        with gzip.open(path, 'rb') as fh:
+            yield fh
+    elif method == 'zstd':
+        with process.default_sigchld():
+            proc = subprocess.Popen(['zstd', '-q', '-d', '-c', path],
+                                    stdout=subprocess.PIPE)
+            try:
+                yield proc.stdout
+            finally:
+                proc.stdout.close()
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+            if proc.returncode not in (0, -9):
+                raise IOError('zstd failed to decompress %s' % path)
+    else:
+        raise ValueError('Unknown compression method %s' % method)
+
+
+def compress_in_place(path, method, level=None, threads=0):
+    """Replace path with a compressed copy and return the new path"""
+    dest = path + SUFFIXES[method]
+    tmp_path = '%s.tmp' % dest
+    try:
+        compress(path, tmp_path, method, level, threads)
+        os.rename(tmp_path, dest)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    os.unlink(path)
+    return dest
@@ -7,6 +7,10 @@ DEFAULT_BUILD_PROCESSFILE_DIR = os.path.expanduser('~/.dib2cloud/run/builds')
 DEFAULT_UPLOAD_PROCESSFILE_DIR = os.path.expanduser('~/.dib2cloud/run/uploads')
 DEFAULT_BUILDLOG_DIR = os.path.expanduser('~/.dib2cloud/logs/builds')
 DEFAULT_IMAGES_DIR = os.path.expanduser('~/.dib2cloud/images')
+DEFAULT_THROTTLE_DIR = os.path.expanduser('~/.dib2cloud/run/throttle')
+DEFAULT_METRICS_FILE = os.path.expanduser('~/.dib2cloud/run/metrics.json')
+DEFAULT_SNAPSHOT_DIR = os.path.expanduser('~/.dib2cloud/cache/snapshots')
+DEFAULT_FARM_DIR = os.path.expanduser('~/.dib2cloud/farm')
 
 
 class ConfigValueMissingError(Exception):
@@ -94,7 +98,7 @@ class ConfigCollection(ConfigValue):
             if found:
                 return ret
             else:
-                return ConfigItemNotFoundError(
+                raise ConfigItemNotFoundError(
                     'No item with property %s=%s found'
                     % (item_property, val)
                 )
@@ -128,19 +132,54 @@ class ConfigCollection(ConfigValue):
 
 class Diskimage(ConfigDict):
     defaults = {
-        'env_vars': []
+        'env_vars': [],
+        'scheduling': {},
+        'timeout': None,
+        'stall_timeout': None,
+        'base_elements': [],
+        'cache_artifacts': [],
+        'max_age': None,
+        'retention': {}
     }
 
     def __init__(self, **kwargs):
+        env_vars = kwargs.get('env_vars') or []
+        if not isinstance(env_vars, dict) and not all(
+                '=' in str(x) for x in env_vars):
+            raise ConfigKeyInvalidError(
+                'env_vars must be a dict or a list of NAME=value'
+            )
         super(Diskimage, self).__init__(['name',
                                          'elements',
-                                         'env_vars'], kwargs)
+                                         'env_vars',
+                                         'scheduling',
+                                         'timeout',
+                                         'stall_timeout',
+                                         'base_elements',
+                                         'cache_artifacts',
+                                         'max_age',
+                                         'retention'], kwargs)
 
 
 class Provider(ConfigDict):
+    defaults = {
+        'bandwidth_limit': None,
+        'bandwidth_profiles': [],
+        'accept_compressed': False,
+        'retention': {},
+        'prepare': None,
+        'priority': None
+    }
+
     def __init__(self, **kwargs):
         super(Provider, self).__init__(['name',
-                                        'cloud'], kwargs)
+                                        'cloud',
+                                        'bandwidth_limit',
+                                        'bandwidth_profiles',
+                                        'accept_compressed',
+                                        'retention',
+                                        'prepare',
+                                        'priority'], kwargs)
 
 
 class DiskimagesCollection(ConfigCollection):
@@ -158,8 +197,63 @@ class Config(ConfigDict):
         'upload_processfile_dir': DEFAULT_UPLOAD_PROCESSFILE_DIR,
         'buildlog_dir': DEFAULT_BUILDLOG_DIR,
         'images_dir': DEFAULT_IMAGES_DIR,
-        'providers': [],
-        'diskimages': []
+        'throttle_dir': DEFAULT_THROTTLE_DIR,
+        'metrics_file': DEFAULT_METRICS_FILE,
+        'bandwidth_limit': None,
+        'bandwidth_profiles': [],
+        'admission_policy': 'off',
+        'admission_default_memory': 2 * 1024 ** 3,
+        'admission_default_disk': 5 * 1024 ** 3,
+        'admission_min_free_memory': 512 * 1024 ** 2,
+        'admission_min_free_disk': 1024 ** 3,
+        'admission_ramp_seconds': 300,
+        'admission_hold_timeout': 3600,
+        'admission_poll_interval': 30,
+        'build_scheduling': {},
+        'build_timeout': None,
+        'build_stall_timeout': None,
+        'upload_timeout': None,
+        'upload_stall_timeout': None,
+        'watchdog_interval': 10,
+        'kill_grace_seconds': 30,
+        'dedup_mode': 'off',
+        'snapshot_dir': DEFAULT_SNAPSHOT_DIR,
+        'snapshot_cache_size': 0,
+        'snapshot_env_var': 'DIB_LOCAL_IMAGE',
+        'dib_cache_dir': None,
+        'dib_cache_max_age': 86400,
+        'dib_cache_timeout': 60,
+        'cache_artifacts': [],
+        'compress_outputs': 'off',
+        'compress_level': None,
+        'compress_threads': 0,
+        'elements_path': None,
+        'rebuild_max_age': None,
+        'rebuild_jitter': 0,
+        'rebuild_concurrency': 2,
+        'upload_retention': {},
+        'upload_chunk_size': 1024 * 1024,
+        'upload_stream': False,
+        'upload_slots': None,
+        'upload_priority': 0,
+        'upload_queue_poll_interval': 5,
+        'upload_progress_interval': 5,
+        'prepare_uploads': 'off',
+        'dib_tuning': 'off',
+        'qemu_img': 'qemu-img',
+        'prepare_default_rate': 50 * 1024 ** 2,
+        'prepare_default_ratio': 0.7,
+        'farm_dir': DEFAULT_FARM_DIR,
+        'farm_lease_seconds': 120,
+        'farm_max_attempts': 3,
+        'farm_poll_interval': 5,
+        'farm_slots': 1,
+        'farm_publish_dir': None,
+        'farm_token': None,
+        'prune_batch_size': 10,
+        'prune_rate': None,
+        'providers': ConfigCollection([]),
+        'diskimages': DiskimagesCollection([])
     }
 
     @classmethod
@@ -173,6 +267,30 @@ class Config(ConfigDict):
         return Config(**config_dict)
 
     def __init__(self, **kwargs):
+        if kwargs.get('admission_policy', 'off') not in ('off', 'hold',
+                                                         'reject'):
+            raise ConfigKeyInvalidError(
+                'admission_policy must be one of off, hold or reject'
+            )
+        if kwargs.get('dedup_mode', 'off') not in ('off', 'auto', 'reflink',
+                                                   'hardlink'):
+            raise ConfigKeyInvalidError(
+                'dedup_mode must be one of off, auto, reflink or hardlink'
+            )
+        if kwargs.get('compress_outputs', 'off') not in ('off', 'auto',
+                                                         'zstd', 'gzip'):
+            raise ConfigKeyInvalidError(
+                'compress_outputs must be one of off, auto, zstd or gzip'
+            )
+        if kwargs.get('prepare_uploads', 'off') not in ('off', 'auto',
+                                                        'always'):
+            raise ConfigKeyInvalidError(
+                'prepare_uploads must be one of off, auto or always'
+            )
+        if kwargs.get('dib_tuning', 'off') not in ('off', 'auto'):
+            raise ConfigKeyInvalidError(
+                'dib_tuning must be one of off or auto'
+            )
         if 'diskimages' in kwargs:
             kwargs['diskimages'] = DiskimagesCollection(
                 [Diskimage(**x) for x in kwargs['diskimages']]
@@ -187,7 +305,62 @@ class Config(ConfigDict):
                                       'build_processfile_dir',
                                       'upload_processfile_dir',
                                       'buildlog_dir',
-                                      'images_dir'], kwargs)
+                                      'images_dir',
+                                      'throttle_dir',
+                                      'metrics_file',
+                                      'admission_policy',
+                                      'admission_default_memory',
+                                      'admission_default_disk',
+                                      'admission_min_free_memory',
+                                      'admission_min_free_disk',
+                                      'admission_ramp_seconds',
+                                      'admission_hold_timeout',
+                                      'admission_poll_interval',
+                                      'build_scheduling',
+                                      'build_timeout',
+                                      'build_stall_timeout',
+                                      'upload_timeout',
+                                      'upload_stall_timeout',
+                                      'watchdog_interval',
+                                      'kill_grace_seconds',
+                                      'dedup_mode',
+                                      'snapshot_dir',
+                                      'snapshot_cache_size',
+                                      'snapshot_env_var',
+                                      'dib_cache_dir',
+                                      'dib_cache_max_age',
+                                      'dib_cache_timeout',
+                                      'cache_artifacts',
+                                      'compress_outputs',
+                                      'compress_level',
+                                      'compress_threads',
+                                      'elements_path',
+                                      'rebuild_max_age',
+                                      'rebuild_jitter',
+                                      'rebuild_concurrency',
+                                      'upload_retention',
+                                      'upload_chunk_size',
+                                      'upload_stream',
+                                      'upload_slots',
+                                      'upload_priority',
+                                      'upload_queue_poll_interval',
+                                      'upload_progress_interval',
+                                      'prepare_uploads',
+                                      'dib_tuning',
+                                      'qemu_img',
+                                      'prepare_default_rate',
+                                      'prepare_default_ratio',
+                                      'farm_dir',
+                                      'farm_lease_seconds',
+                                      'farm_max_attempts',
+                                      'farm_poll_interval',
+                                      'farm_slots',
+                                      'farm_publish_dir',
+                                      'farm_token',
+                                      'prune_batch_size',
+                                      'prune_rate',
+                                      'bandwidth_limit',
+                                      'bandwidth_profiles'], kwargs)
 
     def to_yaml_file(self, path):
         with open(path, 'w') as fh:
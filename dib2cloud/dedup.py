@@ -0,0 +1,111 @@
+import errno
+import fcntl
+import hashlib
+import os
+
+from dib2cloud import util
+
+
+# From linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reflink(src, dest):
+    with open(src, 'rb') as src_fh:
+        with open(dest, 'wb') as dest_fh:
+            fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+
+
+def _replace(src, dest, link_func):
+    # Link next to dest then rename over it so dest is never missing
+    tmp_path = '%s.dedup' % dest
+    try:
+        link_func(src, tmp_path)
+        os.rename(tmp_path, dest)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class Deduplicator(object):
+    """Replace build outputs with links to identical earlier outputs
+
+    Outputs are indexed by content hash as builds finish, so each new output
+    is hashed once and compared against the index instead of rescanning
+    images_dir. Reflinks share data but stay independent files. Hardlinks
+    work on any filesystem but make the duplicates the same file, which is
+    fine as we never modify outputs in place.
+    """
+
+    def __init__(self, images_dir, mode='auto'):
+        self.images_dir = images_dir
+        self.mode = mode
+        self.index_path = os.path.join(images_dir, '.dedup-index.json')
+
+    def _link(self, src, dest):
+        methods = []
+        if self.mode in ('auto', 'reflink'):
+            methods.append(('reflink', reflink))
+        if self.mode in ('auto', 'hardlink'):
+            methods.append(('hardlink', os.link))
+        for name, link_func in methods:
+            try:
+                _replace(src, dest, link_func)
+                return name
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EXDEV, errno.EINVAL, errno.EPERM,
+                                   errno.EMLINK):
+                    raise
+        return None
+
+    def dedup(self, path):
+        """Index path and link it to an identical output if there is one
+
+        Returns a dict describing what was done, including the bytes saved.
+        """
+        size = os.path.getsize(path)
+        digest = file_hash(path)
+        ret = {'hash': digest, 'method': None, 'source': None,
+               'saved_bytes': 0}
+        with util.locked_json(self.index_path) as index:
+            entry = index.setdefault(digest, {'size': size, 'paths': []})
+            # Forget outputs which have been deleted since they were indexed
+            entry['paths'] = [x for x in entry['paths']
+                              if x != path and os.path.exists(x)]
+            for src in entry['paths']:
+                if os.path.samefile(src, path):
+                    ret.update({'method': 'hardlink', 'source': src})
+                    break
+                method = self._link(src, path)
+                if method is not None:
+                    ret.update({'method': method, 'source': src,
+                                'saved_bytes': size})
+                    break
+            entry['paths'].append(path)
+        return ret
+
+    def forget(self, path):
+        """Drop a deleted output from the index"""
+        with util.locked_json(self.index_path) as index:
+            for digest in list(index):
+                paths = index[digest]['paths']
+                if path in paths:
+                    paths.remove(path)
+                if not paths:
+                    del index[digest]
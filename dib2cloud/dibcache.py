@@ -0,0 +1,73 @@
+import os
+import shutil
+import time
+
+try:
+    from urllib import request as urllib_request
+except ImportError:
+    import urllib2 as urllib_request
+
+from dib2cloud import process
+from dib2cloud import util
+
+
+class DibCache(object):
+    """The disk-image-create download cache shared by builds on this host
+
+    Artifacts are dicts with a 'url' and optionally a 'path' relative to the
+    cache, which defaults to the last part of the url. Each artifact has its
+    own lock so exactly one build downloads it while any others needing it
+    wait, then find it in place. A fetch gives up once its server is silent
+    for timeout seconds, rather than hanging every build waiting on it.
+    """
+
+    def __init__(self, path, max_age=None, timeout=60):
+        self.path = path
+        self.max_age = max_age
+        self.timeout = timeout
+
+    def artifact_path(self, artifact):
+        rel_path = artifact.get('path') or artifact['url'].rstrip('/').split(
+            '/')[-1]
+        return os.path.join(self.path, rel_path)
+
+    def _fresh(self, path, max_age):
+        if not os.path.exists(path):
+            return False
+        if not max_age:
+            return True
+        return time.time() - os.path.getmtime(path) < max_age
+
+    def fetch(self, artifact):
+        """Make sure artifact is in the cache, return whether we fetched it"""
+        path = self.artifact_path(artifact)
+        max_age = artifact.get('max_age', self.max_age)
+        util.assert_dir(os.path.dirname(path))
+        with process.LockedFile('%s.lock' % path):
+            if self._fresh(path, max_age):
+                return False
+            tmp_path = '%s.tmp' % path
+            try:
+                resp = urllib_request.urlopen(artifact['url'],
+                                              timeout=self.timeout)
+                try:
+                    with open(tmp_path, 'wb') as fh:
+                        shutil.copyfileobj(resp, fh, 1024 * 1024)
+                finally:
+                    resp.close()
+                # Anyone not taking our lock still never sees a partial file
+                os.rename(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        return True
+
+    def warm(self, artifacts):
+        ret = []
+        for artifact in artifacts:
+            fetched = self.fetch(artifact)
+            ret.append({'url': artifact['url'],
+                        'path': self.artifact_path(artifact),
+                        'fetched': fetched})
+        return ret
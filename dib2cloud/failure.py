@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+
+from dib2cloud import util
+
+
+TAIL_LINES = 20
+TAIL_BYTES = 64 * 1024
+
+# A hook script such as install.d/50-foo, and its element when DIB logs the
+# path it was copied from
+_SCRIPT_RE = re.compile(r'(?:elements/(?P<element>[^/\s]+)/)?'
+                        r'(?P<script>[\w-]+\.d/[^\s/:\'"]+)'
+                        r'(?=[\s:\'"]|$)')
+_ERROR_RE = re.compile(r'error|fail|fatal|could not|couldn\'t|unable to|'
+                       r'no such|not found|denied|refused|timed out|'
+                       r'E: |exit(ed)? (status|with|code)', re.I)
+_NORMALISE = [
+    # Timestamps
+    (re.compile(r'\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(\.\d+)?'), '<time>'),
+    (re.compile(r'\b\d\d:\d\d:\d\d(\.\d+)?\b'), '<time>'),
+    # DIB prefixes every line with the time
+    (re.compile(r'^<time> \| '), ''),
+    # Temporary paths are different for every build
+    (re.compile(r'/tmp/[^\s:\'"]+'), '/tmp/<path>'),
+    (re.compile(r'\b[0-9a-f]{32}\b|\b[0-9a-f-]{36}\b'), '<uuid>'),
+    (re.compile(r'\b0x[0-9a-f]+\b', re.I), '<hex>'),
+    (re.compile(r'\d+'), '<n>'),
+]
+
+
+def tail(path, lines=TAIL_LINES, max_bytes=TAIL_BYTES):
+    """Return the last lines of path without reading all of it"""
+    try:
+        with open(path, 'rb') as fh:
+            fh.seek(0, os.SEEK_END)
+            fh.seek(max(0, fh.tell() - max_bytes))
+            data = fh.read()
+    except IOError:
+        return []
+    text = data.decode('utf-8', 'replace')
+    return [x.rstrip() for x in text.splitlines() if x.strip()][-lines:]
+
+
+def normalise(line):
+    for pattern, replacement in _NORMALISE:
+        line = pattern.sub(replacement, line)
+    return line.strip()
+
+
+def extract(log_path):
+    """Summarise why a build failed from the end of its log"""
+    lines = tail(log_path)
+    element = None
+    script = None
+    for line in lines:
+        match = _SCRIPT_RE.search(line)
+        if match:
+            element = match.group('element') or element
+            script = match.group('script')
+    error = None
+    for line in reversed(lines):
+        if _ERROR_RE.search(line):
+            error = line
+            break
+    if error is None and lines:
+        error = lines[-1]
+    cause = normalise(error or '')
+    return {
+        'tail': lines,
+        'element': element,
+        'script': script,
+        'error': error,
+        'cause': cause,
+        'fingerprint': _fingerprint(script, cause)
+    }
+
+
+def from_exception(exc, log_path):
+    """Summarise a build which failed with exc rather than in DIB"""
+    ret = extract(log_path)
+    error = '%s: %s' % (type(exc).__name__, exc)
+    cause = normalise(error)
+    ret.update({
+        'error': error,
+        'cause': cause,
+        'exception': type(exc).__name__,
+        'fingerprint': _fingerprint(ret['script'], cause)
+    })
+    return ret
+
+
+def _fingerprint(script, cause):
+    digest = hashlib.sha1(('%s|%s' % (script, cause)).encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+class FailureIndex(object):
+    """Failed builds grouped by the fingerprint of their failure
+
+    Kept up to date as builds fail and are deleted so grouping never has to
+    read a log or a processfile.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, build_uuid, name, created_at, failure):
+        with util.locked_json(self.path) as index:
+            group = index.setdefault(failure['fingerprint'], {
+                'cause': failure['cause'],
+                'element': failure['element'],
+                'script': failure['script'],
+                'builds': {}
+            })
+            group['builds'][build_uuid] = {'name': name,
+                                           'created_at': created_at}
+
+    def remove(self, build_uuid):
+        with util.locked_json(self.path) as index:
+            for fingerprint in list(index):
+                builds = index[fingerprint]['builds']
+                builds.pop(build_uuid, None)
+                if not builds:
+                    del index[fingerprint]
+
+    def groups(self, name=None, since=None):
+        """Return failure groups, the most common first"""
+        def matches(build):
+            if name is not None and build['name'] != name:
+                return False
+            return since is None or (build['created_at'] or 0) >= since
+
+        ret = []
+        index = util.read_locked_json(self.path)
+        for fingerprint, group in index.items():
+            build_ids = sorted(x for x, build in group['builds'].items()
+                               if matches(build))
+            if not build_ids:
+                continue
+            ret.append({
+                'fingerprint': fingerprint,
+                'cause': group['cause'],
+                'element': group['element'],
+                'script': group['script'],
+                'count': len(build_ids),
+                'builds': build_ids
+            })
+        ret.sort(key=lambda x: (-x['count'], x['fingerprint']))
+        return ret
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+
+try:
+    from http import server as http_server
+except ImportError:
+    import BaseHTTPServer as http_server
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class _Server(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+
+class FakeGlance(object):
+    """Just enough of a glance v2 server on localhost to upload to
+
+    Image data is checksummed and thrown away so uploads of any size can
+    be made against it. Image records are kept in memory and available as
+    images.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.images = {}
+        self.lock = threading.Lock()
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/v2' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _handler(self):
+        glance = self
+
+        class Handler(http_server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body=None):
+                data = b''
+                if body is not None:
+                    data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _chunks(self):
+                length = self.headers.get('Content-Length')
+                if length is not None:
+                    remaining = int(length)
+                    while remaining:
+                        chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        yield chunk
+                    return
+                # Streamed bodies of unknown size are sent chunked
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if not size:
+                        self.rfile.readline()
+                        return
+                    yield self.rfile.read(size)
+                    self.rfile.readline()
+
+            def _image_id(self, suffix=''):
+                match = re.match(r'^/v2/images/([^/]+)%s$' % suffix,
+                                 self.path)
+                return match and match.group(1)
+
+            def do_POST(self):
+                if self.path != '/v2/images':
+                    return self._reply(404)
+                body = json.loads(b''.join(self._chunks()).decode('utf-8'))
+                image = dict(body)
+                image.update({'id': str(uuid.uuid4()), 'status': 'queued',
+                              'size': None, 'checksum': None,
+                              'created_at': time.time()})
+                with glance.lock:
+                    glance.images[image['id']] = image
+                self._reply(201, image)
+
+            def do_PUT(self):
+                image_id = self._image_id('/file')
+                if image_id not in glance.images:
+                    return self._reply(404)
+                digest = hashlib.md5()
+                size = 0
+                for chunk in self._chunks():
+                    digest.update(chunk)
+                    size += len(chunk)
+                with glance.lock:
+                    glance.images[image_id].update({
+                        'status': 'active', 'size': size,
+                        'checksum': digest.hexdigest()})
+                self._reply(204)
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/v2/images':
+                    with glance.lock:
+                        images = list(glance.images.values())
+                    return self._reply(200, {'images': images})
+                image = glance.images.get(self._image_id())
+                if image is None:
+                    return self._reply(404)
+                self._reply(200, image)
+
+            def do_DELETE(self):
+                with glance.lock:
+                    image = glance.images.pop(self._image_id(), None)
+                self._reply(404 if image is None else 204)
+
+        return Handler
@@ -0,0 +1,407 @@
+import contextlib
+import hmac
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+try:
+    from http import server as http_server
+except ImportError:
+    import BaseHTTPServer as http_server
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from urllib import request as urllib_request
+    from urllib.error import HTTPError
+except ImportError:
+    import urllib2 as urllib_request
+    from urllib2 import HTTPError
+
+from dib2cloud import process
+from dib2cloud import util
+
+
+# How much of a build log is sent with each heartbeat
+LOG_CHUNK = 64 * 1024
+
+TOKEN_HEADER = 'X-Dib2cloud-Farm-Token'
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+class UnauthorizedError(Exception):
+    pass
+
+
+class Coordinator(object):
+    """The queue of builds a farm of agents works through
+
+    Agents lease queued jobs, renewing the lease with every heartbeat. When
+    an agent's host goes away its leases run out and the jobs go back on
+    the queue, until a job has been tried max_attempts times. The queue is
+    kept in farm_dir so it survives the coordinator restarting.
+    """
+
+    def __init__(self, farm_dir, lease_seconds=120, max_attempts=3):
+        self.farm_dir = farm_dir
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.state_path = os.path.join(farm_dir, 'farm.json')
+        self.log_dir = os.path.join(farm_dir, 'logs')
+        # Requests are served from several threads, which file locks don't
+        # keep apart
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _state(self):
+        with self._lock:
+            with util.locked_json(self.state_path) as state:
+                state.setdefault('jobs', {})
+                state.setdefault('workers', {})
+                self._expire_leases(state, time.time())
+                yield state
+
+    def _expire_leases(self, state, now):
+        for job in state['jobs'].values():
+            if job['state'] != 'leased' or job['lease_expires'] > now:
+                continue
+            job['history'].append({'worker': job['worker'],
+                                   'result': 'lease expired', 'time': now})
+            job['worker'] = None
+            job['state'] = 'queued'
+            if job['attempts'] >= self.max_attempts:
+                job['state'] = 'failed'
+
+    def log_path(self, job_id):
+        return os.path.join(self.log_dir, '%s.log' % job_id)
+
+    def submit(self, name, upload_to=None):
+        job = {
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'upload_to': upload_to,
+            'state': 'queued',
+            'submitted_at': time.time(),
+            'worker': None,
+            'lease_expires': None,
+            'attempts': 0,
+            'history': [],
+            'result': None
+        }
+        with self._state() as state:
+            state['jobs'][job['id']] = job
+        return job
+
+    def jobs(self):
+        with self._state() as state:
+            return sorted(state['jobs'].values(),
+                          key=lambda x: x['submitted_at'])
+
+    def workers(self):
+        with self._state() as state:
+            return state['workers']
+
+    def lease(self, worker, capacity):
+        """Hand out queued jobs, oldest first, up to the worker's free slots"""
+        now = time.time()
+        leased = []
+        with self._state() as state:
+            running = [x for x in state['jobs'].values()
+                       if x['state'] == 'leased' and x['worker'] == worker]
+            state['workers'][worker] = {'capacity': capacity,
+                                        'last_seen': now,
+                                        'running': len(running)}
+            free = capacity.get('slots', 1) - len(running)
+            queued = sorted((x for x in state['jobs'].values()
+                             if x['state'] == 'queued'),
+                            key=lambda x: x['submitted_at'])
+            for job in queued[:max(0, free)]:
+                job.update({'state': 'leased', 'worker': worker,
+                            'lease_expires': now + self.lease_seconds})
+                job['attempts'] += 1
+                leased.append(dict(job))
+            state['workers'][worker]['running'] += len(leased)
+        return leased
+
+    def _held_job(self, state, job_id, worker):
+        job = state['jobs'].get(job_id)
+        if job is None or job['state'] != 'leased' or job['worker'] != worker:
+            raise LeaseLostError('%s does not hold %s' % (worker, job_id))
+        return job
+
+    def heartbeat(self, job_id, worker, log_offset=0, log=''):
+        """Renew a lease and append the next part of the job's log"""
+        with self._state() as state:
+            job = self._held_job(state, job_id, worker)
+            job['lease_expires'] = time.time() + self.lease_seconds
+            state['workers'].setdefault(worker, {})['last_seen'] = time.time()
+        if log:
+            self._append_log(job_id, log_offset, log)
+        return job
+
+    def _append_log(self, job_id, offset, log):
+        util.assert_dir(self.log_dir)
+        path = self.log_path(job_id)
+        # A retried heartbeat resends what we may already have
+        with open(path, 'a+b') as fh:
+            if offset == fh.tell():
+                fh.write(log.encode('utf-8'))
+
+    def finish(self, job_id, worker, result):
+        with self._state() as state:
+            job = self._held_job(state, job_id, worker)
+            job['state'] = 'completed'
+            if result.get('status') != 'completed':
+                job['state'] = 'failed'
+            job['result'] = result
+            job['lease_expires'] = None
+            job['history'].append({'worker': worker,
+                                   'result': result.get('status'),
+                                   'time': time.time()})
+        return job
+
+
+class _Server(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+
+def make_server(coordinator, host, port, token):
+    """Serve the coordinator to agents and clients which know token"""
+    if not token:
+        raise ValueError('A farm token is required to serve the coordinator')
+
+    class CoordinatorHandler(http_server.BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+
+        def _authorized(self):
+            given = self.headers.get(TOKEN_HEADER) or ''
+            if hmac.compare_digest(given.encode('utf-8'),
+                                   token.encode('utf-8')):
+                return True
+            self._reply(401, {'error': 'Missing or wrong farm token'})
+            return False
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path == '/jobs':
+                self._reply(200, coordinator.jobs())
+            elif self.path == '/workers':
+                self._reply(200, coordinator.workers())
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            body = self._body()
+            parts = self.path.strip('/').split('/')
+            try:
+                if parts == ['jobs']:
+                    self._reply(201, coordinator.submit(
+                        body['name'], body.get('upload_to')))
+                elif parts == ['lease']:
+                    self._reply(200, coordinator.lease(
+                        body['worker'], body.get('capacity', {})))
+                elif len(parts) == 3 and parts[2] == 'heartbeat':
+                    self._reply(200, coordinator.heartbeat(
+                        parts[1], body['worker'], body.get('log_offset', 0),
+                        body.get('log', '')))
+                elif len(parts) == 3 and parts[2] == 'finish':
+                    self._reply(200, coordinator.finish(
+                        parts[1], body['worker'], body['result']))
+                else:
+                    self.send_error(404)
+            except LeaseLostError as e:
+                self._reply(409, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Server((host, port), CoordinatorHandler)
+
+
+class Client(object):
+    def __init__(self, url, token=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, path, body=None):
+        data = None
+        headers = {}
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        req = urllib_request.Request(self.url + path, data, headers)
+        try:
+            resp = urllib_request.urlopen(req, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 409:
+                raise LeaseLostError(path)
+            if e.code == 401:
+                # Not something waiting will fix, unlike other HTTP errors
+                raise UnauthorizedError('%s refused our farm_token' %
+                                        self.url)
+            raise
+        try:
+            return json.loads(resp.read().decode('utf-8'))
+        finally:
+            resp.close()
+
+
+class Agent(object):
+    """Runs builds leased from a coordinator on this host
+
+    Builds run as usual for the local App, their logs are streamed to the
+    coordinator with each heartbeat and finished outputs are copied to
+    publish_dir, if given, and uploaded wherever the job asked. A build whose
+    lease was lost, because the coordinator gave up on us, is cancelled, or
+    its uploads are if it has already been built. A job which can't be
+    started here is reported as failed straight away.
+    """
+
+    def __init__(self, d2c, url, worker=None, slots=1, publish_dir=None,
+                 blocking=False, token=None):
+        self.app = d2c
+        self.client = Client(url, token)
+        self.worker = worker or socket.gethostname()
+        self.slots = slots
+        self.publish_dir = publish_dir
+        # Only for running builds in the foreground, one at a time
+        self.blocking = blocking
+        self.running = {}
+
+    def run_once(self):
+        """Take as many jobs as we have room for and report on our builds"""
+        capacity = {'slots': self.slots}
+        if len(self.running) < self.slots:
+            for job in self.client.request(
+                    '/lease', {'worker': self.worker, 'capacity': capacity}):
+                self._start(job)
+        for job_id in list(self.running):
+            self._report(job_id)
+
+    def serve_forever(self, interval=5):
+        while True:
+            try:
+                self.run_once()
+            except (IOError, OSError):
+                # The coordinator may only be restarting, our leases last
+                # longer than this
+                pass
+            time.sleep(interval)
+
+    def _start(self, job):
+        try:
+            build = self.app.build(job['name'], blocking=self.blocking,
+                                   upload_to=job.get('upload_to'))
+        except Exception as e:
+            # Such as a diskimage this host has no config for, which must not
+            # hold up the other jobs we leased
+            self._finish(job['id'], {
+                'status': 'error',
+                'worker': self.worker,
+                'error': '%s: %s' % (type(e).__name__, e)
+            })
+            return
+        self.running[job['id']] = {'build': build.uuid, 'log_offset': 0}
+
+    def _finish(self, job_id, result):
+        try:
+            self.client.request('/jobs/%s/finish' % job_id, {
+                'worker': self.worker, 'result': result})
+        except LeaseLostError:
+            pass
+
+    def _send_log(self, job_id, tracked, build):
+        offset = tracked['log_offset']
+        log = ''
+        if os.path.exists(build.log_path):
+            with open(build.log_path, 'rb') as fh:
+                fh.seek(offset)
+                log = fh.read(LOG_CHUNK).decode('utf-8', 'replace')
+        self.client.request('/jobs/%s/heartbeat' % job_id, {
+            'worker': self.worker, 'log_offset': offset, 'log': log})
+        tracked['log_offset'] = offset + len(log.encode('utf-8'))
+        return log
+
+    def _report(self, job_id):
+        tracked = self.running[job_id]
+        build = self.app.get_job(tracked['build'])
+        process.reap(build.pid)
+        running = build.is_running()
+        try:
+            # Once the build is done send the rest of its log
+            while self._send_log(job_id, tracked, build) and not running:
+                pass
+            if running:
+                return
+            self.client.request('/jobs/%s/finish' % job_id, {
+                'worker': self.worker, 'result': self._result(build)})
+        except LeaseLostError:
+            self._abandon(build)
+        del self.running[job_id]
+
+    def _abandon(self, build):
+        """Stop a build which is being run elsewhere now"""
+        if not build.is_running():
+            return
+        try:
+            self.app.cancel(build.uuid)
+        except ValueError:
+            # It has been built and is uploading, or has just finished
+            for upload_id in self.app.get_job(build.uuid).upload_ids:
+                try:
+                    self.app.cancel(upload_id)
+                except ValueError:
+                    pass
+
+    def _result(self, build):
+        succeeded = build.succeeded()[0]
+        published = []
+        if succeeded and self.publish_dir:
+            published = self._publish(build)
+        return {
+            'status': 'completed' if succeeded else 'error',
+            'worker': self.worker,
+            'build': build.uuid,
+            'destinations': build.dest_paths,
+            'published': published,
+            'uploads': build.upload_ids,
+            'failure': build.failure
+        }
+
+    def _publish(self, build):
+        dest_dir = os.path.join(self.publish_dir, build.name)
+        util.assert_dir(dest_dir)
+        ret = []
+        for path in build.dest_paths:
+            dest = os.path.join(dest_dir, os.path.basename(path))
+            tmp_path = '%s.tmp' % dest
+            shutil.copyfile(path, tmp_path)
+            os.rename(tmp_path, dest)
+            ret.append(dest)
+        return ret
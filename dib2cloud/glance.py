@@ -0,0 +1,160 @@
+import os
+import re
+import time
+
+from dib2cloud import compression
+from dib2cloud import tracing
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class GlanceError(Exception):
+    pass
+
+
+class ImageReader(object):
+    """Iterate over an image file in chunks, applying bandwidth limits
+
+    Passing this as a request body streams the file with a known
+    Content-Length while letting us pace every chunk that is sent. A
+    compressed file is decompressed as it is read, in which case its size
+    has to be given to know the Content-Length. gate, if given, is called
+    before every chunk.
+    """
+
+    def __init__(self, path, buckets=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compression=None, size=None, gate=None):
+        self.path = path
+        self.buckets = buckets or []
+        self.gate = gate
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self._size = size
+        self.bytes_read = 0
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def size(self):
+        if self._size is None and self.compression is None:
+            return os.path.getsize(self.path)
+        return self._size
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def body(self):
+        """What to send, which is sent chunked if we don't know the size"""
+        if self.size is None:
+            return iter(self)
+        return self
+
+    def __iter__(self):
+        self.start_time = time.time()
+        with compression.open_decompressed(self.path,
+                                           self.compression) as fh:
+            while True:
+                if self.gate is not None:
+                    self.gate()
+                chunk_start = time.time()
+                chunk = fh.read(self.chunk_size)
+                if not chunk:
+                    break
+                for bucket in self.buckets:
+                    bucket.consume(len(chunk))
+                self.bytes_read += len(chunk)
+                # How long reading and pacing the chunk took, sending it is
+                # the time until we are asked for the next one
+                tracing.emit('upload_chunk', bytes=len(chunk),
+                             duration=time.time() - chunk_start)
+                yield chunk
+        self.end_time = time.time()
+
+    @property
+    def throughput(self):
+        if self.start_time is None:
+            return None
+        elapsed = (self.end_time or time.time()) - self.start_time
+        if elapsed <= 0:
+            return None
+        return self.bytes_read / elapsed
+
+
+class ImageService(object):
+    """Just enough of the glance v2 API to upload image data ourselves
+
+    Uploads only go through here when they need pacing or decompressing,
+    which shade's create_image can't do, and only once version tells us
+    the cloud speaks glance v2.
+    """
+
+    def __init__(self, session, endpoint):
+        self.session = session
+        self.root = endpoint.rstrip('/')
+        match = re.search(r'/v(\d+)(\.\d+)?$', self.root)
+        self._version = int(match.group(1)) if match else None
+        self.endpoint = self.root if match else '%s/v2' % self.root
+
+    @classmethod
+    def from_cloud(cls, cloud):
+        return cls(cloud.keystone_session,
+                   cloud.get_session_endpoint('image'))
+
+    def _url(self, path):
+        return '%s%s' % (self.endpoint, path)
+
+    @property
+    def version(self):
+        """The glance major version of the endpoint, None if unknown"""
+        if self._version is None:
+            # An unversioned endpoint lists the versions it serves
+            resp = self.session.get(self.root)
+            ids = [x.get('id', '') for x in resp.json().get('versions', [])
+                   if x.get('status') in ('CURRENT', 'SUPPORTED')]
+            if any(x.startswith('v2') for x in ids):
+                self._version = 2
+            elif any(x.startswith('v1') for x in ids):
+                self._version = 1
+        return self._version
+
+    def create_image(self, name, disk_format, container_format,
+                     **properties):
+        body = dict(properties)
+        body.update({'name': name,
+                     'disk_format': disk_format,
+                     'container_format': container_format})
+        resp = self.session.post(self._url('/images'), json=body)
+        resp.raise_for_status()
+        return resp.json()['id']
+
+    def upload_image_data(self, image_id, data):
+        resp = self.session.put(
+            self._url('/images/%s/file' % image_id),
+            data=data,
+            headers={'Content-Type': 'application/octet-stream'})
+        resp.raise_for_status()
+
+    def wait_for_active(self, image_id, timeout=3600, interval=2):
+        """Wait until glance has finished importing image_id"""
+        deadline = time.time() + timeout
+        while True:
+            resp = self.session.get(self._url('/images/%s' % image_id))
+            resp.raise_for_status()
+            status = resp.json().get('status')
+            if status == 'active':
+                return
+            if status in ('killed', 'deleted', 'deactivated'):
+                raise GlanceError('Image %s went %s' % (image_id, status))
+            if time.time() >= deadline:
+                raise GlanceError('Image %s still %s after %d seconds' %
+                                  (image_id, status, timeout))
+            time.sleep(interval)
+
+    def delete_image(self, image_id):
+        resp = self.session.delete(self._url('/images/%s' % image_id))
+        # Already gone is as good as deleted
+        if getattr(resp, 'status_code', None) == 404:
+            return
+        resp.raise_for_status()
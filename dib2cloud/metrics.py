@@ -0,0 +1,246 @@
+import json
+import os
+import tempfile
+
+try:
+    from http import server as http_server
+except ImportError:
+    import BaseHTTPServer as http_server
+
+from dib2cloud import process
+from dib2cloud import util
+
+
+DURATION_BUCKETS = [60, 300, 600, 1200, 1800, 3600, 7200, 14400]
+THROUGHPUT_BUCKETS = [10 ** 5, 10 ** 6, 10 ** 7, 5 * 10 ** 7, 10 ** 8,
+                      10 ** 9]
+
+METRICS = {
+    'dib2cloud_builds_total': (
+        'counter', 'Finished builds by diskimage and status'),
+    'dib2cloud_uploads_total': (
+        'counter', 'Finished uploads by diskimage, provider and status'),
+    'dib2cloud_build_duration_seconds': (
+        'histogram', 'Wall time of finished builds'),
+    'dib2cloud_upload_duration_seconds': (
+        'histogram', 'Wall time of finished uploads'),
+    'dib2cloud_upload_bytes_sent_total': (
+        'counter', 'Bytes sent by uploads, finished or not'),
+    'dib2cloud_upload_bytes_per_second': (
+        'histogram', 'Average throughput of finished uploads'),
+    'dib2cloud_running_builds': (
+        'gauge', 'Builds currently running'),
+    'dib2cloud_running_uploads': (
+        'gauge', 'Uploads currently running'),
+    'dib2cloud_images_dir_bytes': (
+        'gauge', 'Bytes of build outputs stored in images_dir'),
+}
+
+
+def _label_key(labels):
+    return json.dumps(labels or {}, sort_keys=True)
+
+
+def _format_labels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in items)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class MetricsStore(object):
+    """Metrics kept up to date as builds and uploads change state
+
+    Every state change updates a small JSON file so producing the metrics
+    never has to look at processfiles or images_dir. Running jobs are kept
+    by uuid with the pid of their worker, and only those still alive are
+    counted, so a worker which is killed does not leave its gauge raised.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _update(self, func):
+        with util.locked_json(self.path) as state:
+            func(state)
+
+    @staticmethod
+    def _inc(state, metric, labels, amount=1):
+        values = state.setdefault(metric, {})
+        key = _label_key(labels)
+        values[key] = values.get(key, 0) + amount
+
+    @staticmethod
+    def _observe(state, metric, labels, value, buckets):
+        if value is None:
+            return
+        values = state.setdefault(metric, {})
+        hist = values.setdefault(_label_key(labels), {
+            'buckets': buckets,
+            'counts': [0] * len(buckets),
+            'sum': 0,
+            'count': 0
+        })
+        for i, bound in enumerate(hist['buckets']):
+            if value <= bound:
+                hist['counts'][i] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+    @staticmethod
+    def _start(state, uuid, metric, labels):
+        running = state.setdefault('running', {})
+        for key in [x for x in running
+                    if not process.pid_alive(running[x]['pid'])]:
+            del running[key]
+        running[uuid] = {'metric': metric, 'labels': labels,
+                         'pid': os.getpid()}
+        # Keeps the gauge of every label set seen, at 0 once nothing runs
+        MetricsStore._inc(state, metric, labels, 0)
+
+    @staticmethod
+    def _finish(state, uuid):
+        """Stop counting a job as running, return whether it was"""
+        return state.setdefault('running', {}).pop(uuid, None) is not None
+
+    def build_started(self, diskimage, uuid):
+        def update(state):
+            self._start(state, uuid, 'dib2cloud_running_builds',
+                        {'diskimage': diskimage})
+        self._update(update)
+
+    def build_finished(self, diskimage, status, duration, output_bytes,
+                       uuid):
+        def update(state):
+            # Whoever finishes the build first counts it
+            if not self._finish(state, uuid):
+                return
+            self._inc(state, 'dib2cloud_builds_total',
+                      {'diskimage': diskimage, 'status': status})
+            self._observe(state, 'dib2cloud_build_duration_seconds',
+                          {'diskimage': diskimage}, duration,
+                          DURATION_BUCKETS)
+            self._inc(state, 'dib2cloud_images_dir_bytes', {},
+                      output_bytes)
+        self._update(update)
+
+    def build_deleted(self, output_bytes):
+        def update(state):
+            self._inc(state, 'dib2cloud_images_dir_bytes', {},
+                      -output_bytes)
+        self._update(update)
+
+    def upload_started(self, diskimage, provider, uuid):
+        def update(state):
+            self._start(state, uuid, 'dib2cloud_running_uploads',
+                        {'diskimage': diskimage, 'provider': provider})
+        self._update(update)
+
+    def upload_progress(self, diskimage, provider, bytes_sent):
+        def update(state):
+            self._inc(state, 'dib2cloud_upload_bytes_sent_total',
+                      {'diskimage': diskimage, 'provider': provider},
+                      bytes_sent)
+        self._update(update)
+
+    def upload_finished(self, diskimage, provider, status, duration,
+                        bytes_per_second, uuid):
+        def update(state):
+            if not self._finish(state, uuid):
+                return
+            labels = {'diskimage': diskimage, 'provider': provider}
+            self._inc(state, 'dib2cloud_uploads_total',
+                      dict(labels, status=status))
+            self._observe(state, 'dib2cloud_upload_duration_seconds',
+                          labels, duration, DURATION_BUCKETS)
+            self._observe(state, 'dib2cloud_upload_bytes_per_second',
+                          labels, bytes_per_second, THROUGHPUT_BUCKETS)
+        self._update(update)
+
+    @staticmethod
+    def _running(state):
+        counts = {}
+        for metric in ('dib2cloud_running_builds',
+                       'dib2cloud_running_uploads'):
+            counts[metric] = dict.fromkeys(state.get(metric, {}), 0)
+        for job in state.get('running', {}).values():
+            if process.pid_alive(job['pid']):
+                MetricsStore._inc(counts, job['metric'], job['labels'])
+        return counts
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        state = util.read_locked_json(self.path)
+        running = self._running(state)
+        lines = []
+        for metric in sorted(METRICS):
+            metric_type, help_text = METRICS[metric]
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s %s' % (metric, metric_type))
+            values = state.get(metric, {})
+            if metric in running:
+                values = running[metric]
+            if not values and metric_type == 'gauge':
+                lines.append('%s 0.0' % metric)
+            for key in sorted(values):
+                labels = json.loads(key)
+                value = values[key]
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (metric, _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+                bounds = value['buckets'] + [float('inf')]
+                counts = value['counts'] + [value['count']]
+                for bound, count in zip(bounds, counts):
+                    lines.append('%s_bucket%s %s' % (
+                        metric,
+                        _format_labels(labels, ('le', _format_value(bound))),
+                        _format_value(count)))
+                lines.append('%s_sum%s %s' % (metric, _format_labels(labels),
+                                              _format_value(value['sum'])))
+                lines.append('%s_count%s %s' % (
+                    metric, _format_labels(labels),
+                    _format_value(value['count'])))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Write then rename so node_exporter never reads a partial file
+        dest_dir = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.dib2cloud-')
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def make_server(store, host, port):
+    class MetricsHandler(http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = store.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return http_server.HTTPServer((host, port), MetricsHandler)
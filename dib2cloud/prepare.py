@@ -0,0 +1,127 @@
+import os
+import shutil
+import subprocess
+import time
+
+from dib2cloud import compression
+from dib2cloud import process
+
+
+# How many past uploads and preparations estimates are made from
+HISTORY = 5
+
+
+class PrepareError(Exception):
+    pass
+
+
+def prepared_path(raw_path):
+    return '%s.prepared' % raw_path
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[len(values) // 2]
+
+
+def estimate(uploads, provider_name):
+    """Estimate link and preparation speeds from earlier uploads
+
+    Returns the provider's upload rate in bytes a second, the rate images
+    are prepared at in raw bytes a second and the size of a prepared image
+    as a fraction of its raw size. Any of these is None without history.
+    """
+    # Records from before created_at was kept sort as the oldest
+    uploads = sorted(uploads, key=lambda x: x.created_at or 0, reverse=True)
+    link_rates = []
+    prepare_rates = []
+    ratios = []
+    for upload in uploads:
+        if upload.provider_name == provider_name and upload.throughput:
+            link_rates.append(upload.throughput)
+        prepared = upload.prepared or {}
+        # Only preparations which were actually run say what one costs
+        ran = prepared.get('seconds') and not prepared.get('cached')
+        if ran and prepared.get('raw_size'):
+            prepare_rates.append(prepared['raw_size'] / prepared['seconds'])
+            ratios.append(prepared['size'] / float(prepared['raw_size']))
+    return {
+        'link_rate': _median(link_rates[:HISTORY]),
+        'prepare_rate': _median(prepare_rates[:HISTORY]),
+        'ratio': _median(ratios[:HISTORY])
+    }
+
+
+def worthwhile(raw_size, link_rate, prepare_rate, ratio):
+    """Return whether preparing an image and sending it beats sending it
+
+    Without knowing how fast the link is we can't tell, so we don't.
+    """
+    if not link_rate or not raw_size:
+        return False
+    send_time = raw_size / float(link_rate)
+    prepared_time = raw_size / float(prepare_rate)
+    prepared_time += raw_size * ratio / float(link_rate)
+    return prepared_time < send_time
+
+
+def prepare(qemu_img, src, dest, image_format, source_compression=None,
+            log_fh=None):
+    """Write a sparsified, compressed copy of the src image to dest
+
+    qemu-img convert leaves out clusters which are unallocated or zero and
+    compresses those it writes. A compressed build output is decompressed
+    next to dest first as qemu-img needs to seek in its input.
+    """
+    tmp_path = '%s.tmp' % dest
+    raw_copy = None
+    try:
+        if source_compression:
+            raw_copy = '%s.raw' % dest
+            with compression.open_decompressed(src,
+                                               source_compression) as src_fh:
+                with open(raw_copy, 'wb') as dest_fh:
+                    shutil.copyfileobj(src_fh, dest_fh,
+                                       compression.CHUNK_SIZE)
+            src = raw_copy
+        cmd = [qemu_img, 'convert', '-f', image_format, '-O', image_format]
+        if image_format == 'qcow2':
+            cmd.append('-c')
+        with process.default_sigchld():
+            proc = subprocess.Popen(cmd + [src, tmp_path], stdout=log_fh,
+                                    stderr=subprocess.STDOUT)
+            try:
+                returncode = proc.wait()
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+        if returncode:
+            raise PrepareError('%s exited with status %d' %
+                               (qemu_img, returncode))
+        os.rename(tmp_path, dest)
+    finally:
+        for path in (tmp_path, raw_copy):
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+
+def ensure_prepared(settings, src, source_compression=None, log_fh=None):
+    """Prepare src once no matter how many uploads need it at once
+
+    Returns a record of the prepared image, with cached set if it had
+    already been prepared.
+    """
+    dest = settings['path']
+    with process.LockedFile('%s.lock' % dest):
+        if os.path.exists(dest):
+            return {'path': dest, 'size': os.path.getsize(dest),
+                    'cached': True}
+        start_time = time.time()
+        prepare(settings['qemu_img'], src, dest, settings['format'],
+                source_compression, log_fh)
+        return {'path': dest, 'size': os.path.getsize(dest),
+                'raw_size': settings['raw_size'],
+                'seconds': time.time() - start_time, 'cached': False}
@@ -1,8 +1,12 @@
+import contextlib
 import errno
 import fcntl
 import os
+import resource
 import signal
 import subprocess
+import sys
+import tempfile
 import time
 
 import yaml
@@ -22,6 +26,59 @@ def sigchld_handler(signum, frame):
 signal.signal(signal.SIGCHLD, sigchld_handler)
 
 
+@contextlib.contextmanager
+def default_sigchld():
+    # Our SIGCHLD handler reaps any child, which would race with a caller
+    # waiting on a specific pid for its exit status
+    old_handler = signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGCHLD, old_handler)
+
+
+def usage_summary(rusage, wall_time, exit_code=None, since=None):
+    """Summarise a struct_rusage, optionally relative to an earlier one"""
+    ret = {
+        'exit_code': exit_code,
+        'wall_time': wall_time,
+        'user_cpu': None,
+        'system_cpu': None,
+        'max_rss': None,
+        'read_bytes': None,
+        'write_bytes': None
+    }
+    if rusage is not None:
+        ret.update({
+            'user_cpu': rusage.ru_utime,
+            'system_cpu': rusage.ru_stime,
+            # ru_maxrss is in kilobytes, block counts are 512 byte units
+            'max_rss': rusage.ru_maxrss * 1024,
+            'read_bytes': rusage.ru_inblock * 512,
+            'write_bytes': rusage.ru_oublock * 512
+        })
+        if since is not None:
+            ret['user_cpu'] -= since.ru_utime
+            ret['system_cpu'] -= since.ru_stime
+            ret['read_bytes'] -= since.ru_inblock * 512
+            ret['write_bytes'] -= since.ru_oublock * 512
+    return ret
+
+
+class SelfUsage(object):
+    """Measure resources used by the current process from now on"""
+
+    def __init__(self):
+        self._start_time = time.time()
+        self._start_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    def summary(self, exit_code=None):
+        return usage_summary(resource.getrusage(resource.RUSAGE_SELF),
+                             time.time() - self._start_time,
+                             exit_code,
+                             since=self._start_usage)
+
+
 class Process(object):
     def __init__(self, pid=None):
         self.pid = None
@@ -46,45 +103,222 @@ class PythonProcess(Process):
                 return chpid
             else:
                 # We are the child
-                self._func(*self._args, **self._kwargs)
-                # Become the session and group leader
-                os.setsid()
-                # Use _exit so we don't call any atexit registered functions of
-                # our parent. This has the downside of not flushing any stdio
-                # fd's so care must be taken when using things like
-                # multiprocessing.Queue which rely on a separate i/o thread
-                os._exit(0)
+                status = 1
+                try:
+                    # Become the session and group leader
+                    os.setsid()
+                    self._func(*self._args, **self._kwargs)
+                    status = 0
+                finally:
+                    # Use _exit so we don't call any atexit registered
+                    # functions of our parent. This has the downside of not
+                    # flushing any stdio fd's so care must be taken when using
+                    # things like multiprocessing.Queue which rely on a
+                    # separate i/o thread
+                    os._exit(status)
         else:
             self._func(*self._args, **self._kwargs)
 
 
+def spawn(cmd, stdout=None, stderr=None, env=None, setsid=False):
+    """Start cmd and return its pid
+
+    posix_spawn lets libc use vfork-style spawning so the cost of starting a
+    process does not grow with the size of our own heap. We fall back to
+    subprocess where it is not available.
+    """
+    if env is None:
+        env = os.environ
+    if hasattr(os, 'posix_spawnp'):
+        file_actions = []
+        for target_fd, fh in ((1, stdout), (2, stderr)):
+            if fh is not None:
+                file_actions.append((os.POSIX_SPAWN_DUP2, fh.fileno(),
+                                     target_fd))
+        return os.posix_spawnp(cmd[0], cmd, env, file_actions=file_actions,
+                               setsid=setsid)
+    preexec_fn = os.setsid if setsid else None
+    return subprocess.Popen(cmd, stdout=stdout, stderr=stderr, env=env,
+                            preexec_fn=preexec_fn).pid
+
+
 class CmdProcess(Process):
-    def __init__(self, cmd, stdout, stderr):
+    """Run a command, reaping it and recording what it cost if blocking
+
+    track, if given, is called with the command's pid once it is started
+    and with None once it has been reaped.
+    """
+
+    def __init__(self, cmd, stdout, stderr, setsid=False, kill_grace=10,
+                 env=None, track=None):
         super(Process, self).__init__()
         self._cmd = cmd
+        self._track = track
         self._stdout = stdout
         self._stderr = stderr
+        self._setsid = setsid
+        self._env = env
+        self._kill_grace = kill_grace
         self._proc = None
+        self.exit_code = None
+        self.usage = None
+
+    def _spawn(self):
+        return spawn(self._cmd, stdout=self._stdout, stderr=self._stderr,
+                     env=self._env, setsid=self._setsid)
+
+    def _signal(self, pid, signum):
+        try:
+            if self._setsid:
+                # Reach everything the command started as well
+                os.killpg(pid, signum)
+            else:
+                os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _kill(self, pid):
+        # Ask nicely first so the command can run its own cleanup
+        self._signal(pid, signal.SIGTERM)
+        deadline = time.time() + self._kill_grace
+        while time.time() < deadline:
+            wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+            if wpid:
+                return status, rusage
+            time.sleep(.1)
+        self._signal(pid, signal.SIGKILL)
+        return os.wait4(pid, 0)[1:]
 
     def _run(self, blocking=False):
-        self._subproc = subprocess.Popen(self._cmd,
-                                         stdout=self._stdout,
-                                         stderr=self._stderr)
+        if not blocking:
+            return self._spawn()
+
+        with default_sigchld():
+            start_time = time.time()
+            pid = self._spawn()
+            status = None
+            rusage = None
+            try:
+                if self._track is not None:
+                    self._track(pid)
+                _, status, rusage = os.wait4(pid, 0)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+            except BaseException:
+                # We were interrupted, don't leave the command behind
+                try:
+                    status, rusage = self._kill(pid)
+                finally:
+                    self._set_result(status, rusage, start_time)
+                raise
+            finally:
+                if self._track is not None:
+                    self._track(None)
+            self._set_result(status, rusage, start_time)
+        return pid
+
+    def _set_result(self, status, rusage, start_time):
+        if status is not None:
+            if os.WIFSIGNALED(status):
+                self.exit_code = -os.WTERMSIG(status)
+            else:
+                self.exit_code = os.WEXITSTATUS(status)
+        self.usage = usage_summary(rusage, time.time() - start_time,
+                                   self.exit_code)
+
+
+class WorkerProcess(Process):
+    """Run a tracked job in a freshly spawned dib2cloud worker
+
+    The worker is a new interpreter started with posix_spawn rather than a
+    fork of the caller, so it starts with a small heap no matter how large
+    the calling process has grown, and it outlives the caller.
+    """
+
+    def __init__(self, config_path, kind, uuid, log_path):
+        super(Process, self).__init__()
+        self._cmd = [sys.executable, '-m', 'dib2cloud.worker',
+                     config_path, kind, uuid]
+        self._log_path = log_path
+
+    def _run(self, blocking=False):
+        with open(os.devnull, 'w') as devnull:
+            with open(self._log_path, 'a') as log_fh:
+                pid = spawn(self._cmd, stdout=devnull, stderr=log_fh,
+                            setsid=True)
         if blocking:
-            self._subproc.wait()
-        return self._subproc.pid
+            with default_sigchld():
+                try:
+                    os.waitpid(pid, 0)
+                except OSError as e:
+                    if e.errno != errno.ECHILD:
+                        raise
+        return pid
+
+
+def reap(pid):
+    """Collect pid if it is an exited child of ours
+
+    Our SIGCHLD handler only reaps children in our process group, workers
+    run in their own session so a long lived parent has to reap them.
+    """
+    if pid is None:
+        return
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+
+
+def pid_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def wait_exit(pid, timeout):
+    """Wait up to timeout seconds for pid to exit, return whether it did"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                return True
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            # Not our child, or already reaped
+            if not pid_alive(pid):
+                return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(.1)
 
 
 def processfile_for_uuid(pf_dir, uuid):
     return os.path.join(pf_dir, '%s.processfile' % uuid)
 
 
+PROCESSFILE_VERSION = 1
+
+
 class LockedFile(object):
+    """Hold an exclusive lock on path for the duration of a with block
+
+    The file is only used for locking and is never truncated.
+    """
+
     def __init__(self, path):
         self.path = path
 
     def __enter__(self):
-        self.fh = open(self.path, 'w')
+        self.fh = open(self.path, 'a')
         fcntl.lockf(self.fh, fcntl.LOCK_EX)
         return self.fh
 
@@ -93,26 +327,86 @@ class LockedFile(object):
         self.fh.close()
 
 
+def _umask():
+    # There is no way to read the umask without setting it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def write_atomic(path, write_func):
+    """Replace path with what write_func writes, atomically
+
+    Readers either see the old contents or the new ones and never need to
+    take a lock. The file gets the mode open() would have given it, not the
+    0600 of a temporary file.
+    """
+    dest_dir = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=dest_dir, prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+    try:
+        os.fchmod(fd, 0o666 & ~_umask())
+        with os.fdopen(fd, 'w') as fh:
+            write_func(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_record(path):
+    try:
+        fh = open(path, 'r')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    with fh:
+        return yaml.safe_load(fh)
+
+
 class ProcessTracker(object):
+    @staticmethod
+    def _from_record(pt_type, record, **extra_kwargs):
+        record.pop('version', None)
+        generation = record.pop('generation', 0)
+        record.update(extra_kwargs)
+        tracker = pt_type(**record)
+        tracker.generation = generation
+        return tracker
+
     @staticmethod
     def from_processfile(pt_type, pf, **extra_kwargs):
-        with open(pf, 'r') as fh:
-            kwargs = yaml.safe_load(fh)
-            kwargs.update(extra_kwargs)
-            return pt_type(**kwargs)
+        record = load_record(pf)
+        if record is None:
+            raise IOError(errno.ENOENT, 'No such processfile', pf)
+        return ProcessTracker._from_record(pt_type, record, **extra_kwargs)
+
+    @classmethod
+    def iter_all(cls, pt_type, pf_dir, record_filter=None, **extra_kwargs):
+        """Lazily load every tracker in pf_dir
+
+        record_filter is called with the raw processfile contents so records
+        can be skipped before a tracker is built for them.
+        """
+        if not os.path.exists(pf_dir):
+            return
+        for pf in os.listdir(pf_dir):
+            if not pf.endswith('processfile'):
+                continue
+            record = load_record(os.path.join(pf_dir, pf))
+            if record is None:
+                # Deleted since we listed the directory
+                continue
+            if record_filter is not None and not record_filter(record):
+                continue
+            yield cls._from_record(pt_type, record, **extra_kwargs)
 
     @classmethod
     def get_all(cls, pt_type, pf_dir, **extra_kwargs):
-        pts = []
-        if os.path.exists(pf_dir):
-            for pf in os.listdir(pf_dir):
-                if pf.endswith('processfile'):
-                    pts.append(cls.from_processfile(
-                        pt_type,
-                        os.path.join(pf_dir, pf),
-                        **extra_kwargs
-                    ))
-        return pts
+        return list(cls.iter_all(pt_type, pf_dir, **extra_kwargs))
 
     @classmethod
     def from_uuid(cls, pt_type, pf_dir, uuid, **extra_kwargs):
@@ -120,49 +414,102 @@ class ProcessTracker(object):
                                     processfile_for_uuid(pf_dir, uuid),
                                     **extra_kwargs)
 
-    def __init__(self, uuid, pf_dir, pid=None):
+    def __init__(self, uuid, pf_dir, pid=None, created_at=None,
+                 config_path=None):
         self.uuid = uuid
         self.pf_dir = pf_dir
         self.pid = pid
+        self.created_at = created_at
+        self.config_path = config_path
+        self.generation = 0
         self._proc = None
 
     @property
     def processfile(self):
         util.assert_dir(self.pf_dir)
-        return LockedFile(processfile_for_uuid(self.pf_dir, self.uuid))
+        return processfile_for_uuid(self.pf_dir, self.uuid)
 
-    def to_yaml_file(self, dest):
-        with dest as fh:
-            out = {}
-            for attr in self.process_properties + ['uuid', 'pf_dir', 'pid']:
-                out[attr] = getattr(self, attr)
-            yaml.safe_dump(out, fh)
+    @property
+    def processfile_lock(self):
+        return '%s.lock' % self.processfile
+
+    def to_dict(self):
+        out = {}
+        for attr in self.process_properties + ['uuid', 'pf_dir', 'pid',
+                                               'created_at']:
+            out[attr] = getattr(self, attr)
+        return out
+
+    def update_processfile(self, if_generation=None):
+        """Write our state out as the next generation of the processfile
+
+        If if_generation is given the write is skipped, and False returned,
+        when someone else has written the processfile since that generation.
+        """
+        with LockedFile(self.processfile_lock):
+            current = load_record(self.processfile) or {}
+            generation = current.get('generation', 0)
+            if if_generation is not None and generation != if_generation:
+                return False
+            out = self.to_dict()
+            out['version'] = PROCESSFILE_VERSION
+            out['generation'] = generation + 1
+            write_atomic(self.processfile,
+                         lambda fh: yaml.safe_dump(out, fh))
+            self.generation = generation + 1
+        return True
+
+    def remove_processfile(self):
+        for path in (self.processfile, self.processfile_lock):
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
 
-    def update_processfile(self):
-        self.to_yaml_file(self.processfile)
+    @property
+    def worker_log_path(self):
+        return os.path.join(self.pf_dir, '%s.worker.log' % self.uuid)
+
+    def _get_process(self, blocking=False):
+        if blocking or self.config_path is None:
+            return PythonProcess(self._job)
+        return WorkerProcess(self.config_path, self.worker_kind, self.uuid,
+                             self.worker_log_path)
 
     def run(self, blocking=False):
         if self.pid:
             raise RuntimeError('Image build for image uuid %s with name %s has'
                                ' already been run.', self.uuid, self.name)
-        self._proc = self._get_process()
+        if self.created_at is None:
+            self.created_at = time.time()
+        self._proc = self._get_process(blocking)
+        # Workers load their job from the processfile so it has to exist
+        # before they start
+        self.update_processfile()
         self._proc.start(blocking)
         self.pid = self._proc.pid
-        self.to_yaml_file(self.processfile)
-
-    def wait(self, timeout=None):
-        if self._proc is not None:
-            self._proc.wait(timeout)
-        else:
-            while True:
-                if self.is_running():
-                    return True
-                else:
-                    time.sleep(.5)
+        # Don't clobber anything a worker has already recorded
+        self.update_processfile(if_generation=self.generation)
+
+    def run_in_worker(self):
+        self.pid = os.getpid()
+        self.update_processfile()
+        self._job()
+
+    def wait(self):
+        if self.pid is None:
+            return
+        with default_sigchld():
+            try:
+                os.waitpid(self.pid, 0)
+                return
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+        # Not our child, all we can do is poll
+        while self.is_running():
+            time.sleep(.5)
 
     def is_running(self):
-        try:
-            os.kill(self.pid, 0)
-        except OSError:
-            return False
-        return True
+        return pid_alive(self.pid)
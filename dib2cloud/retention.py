@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+
+def _created_at(upload, now):
+    """Return when upload was made, never earlier than it really was
+
+    Records from before created_at was kept go by when their processfile
+    was last written, so they are never taken for older than they are.
+    """
+    if upload.created_at is not None:
+        return upload.created_at
+    try:
+        return os.path.getmtime(upload.processfile)
+    except OSError:
+        return now
+
+
+def select(uploads, policy, in_use=(), now=None):
+    """Return (upload, reason) for every upload the policy doesn't keep
+
+    uploads are the completed uploads of one diskimage to one provider. The
+    newest keep_newest of them are kept, as is any uploaded less than
+    keep_newer_than seconds ago. An upload is only pruned when both allow
+    it, and images in use are never pruned. Without either setting nothing
+    is pruned.
+    """
+    keep_newest = policy.get('keep_newest')
+    keep_newer_than = policy.get('keep_newer_than')
+    if keep_newest is None and keep_newer_than is None:
+        return []
+    if now is None:
+        now = time.time()
+    ret = []
+    by_age = sorted(((_created_at(x, now), x) for x in uploads),
+                    key=lambda x: x[0], reverse=True)
+    for index, (created_at, upload) in enumerate(by_age):
+        if keep_newest is not None and index < keep_newest:
+            continue
+        age = now - created_at
+        if keep_newer_than is not None and age < keep_newer_than:
+            continue
+        if upload.glance_uuid in in_use:
+            continue
+        if keep_newest is not None:
+            reason = 'not one of the newest %d' % keep_newest
+        else:
+            reason = 'older than %d seconds' % keep_newer_than
+        ret.append((upload, reason))
+    return ret
+
+
+def delete_batched(delete, image_ids, batch_size=10, bucket=None):
+    """Call delete for each image id, batch_size at a time in parallel
+
+    bucket paces the deletes, one token per delete. Returns a dict of image
+    id to the error deleting it raised, or None if it was deleted.
+    """
+    results = {}
+
+    def delete_one(image_id):
+        try:
+            delete(image_id)
+            results[image_id] = None
+        except Exception as e:
+            results[image_id] = str(e) or e.__class__.__name__
+
+    for start in range(0, len(image_ids), batch_size):
+        threads = []
+        for image_id in image_ids[start:start + batch_size]:
+            if bucket is not None:
+                bucket.consume(1)
+            thread = threading.Thread(target=delete_one, args=(image_id,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    return results
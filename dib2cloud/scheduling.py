@@ -0,0 +1,69 @@
+import os
+
+from dib2cloud import process
+
+
+IONICE_CLASSES = ('realtime', 'best-effort', 'idle')
+
+
+class SchedulingError(Exception):
+    pass
+
+
+def merge(*settings):
+    ret = {}
+    for setting in settings:
+        ret.update(setting or {})
+    return ret
+
+
+def validate(settings):
+    ionice_class = settings.get('ionice_class')
+    if ionice_class is not None and ionice_class not in IONICE_CLASSES:
+        raise SchedulingError('ionice_class must be one of %s' %
+                              ', '.join(IONICE_CLASSES))
+    nice = settings.get('nice')
+    if nice is not None and not -20 <= int(nice) <= 19:
+        raise SchedulingError('nice must be between -20 and 19')
+
+
+def command_prefix(settings):
+    """Return the command prefix which applies settings to a build
+
+    The prefix tools exec the build command, so every process DIB starts
+    inherits the same priority, affinity and memory policy.
+    """
+    prefix = []
+    if settings.get('numa_node') is not None:
+        node = str(settings['numa_node'])
+        prefix += ['numactl', '--cpunodebind=%s' % node,
+                   '--membind=%s' % node]
+    if settings.get('cpu_affinity'):
+        prefix += ['taskset', '-c', str(settings['cpu_affinity'])]
+    if settings.get('ionice_class') is not None:
+        prefix += ['ionice', '-c', settings['ionice_class']]
+        if settings.get('ionice_level') is not None:
+            prefix += ['-n', str(settings['ionice_level'])]
+    if settings.get('nice') is not None:
+        prefix += ['nice', '-n', str(settings['nice'])]
+    return prefix
+
+
+def pick_cpu_set(cpu_sets, pf_dir, exclude_uuid=None):
+    """Pick the CPU set used by the fewest running builds
+
+    Spreading concurrent builds over disjoint sets keeps them from competing
+    for the same cores and caches.
+    """
+    usage = dict((x, 0) for x in cpu_sets)
+    if os.path.exists(pf_dir):
+        for pf in os.listdir(pf_dir):
+            if not pf.endswith('processfile'):
+                continue
+            record = process.load_record(os.path.join(pf_dir, pf))
+            if record is None or record['uuid'] == exclude_uuid:
+                continue
+            cpu_set = (record.get('scheduling') or {}).get('cpu_affinity')
+            if cpu_set in usage and process.pid_alive(record.get('pid')):
+                usage[cpu_set] += 1
+    return min(cpu_sets, key=lambda x: (usage[x], cpu_sets.index(x)))
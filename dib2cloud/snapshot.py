@@ -0,0 +1,117 @@
+import errno
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from dib2cloud import process
+from dib2cloud import util
+
+
+def fingerprint(elements, env_vars=None, upstream=None, element_hashes=None):
+    """Return a key identifying the root filesystem elements would build
+
+    upstream is the stamp of each upstream artifact the build fetches and
+    element_hashes the tree hash of each of the elements and what they
+    depend on, so a snapshot is never reused once the mirror or the
+    elements' hooks have changed underneath it.
+    """
+    data = json.dumps({'elements': elements, 'env_vars': env_vars or [],
+                       'upstream': upstream or {},
+                       'element_hashes': element_hashes or {}},
+                      sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class SnapshotCache(object):
+    """Compressed root filesystem snapshots, evicted least recently used
+
+    A snapshot is what disk-image-create produces for the stable early
+    elements of a diskimage. Later builds of the diskimage are seeded from it
+    instead of fetching and installing the same base again.
+
+    Builds pin the snapshots they are seeded from until they are done with
+    them, and pinned snapshots are never evicted.
+    """
+
+    def __init__(self, path, max_bytes, env_var='DIB_LOCAL_IMAGE'):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.env_var = env_var
+        self.index_path = os.path.join(path, 'index.json')
+
+    def snapshot_path(self, key):
+        return os.path.join(self.path, '%s.tar.gz' % key)
+
+    def lock(self, key):
+        # Held while a snapshot is looked up or built so concurrent builds of
+        # the same diskimage wait for one snapshot instead of each making one
+        util.assert_dir(self.path)
+        return process.LockedFile(os.path.join(self.path, '%s.lock' % key))
+
+    def get(self, key, user=None):
+        """Return the path of the snapshot for key, or None
+
+        If user is given the snapshot is pinned for them until release.
+        """
+        path = self.snapshot_path(key)
+        with util.locked_json(self.index_path) as index:
+            if key not in index or not os.path.exists(path):
+                index.pop(key, None)
+                return None
+            index[key]['last_used'] = time.time()
+            self._pin(index[key], user)
+        return path
+
+    def add(self, key, tar_path, user=None):
+        """Compress tar_path into the cache and return the snapshot path
+
+        If user is given the snapshot is pinned for them until release.
+        """
+        path = self.snapshot_path(key)
+        tmp_path = '%s.tmp' % path
+        with open(tar_path, 'rb') as src:
+            with open(tmp_path, 'wb') as raw:
+                # Don't record our temporary file name in the header
+                with gzip.GzipFile(filename='', mode='wb',
+                                   fileobj=raw) as dest:
+                    shutil.copyfileobj(src, dest, 1024 * 1024)
+        os.rename(tmp_path, path)
+        with util.locked_json(self.index_path) as index:
+            index[key] = {'size': os.path.getsize(path),
+                          'last_used': time.time()}
+            self._pin(index[key], user)
+            self._evict(index, keep=key)
+        return path
+
+    def release(self, user):
+        """Unpin every snapshot pinned for user"""
+        with util.locked_json(self.index_path) as index:
+            for entry in index.values():
+                entry.get('users', {}).pop(user, None)
+
+    def _pin(self, entry, user):
+        if user is not None:
+            entry.setdefault('users', {})[user] = os.getpid()
+
+    def _pinned(self, entry):
+        # Builds which went away without releasing their pins hold nothing
+        return any(process.pid_alive(x)
+                   for x in entry.get('users', {}).values())
+
+    def _evict(self, index, keep):
+        total = sum(x['size'] for x in index.values())
+        by_age = sorted(index, key=lambda x: index[x]['last_used'])
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            if key == keep or self._pinned(index[key]):
+                continue
+            try:
+                os.unlink(self.snapshot_path(key))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            total -= index.pop(key)['size']
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+
+try:
+    from http import client as http_client
+    from urllib import request as urllib_request
+except ImportError:
+    import httplib as http_client
+    import urllib2 as urllib_request
+
+from dib2cloud import tuning
+
+
+# Seconds to wait on a mirror before counting its artifact as unknown
+UPSTREAM_TIMEOUT = 10
+
+# The diskimage settings which change what a build of it contains
+CONTENT_KEYS = ('elements', 'env_vars')
+
+
+class _HeadRequest(urllib_request.Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+def config_hash(diskimage):
+    """Hash the settings of diskimage which change what its builds contain
+
+    Settings such as timeouts and retention are left out so tuning them
+    doesn't make every image stale.
+    """
+    content = dict((x, diskimage.get(x)) for x in CONTENT_KEYS)
+    content['env_vars'] = tuning.env_dict(content['env_vars'])
+    data = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def find_element(name, elements_path):
+    for path in elements_path:
+        element_dir = os.path.join(path, name)
+        if os.path.isdir(element_dir):
+            return element_dir
+    return None
+
+
+def tree_hash(path):
+    """Hash the names, modes and contents of every file under path"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            rel_path = os.path.relpath(file_path, path)
+            # Hook scripts only run when they are executable
+            executable = os.access(file_path, os.X_OK)
+            digest.update(('%s %s\n' % (rel_path, executable)).encode(
+                'utf-8'))
+            with open(file_path, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _direct_deps(element_dir):
+    deps_path = os.path.join(element_dir, 'element-deps')
+    if not os.path.exists(deps_path):
+        return []
+    with open(deps_path, 'r') as fh:
+        return [x.strip() for x in fh if x.strip()]
+
+
+def element_deps(elements, elements_path):
+    """Return what each of elements, and what they depend on, depends on
+
+    Elements which can't be found depend on nothing we know of.
+    """
+    ret = {}
+    pending = list(elements)
+    while pending:
+        name = pending.pop(0)
+        if name in ret:
+            continue
+        element_dir = find_element(name, elements_path)
+        ret[name] = [] if element_dir is None else _direct_deps(element_dir)
+        pending.extend(ret[name])
+    return ret
+
+
+def with_deps(elements, deps):
+    """Return elements and everything they depend on, going by deps"""
+    ret = set()
+    pending = list(elements)
+    while pending:
+        name = pending.pop(0)
+        if name not in ret:
+            ret.add(name)
+            pending.extend(deps.get(name, []))
+    return sorted(ret)
+
+
+def element_hashes(elements, elements_path):
+    """Return the tree hash of each element and the elements it depends on
+
+    Elements which can't be found, such as those shipped inside
+    diskimage-builder when it is not on elements_path, hash to None.
+    """
+    ret = {}
+    for name in element_deps(elements, elements_path):
+        element_dir = find_element(name, elements_path)
+        ret[name] = None if element_dir is None else tree_hash(element_dir)
+    return ret
+
+
+def upstream_stamp(url, timeout=UPSTREAM_TIMEOUT):
+    """Return when the mirror says url last changed, or None"""
+    try:
+        resp = urllib_request.urlopen(_HeadRequest(url), timeout=timeout)
+    except (IOError, OSError, ValueError, http_client.HTTPException):
+        return None
+    try:
+        headers = resp.info()
+        return headers.get('Last-Modified') or headers.get('ETag')
+    finally:
+        resp.close()
+
+
+def inputs(diskimage, elements_path, artifacts):
+    """Return everything which decides what building diskimage produces"""
+    return {
+        'config': config_hash(diskimage),
+        'elements': element_hashes(diskimage.get('elements'),
+                                   elements_path),
+        'element_deps': element_deps(diskimage.get('elements'),
+                                     elements_path),
+        'upstream': dict((x['url'], upstream_stamp(x['url']))
+                         for x in artifacts)
+    }
+
+
+def stale_reasons(current, last_build, max_age, now):
+    """Return why a diskimage needs rebuilding, empty if it does not
+
+    last_build is the latest successful build of the diskimage. Inputs which
+    could not be determined, either now or when it was built, are not
+    counted as changes so an unreachable mirror doesn't trigger rebuilds.
+    """
+    if last_build is None:
+        return ['never built']
+    recorded = last_build.inputs
+    if not recorded:
+        return ['inputs not recorded']
+    reasons = []
+    if current['config'] != recorded['config']:
+        reasons.append('config changed')
+    for kind, label in (('elements', 'element'), ('upstream', 'upstream')):
+        for key, value in sorted(current[kind].items()):
+            old_value = recorded[kind].get(key)
+            if value is None or old_value is None:
+                if key not in recorded[kind]:
+                    reasons.append('%s %s added' % (label, key))
+                continue
+            if value != old_value:
+                reasons.append('%s %s changed' % (label, key))
+    # The age of builds from before created_at was kept is unknown
+    created_at = last_build.created_at
+    if max_age and created_at is not None and now - created_at > max_age:
+        reasons.append('older than %d seconds' % max_age)
+    return reasons
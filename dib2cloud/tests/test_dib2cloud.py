@@ -19,19 +19,51 @@ test_dib2cloud
 Tests for `dib2cloud` module.
 """
 
+import errno
+import gzip
 from io import BytesIO
 import json
 import multiprocessing
 import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 
 import fixtures
+import requests
 import shutil
+import yaml
 
+from dib2cloud import admission
 from dib2cloud import app
+from dib2cloud import bench
 from dib2cloud import cmd
+from dib2cloud import compression
 from dib2cloud import config
+from dib2cloud import dibcache
+from dib2cloud import failure
+from dib2cloud import fakeglance
+from dib2cloud import glance
+from dib2cloud import farm
+from dib2cloud import metrics
+from dib2cloud import prepare
 from dib2cloud import process
+from dib2cloud import retention
+from dib2cloud import scheduling
+from dib2cloud import snapshot
+from dib2cloud import staleness
+from dib2cloud import throttle
+from dib2cloud import tracing
+from dib2cloud import tuning
+from dib2cloud import uploadqueue
+from dib2cloud import util
+from dib2cloud import watchdog
+from dib2cloud import worker
 from dib2cloud.tests import base
 
 
@@ -80,6 +112,9 @@ class ConfigFixture(ConfigFragmentFixture):
         config_dict['upload_processfile_dir'] = self._make_tempdir()
         config_dict['buildlog_dir'] = self._make_tempdir()
         config_dict['images_dir'] = self._make_tempdir()
+        config_dict['throttle_dir'] = self._make_tempdir()
+        config_dict['metrics_file'] = os.path.join(self._make_tempdir(),
+                                                   'metrics.json')
         self.config = config.Config(**config_dict)
         self.config.to_yaml_file(self.path)
 
@@ -113,6 +148,19 @@ class FakeUpload(BaseFake):
     build_uuid = 'fake-build-uuid'
     upload_name = 'fake-upload-1234'
     glance_uuid = 'glance-uuid-1234'
+    resources = None
+    stopped = None
+    deleted = None
+    uuid = 'fake-upload-uuid'
+    priority = 0
+    deadline = None
+    queue = {'state': 'queued'}
+    progress = None
+    error = None
+    pid = None
+
+    def is_running(self):
+        return process.pid_alive(self.pid)
 
 
 class FakeBuild(BaseFake):
@@ -120,6 +168,10 @@ class FakeBuild(BaseFake):
     uuid = 'fake-uuid'
     log_path = '/some/logfile'
     dest_paths = ['/some/dest']
+    resources = None
+    upload_ids = []
+    admission = None
+    failure = None
 
     def succeeded(self):
         return (False, app.DibError.OutputMissing)
@@ -129,21 +181,39 @@ class FakeBuild(BaseFake):
 
 
 class FakeApp(BaseFake):
-    def build(self, name):
+    def build(self, name, upload_to=None, keep_local=True):
+        FakeApp.build_kwargs = {'upload_to': upload_to,
+                                'keep_local': keep_local}
         return FakeBuild(name)
 
     def get_builds(self):
         return [FakeBuild()]
 
+    build_count = 1
+
+    def iter_builds(self, name=None, since=None):
+        self.iter_kwargs = {'name': name, 'since': since}
+        return iter([FakeBuild() for _ in range(self.build_count)])
+
     def delete_build(self, image_id):
         return FakeBuild()
 
-    def upload(self, build_uuid, provider_name):
+    queue_plan = {}
+
+    def upload(self, build_uuid, provider_name, priority=None,
+               deadline=None):
+        FakeApp.upload_kwargs = {'priority': priority, 'deadline': deadline}
         return FakeUpload()
 
     def get_uploads(self):
         return [FakeUpload()]
 
+    def iter_uploads(self, name=None, cloud=None, since=None):
+        return iter([FakeUpload()])
+
+    def upload_queue_plan(self):
+        return self.queue_plan
+
 
 class TestCmd(base.TestCase):
     def setUp(self):
@@ -163,8 +233,19 @@ class TestCmd(base.TestCase):
             'log': '/some/logfile',
             'name': 'fake_diskimage',
             'pid': None,
+            'resources': None,
+            'uploads': [],
+            'admission': None,
+            'failure': None,
             'status': 'error'}, out)
 
+    def test_build_upload_to(self):
+        cmd.main(['dib2cloud', '--config', 'some_config',
+                  'build', 'test_diskimage', '--upload-to', 'one,two',
+                  '--no-keep-local'])
+        self.assertEqual({'upload_to': ['one', 'two'], 'keep_local': False},
+                         FakeApp.build_kwargs)
+
     def test_list_builds(self):
         cmd.main(['dib2cloud', '--config', 'some_config', 'list-builds'])
         out = json.loads(self.out.getvalue().decode('utf-8'))
@@ -174,8 +255,63 @@ class TestCmd(base.TestCase):
             'log': '/some/logfile',
             'name': 'fake_diskimage',
             'pid': None,
+            'resources': None,
+            'uploads': [],
+            'admission': None,
+            'failure': None,
             'status': 'error'}], out)
 
+    def test_list_builds_limit(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeApp.build_count', 3))
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-builds',
+                  '--limit', '2'])
+        out = json.loads(self.out.getvalue().decode('utf-8'))
+        self.assertEqual(['fake-uuid', 'fake-uuid'], [x['id'] for x in out])
+
+    def test_list_builds_ndjson(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeApp.build_count', 2))
+        lines = []
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.cmd.output',
+                                             lines.append))
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-builds',
+                  '--format', 'ndjson', '--status', 'error'])
+        self.assertEqual(2, len(lines))
+        self.assertEqual('fake-uuid',
+                         json.loads(lines[0].decode('utf-8'))['id'])
+
+    def test_list_builds_status_filter(self):
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-builds',
+                  '--status', 'completed'])
+        out = json.loads(self.out.getvalue().decode('utf-8'))
+        self.assertEqual([], out)
+
+    def test_profile(self):
+        profile_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.tracing._hooks', []))
+        self.useFixture(fixtures.EnvironmentVariable(tracing.TRACE_ENV))
+        self.useFixture(fixtures.EnvironmentVariable(tracing.PROFILE_ENV))
+        cmd.main(['dib2cloud', '--config', 'some_config', '--profile',
+                  profile_dir, 'list-builds'])
+        prefix = 'list-builds-%d' % os.getpid()
+        self.assertEqual(sorted([prefix + '.memory.txt', prefix + '.prof',
+                                 'trace.json']),
+                         sorted(os.listdir(profile_dir)))
+        # Workers started by the command find where to profile themselves
+        self.assertEqual(profile_dir, os.environ[tracing.PROFILE_ENV])
+
+    def test_parse_size(self):
+        self.assertEqual(64 * 1024, cmd.parse_size('64K'))
+        self.assertEqual(2 * 1024 ** 3, cmd.parse_size('2g'))
+        self.assertEqual(100, cmd.parse_size('100'))
+
+    def test_parse_since(self):
+        self.assertAlmostEqual(time.time() - 7200, cmd.parse_since('2h'),
+                               delta=5)
+        self.assertEqual(time.mktime((2016, 5, 1, 0, 0, 0, 0, 0, -1)),
+                         cmd.parse_since('2016-05-01'))
+
     def test_delete_build(self):
         cmd.main(['dib2cloud', '--config', 'some_config',
                   'delete-build', '123'])
@@ -186,6 +322,10 @@ class TestCmd(base.TestCase):
             'log': '/some/logfile',
             'name': 'fake_diskimage',
             'pid': None,
+            'resources': None,
+            'uploads': [],
+            'admission': None,
+            'failure': None,
             'status': 'deleted'}, out)
 
     def test_upload_image(self):
@@ -195,7 +335,10 @@ class TestCmd(base.TestCase):
         self.assertEqual({
             'glance_uuid': 'glance-uuid-1234',
             'upload_name': 'fake-upload-1234',
-            'status': 'completed'
+            'status': 'completed',
+            'resources': None,
+            'progress': None,
+            'error': None
         }, out)
 
     def test_list_uploads(self):
@@ -204,37 +347,127 @@ class TestCmd(base.TestCase):
         self.assertEqual([{
             'glance_uuid': 'glance-uuid-1234',
             'upload_name': 'fake-upload-1234',
-            'status': 'completed'
+            'status': 'completed',
+            'resources': None,
+            'progress': None,
+            'error': None
         }], out)
 
+    def test_list_uploads_sending(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeUpload.glance_uuid', None))
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-uploads'])
+        out = json.loads(self.out.getvalue().decode('utf-8'))
+        self.assertEqual(['uploading'], [x['status'] for x in out])
+
+    def test_list_uploads_worker_died(self):
+        worker = subprocess.Popen(['true'])
+        worker.wait()
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeUpload.glance_uuid', None))
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeUpload.pid', worker.pid))
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-uploads'])
+        out = json.loads(self.out.getvalue().decode('utf-8'))
+        self.assertEqual(['error'], [x['status'] for x in out])
+
+    def test_list_uploads_no_queue(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeUpload.queue',
+            {'state': 'done'}))
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeApp.upload_queue_plan',
+            None))
+        # The queue isn't read when no listed upload is waiting in it
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-uploads'])
+        out = json.loads(self.out.getvalue().decode('utf-8'))
+        self.assertEqual(['completed'], [x['status'] for x in out])
+
+    def test_upload_priority(self):
+        cmd.main(['dib2cloud', '--config', 'some_config', 'upload',
+                  'test_diskimage', 'test_cloud', '--priority', '10',
+                  '--deadline', '2h'])
+        self.assertEqual(10, FakeApp.upload_kwargs['priority'])
+        self.assertAlmostEqual(time.time() + 7200,
+                               FakeApp.upload_kwargs['deadline'], delta=60)
+
+    def test_list_uploads_queued(self):
+        plan = {'fake-upload-uuid': {'position': 2, 'expected_start': 100.0,
+                                     'deadline_at_risk': False}}
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeApp.queue_plan', plan))
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeUpload.glance_uuid', None))
+        cmd.main(['dib2cloud', '--config', 'some_config', 'list-uploads',
+                  '--status', 'queued'])
+        out = json.loads(self.out.getvalue().decode('utf-8'))
+        self.assertEqual([(2, 100.0)], [(x['queue_position'],
+                                         x['expected_start']) for x in out])
+
+
+class FakeResponse(object):
+    def __init__(self, body=None):
+        self._body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._body
+
+
+class FakeSession(object):
+    uploaded = {}
+    versions = [{'id': 'v2.6', 'status': 'CURRENT'},
+                {'id': 'v1.1', 'status': 'SUPPORTED'}]
+
+    def get(self, url):
+        if url.endswith('/images/1234'):
+            return FakeResponse({'id': '1234', 'status': 'active'})
+        return FakeResponse({'versions': FakeSession.versions})
+
+    def post(self, url, json=None):
+        FakeSession.created = json
+        return FakeResponse({'id': '1234'})
+
+    def put(self, url, data=None, headers=None):
+        FakeSession.uploaded[url] = b''.join(data)
+        return FakeResponse()
+
 
 class FakeImage(object):
     id = '1234'
 
 
 class FakeOpenstackCloud(object):
+    endpoint = 'http://image.example.com'
+
     def __init__(self, cloud=None):
         self.cloud = cloud
+        self.keystone_session = FakeSession()
 
     def create_image(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
         return FakeImage()
 
+    def get_session_endpoint(self, service_key):
+        return FakeOpenstackCloud.endpoint
+
 
 class AppTestCase(base.TestCase):
     def setUp(self):
         super(AppTestCase, self).setUp()
 
-        class FakePopen(object):
-            pid = 123
-
-            def wait(self):
-                pass
+        self.spawn_cmd = None
+        FakeSession.uploaded = {}
 
-        self.popen_cmd = None
+        self.image_data = b''
+        self.log_output = ''
+        self.spawn_cmds = []
 
-        def mock_popen(cmd, stderr, stdout):
+        def mock_spawn(cmd, stdout=None, stderr=None, env=None,
+                       setsid=False):
             destnext = False
             dest = None
             typenext = False
@@ -250,25 +483,103 @@ class AppTestCase(base.TestCase):
                     destnext = True
                 elif arg == '-t':
                     typenext = True
-            if dest:
+            if stdout is not None:
+                stdout.write(self.log_output)
+                stdout.flush()
+            if dest and self.image_data is not None:
                 type_ = type_ or 'qcow2'
-                open('%s.%s' % (dest, type_), 'w')
-            self.popen_cmd = cmd
-            return FakePopen()
-
-        self.useFixture(fixtures.MonkeyPatch('subprocess.Popen', mock_popen))
+                with open('%s.%s' % (dest, type_), 'wb') as fh:
+                    fh.write(self.image_data)
+            self.spawn_cmd = cmd
+            self.spawn_cmds.append(cmd)
+            self.spawn_env = env
+            return 123
+
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.process.spawn',
+                                             mock_spawn))
         self.useFixture(fixtures.MonkeyPatch('shade.openstack_cloud',
                                              FakeOpenstackCloud))
 
+    def _app(self, **config_values):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        for key, val in config_values.items():
+            config_fxtr.config.set(key, val)
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        return app.App(config_path=config_fxtr.path)
+
+    def _write_old_upload(self, d2c, build, glance_uuid):
+        """Write an upload processfile as releases before created_at did"""
+        pf_dir = d2c.config.get('upload_processfile_dir')
+        util.assert_dir(pf_dir)
+        uuid = app.gen_uuid()
+        with open(process.processfile_for_uuid(pf_dir, uuid), 'w') as fh:
+            yaml.safe_dump({
+                'build_uuid': build.uuid,
+                'build_name': build.name,
+                'image_format': 'qcow2',
+                'image_path': build.dest_path_for_format('qcow2'),
+                'cloud_name': 'dib2cloud_test',
+                'glance_uuid': glance_uuid,
+                'uuid': uuid,
+                'pf_dir': pf_dir,
+                'pid': None
+            }, fh)
+        return uuid
+
 
 class TestApp(AppTestCase):
     def test_build_simple(self):
         config_path = self.useFixture(ConfigFixture('simple')).path
         d2c = app.App(config_path=config_path)
-        dib = d2c.build('test_diskimage')
+        dib = d2c.build('test_diskimage', blocking=True)
         self.assertEqual(['disk-image-create', '-t', 'qcow2', '-o',
                           dib.dest_path, 'element1', 'element2'],
-                         self.popen_cmd)
+                         self.spawn_cmd)
+
+    def test_build_nonblocking_spawns_worker(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        dib = d2c.build('test_diskimage')
+        self.assertEqual([sys.executable, '-m', 'dib2cloud.worker',
+                          os.path.abspath(config_path), 'build', dib.uuid],
+                         self.spawn_cmd)
+        self.assertEqual(123, d2c.get_builds()[0].pid)
+
+    def test_run_job_in_worker(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True)
+        upload = app.Upload(d2c.config.get('upload_processfile_dir'),
+                            d2c.config.get('build_processfile_dir'),
+                            app.gen_uuid(), build.uuid, 'qcow2',
+                            'dib2cloud_test', build.name,
+                            build.dest_path_for_format('qcow2'))
+        upload.update_processfile()
+        worker.main(['worker', config_path, 'upload', upload.uuid])
+        cmp_upload = d2c.get_upload(upload.uuid)
+        self.assertEqual('1234', cmp_upload.glance_uuid)
+        self.assertEqual(os.getpid(), cmp_upload.pid)
+
+    def test_build_upload_to(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True,
+                          upload_to=['test_provider'])
+        self.assertEqual(1, len(build.upload_ids))
+        upload = d2c.get_upload(build.upload_ids[0])
+        self.assertEqual('1234', upload.glance_uuid)
+        self.assertEqual(build.uuid, upload.build_uuid)
+        self.assertTrue(all(map(os.path.exists, build.dest_paths)))
+
+    def test_build_upload_to_without_local_copy(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True,
+                          upload_to=['test_provider'], keep_local=False)
+        self.assertFalse(any(map(os.path.exists, build.dest_paths)))
+        loaded = d2c.get_builds()[0]
+        self.assertTrue(loaded.outputs_removed)
+        self.assertEqual((True, None), loaded.succeeded())
 
     def test_get_builds_empty(self):
         config_path = self.useFixture(ConfigFixture('simple')).path
@@ -278,7 +589,7 @@ class TestApp(AppTestCase):
     def test_get_builds_simple_missing_output(self):
         config_path = self.useFixture(ConfigFixture('simple')).path
         d2c = app.App(config_path=config_path)
-        dib = d2c.build('test_diskimage')
+        dib = d2c.build('test_diskimage', blocking=True)
         for path in dib.dest_paths:
             os.unlink(path)
         dibs = d2c.get_builds()
@@ -289,15 +600,37 @@ class TestApp(AppTestCase):
     def test_get_builds_simple(self):
         config_path = self.useFixture(ConfigFixture('simple')).path
         d2c = app.App(config_path=config_path)
-        d2c.build('test_diskimage')
+        d2c.build('test_diskimage', blocking=True)
         dibs = d2c.get_builds()
         self.assertEqual(1, len(dibs))
         self.assertEqual((True, None), dibs[0].succeeded())
 
+    def test_iter_builds_filters(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual([build.uuid],
+                         [x.uuid for x in d2c.iter_builds(
+                             name='test_diskimage',
+                             since=build.created_at)])
+        self.assertEqual([], list(d2c.iter_builds(name='other')))
+        self.assertEqual([], list(d2c.iter_builds(
+            since=build.created_at + 60)))
+
+    def test_get_builds_failed_exit_status(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True)
+        build.resources = process.usage_summary(None, 1.0, 1)
+        build.update_processfile()
+        dibs = d2c.get_builds()
+        self.assertEqual((False, app.DibError.ExitStatus),
+                         dibs[0].succeeded())
+
     def test_delete_build_simple(self):
         config_path = self.useFixture(ConfigFixture('simple')).path
         d2c = app.App(config_path=config_path)
-        build = d2c.build('test_diskimage')
+        build = d2c.build('test_diskimage', blocking=True)
         self.assertEqual(True, all(map(os.path.exists, build.dest_paths)))
 
         del_build = d2c.delete_build('%s' % build.uuid)
@@ -307,14 +640,1424 @@ class TestApp(AppTestCase):
         dibs = d2c.get_builds()
         self.assertEqual(0, len(dibs))
 
+    def test_cancel_build(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True)
+        # Stand in for the worker running the build, still in DIB
+        sleeper = subprocess.Popen(['sleep', '30'])
+        build.pid = sleeper.pid
+        build.resources = None
+        build.update_processfile()
+
+        d2c.metrics.build_started(build.name, build.uuid)
+
+        cancelled = d2c.cancel(build.uuid)
+        self.assertFalse(process.pid_alive(sleeper.pid))
+        self.assertEqual('cancelled', cancelled.stopped['state'])
+        # The killed worker never finished up, so cancel did
+        self.assertIsNotNone(cancelled.resources['wall_time'])
+        text = d2c.metrics.render()
+        self.assertIn('dib2cloud_running_builds{diskimage="test_diskimage"} '
+                      '0.0', text)
+        self.assertIn('dib2cloud_builds_total{diskimage="test_diskimage",'
+                      'status="error"} 1.0', text)
+        self.assertEqual(False, any(map(os.path.exists, build.dest_paths)))
+        self.assertEqual('cancelled', cmd.dib_summary_dict(
+            d2c.get_job(build.uuid))['status'])
+
+    def test_cancel_kills_dib_session(self):
+        d2c = self._app(kill_grace_seconds=0.2)
+        build = d2c.build('test_diskimage', blocking=True)
+        # A worker which is hung and DIB in the session of its own it runs in
+        worker = subprocess.Popen(['sh', '-c', 'trap "" TERM; sleep 30'],
+                                  preexec_fn=os.setsid)
+        dib = subprocess.Popen(['sleep', '30'], preexec_fn=os.setsid)
+        self.addCleanup(dib.wait)
+        self.addCleanup(worker.wait)
+        # Let the shell install its trap
+        time.sleep(.5)
+        build.pid = worker.pid
+        build.dib_pgid = dib.pid
+        build.resources = None
+        build.update_processfile()
+
+        d2c.cancel(build.uuid)
+        process.wait_exit(dib.pid, 5)
+        self.assertFalse(process.pid_alive(worker.pid))
+        self.assertFalse(process.pid_alive(dib.pid))
+
+    def test_cancel_leaves_built_build(self):
+        d2c = self._app()
+        build = d2c.build('test_diskimage', blocking=True)
+        # Stand in for the worker, now running the build's uploads
+        sleeper = subprocess.Popen(['sleep', '30'])
+        self.addCleanup(sleeper.wait)
+        self.addCleanup(sleeper.kill)
+        build.pid = sleeper.pid
+        build.update_processfile()
+
+        self.assertRaises(ValueError, d2c.cancel, build.uuid)
+        self.assertTrue(process.pid_alive(sleeper.pid))
+        self.assertTrue(all(map(os.path.exists, build.dest_paths)))
+
+    def test_cancel_requires_running_job(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertRaises(ValueError, d2c.cancel, build.uuid)
+        self.assertRaises(ValueError, d2c.cancel, 'missing')
+
     def test_upload_simple(self):
         config_path = self.useFixture(ConfigFixture('simple')).path
         d2c = app.App(config_path=config_path)
-        build = d2c.build('test_diskimage')
+        build = d2c.build('test_diskimage', blocking=True)
         upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
         cmp_upload = d2c.get_upload(upload.uuid)
         self.assertEqual(upload.uuid, cmp_upload.uuid)
         self.assertEqual('1234', cmp_upload.glance_uuid)
+        self.assertIsNotNone(cmp_upload.throughput)
+        self.assertIsNotNone(cmp_upload.resources['wall_time'])
+
+    def test_upload_with_old_records(self):
+        d2c = self._app()
+        build = d2c.build('test_diskimage', blocking=True)
+        for glance_uuid in ('old-1', 'old-2'):
+            self._write_old_upload(d2c, build, glance_uuid)
+        upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual('1234', upload.glance_uuid)
+
+    def test_upload_sends_image_data(self):
+        d2c = self._app(upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        with open(build.dest_path_for_format('qcow2'), 'wb') as fh:
+            fh.write(b'image data')
+        d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual(
+            b'image data',
+            FakeSession.uploaded['http://image.example.com/v2/images/1234/'
+                                 'file'])
+
+    def test_upload_through_shade(self):
+        d2c = self._app()
+        build = d2c.build('test_diskimage', blocking=True)
+        upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual((upload.upload_name,), upload._cloud.args)
+        self.assertEqual({'filename': build.dest_path_for_format('qcow2'),
+                          'disk_format': 'qcow2',
+                          'container_format': 'bare',
+                          'wait': True}, upload._cloud.kwargs)
+        self.assertEqual({}, FakeSession.uploaded)
+        self.assertEqual('1234', d2c.get_upload(upload.uuid).glance_uuid)
+
+    def test_stream_needs_glance_v2(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeSession.versions',
+            [{'id': 'v1.1', 'status': 'CURRENT'}]))
+        d2c = self._app(upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertRaises(glance.GlanceError, d2c.upload, build.uuid,
+                          'test_provider', blocking=True)
+        self.assertEqual({}, FakeSession.uploaded)
+        self.assertEqual(1, glance.ImageService(
+            FakeSession(), 'http://image.example.com/v1/').version)
+
+    def test_stream_waits_for_active(self):
+        def get(session, url):
+            return FakeResponse({'id': '1234', 'status': 'killed'})
+        d2c = self._app(upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        # Known to be v2 without asking
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeOpenstackCloud.endpoint',
+            'http://image.example.com/v2'))
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeSession.get', get))
+        self.assertRaises(glance.GlanceError, d2c.upload, build.uuid,
+                          'test_provider', blocking=True)
+        upload = list(d2c.iter_uploads())[0]
+        self.assertIsNone(upload.glance_uuid)
+        self.assertEqual('GlanceError', upload.error['type'])
+
+    def test_upload_bandwidth_buckets(self):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        config_fxtr.config.set('bandwidth_limit', 1000)
+        config_fxtr.config.get('providers').get_one(
+            'name', 'test_provider').set('bandwidth_limit', 500)
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        d2c = app.App(config_path=config_fxtr.path)
+        build = d2c.build('test_diskimage', blocking=True)
+        upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual('dib2cloud_test', upload.cloud_name)
+        self.assertEqual([1000, 500],
+                         [x['limit'] for x in upload.bandwidth_buckets])
+
+    def test_upload_progress(self):
+        self.image_data = b'x' * 4096
+        d2c = self._app(upload_chunk_size=1024, upload_progress_interval=0,
+                        upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        progress = d2c.get_upload(upload.uuid).progress
+        self.assertEqual((4096, 4096, 100.0, 0),
+                         (progress['bytes_sent'], progress['total_bytes'],
+                          progress['percent'], progress['eta']))
+        self.assertIsNotNone(progress['average_rate'])
+        self.assertIn('dib2cloud_upload_bytes_sent_total{diskimage='
+                      '"test_diskimage",provider="test_provider"} 4096.0',
+                      d2c.metrics.render())
+
+    def test_upload_error(self):
+        def put(session, url, data=None, headers=None):
+            next(iter(data))
+            raise IOError('Connection reset by peer')
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.tests.test_dib2cloud.FakeSession.put', put))
+        self.image_data = b'x' * 4096
+        d2c = self._app(upload_chunk_size=1024, upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertRaises(IOError, d2c.upload, build.uuid, 'test_provider',
+                          blocking=True)
+        upload = list(d2c.iter_uploads())[0]
+        summary = cmd.upload_summary_dict(upload)
+        self.assertEqual('error', summary['status'])
+        self.assertEqual('Connection reset by peer',
+                         summary['error']['message'])
+        self.assertEqual(1024, summary['progress']['bytes_sent'])
+
+
+class TestMeminfo(base.TestCase):
+    def test_read_meminfo(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'meminfo')
+        with open(path, 'w') as fh:
+            fh.write('MemTotal:       16318480 kB\n'
+                     'MemAvailable:    8000000 kB\n'
+                     'HugePages_Total:       0\n')
+        meminfo = admission.read_meminfo(path)
+        self.assertEqual(8000000 * 1024, meminfo['MemAvailable'])
+        self.assertEqual(0, meminfo['HugePages_Total'])
+
+
+class TestAdmission(AppTestCase):
+    def setUp(self):
+        super(TestAdmission, self).setUp()
+        self.memory = 8 * 1024 ** 3
+        self.disk = 100 * 1024 ** 3
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.admission.read_meminfo',
+            lambda: {'MemAvailable': self.memory}))
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.admission.free_bytes', lambda path: self.disk))
+
+    def test_admitted(self):
+        d2c = self._app(admission_policy='reject')
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual('admitted', build.admission['state'])
+        self.assertEqual((True, None), d2c.get_builds()[0].succeeded())
+
+    def test_rejected_when_memory_short(self):
+        self.memory = 1024 ** 3
+        d2c = self._app(admission_policy='reject')
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertIsNone(self.spawn_cmd)
+        self.assertEqual('rejected', build.admission['state'])
+        self.assertIn('Not enough memory', build.admission['reason'])
+        out = cmd.dib_summary_dict(d2c.get_builds()[0])
+        self.assertEqual('rejected', out['status'])
+
+    def test_held_until_capacity(self):
+        self.disk = 0
+        d2c = self._app(admission_policy='hold')
+        states = []
+
+        def fake_sleep(seconds):
+            record = d2c.get_builds()[0]
+            states.append(record.admission['state'])
+            self.disk = 100 * 1024 ** 3
+
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', fake_sleep))
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(['held'], states)
+        self.assertEqual('admitted', build.admission['state'])
+        self.assertIsNotNone(self.spawn_cmd)
+
+    def test_estimate_uses_history(self):
+        d2c = self._app(admission_policy='reject')
+        build = d2c.build('test_diskimage', blocking=True)
+        build.resources = process.usage_summary(None, 1.0, 0)
+        build.resources['max_rss'] = 3 * 1024 ** 3
+        build.output_bytes = 7 * 1024 ** 3
+        build.update_processfile()
+        self.assertEqual({'memory': 3 * 1024 ** 3, 'disk': 7 * 1024 ** 3},
+                         d2c.admission.estimate('test_diskimage'))
+        self.assertEqual({'memory': 2 * 1024 ** 3, 'disk': 5 * 1024 ** 3},
+                         d2c.admission.estimate('other'))
+
+
+class TestDedup(AppTestCase):
+    def test_dedup_at_completion(self):
+        d2c = self._app(dedup_mode='hardlink')
+        self.image_data = b'x' * 4096
+        first = d2c.build('test_diskimage', blocking=True)
+        second = d2c.build('test_diskimage', blocking=True)
+        self.image_data = b'y' * 4096
+        third = d2c.build('test_diskimage', blocking=True)
+
+        self.assertEqual(0, first.saved_bytes)
+        self.assertEqual('hardlink', second.dedup['qcow2']['method'])
+        self.assertEqual(4096, second.saved_bytes)
+        self.assertTrue(os.path.samefile(first.dest_paths[0],
+                                         second.dest_paths[0]))
+        self.assertIsNone(third.dedup['qcow2']['method'])
+
+        # Deleting the first copy leaves the second to link against
+        d2c.delete_build(first.uuid)
+        self.image_data = b'x' * 4096
+        fourth = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(second.dest_paths[0],
+                         fourth.dedup['qcow2']['source'])
+
+    def test_dedup_command(self):
+        d2c = self._app()
+        self.image_data = b'x' * 4096
+        builds = [d2c.build('test_diskimage', blocking=True)
+                  for _ in range(3)]
+        self.assertIsNone(builds[0].dedup)
+        self.assertEqual({'deduplicated': 3, 'saved_bytes': 8192},
+                         d2c.dedup())
+        self.assertEqual({'deduplicated': 0, 'saved_bytes': 8192},
+                         d2c.dedup())
+        for build in builds:
+            with open(build.dest_paths[0], 'rb') as fh:
+                self.assertEqual(self.image_data, fh.read())
+
+
+class TestSnapshot(AppTestCase):
+    def _snapshot_app(self, cache_size=10 ** 6):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        self.snapshot_dir = self.useFixture(fixtures.TempDir()).path
+        config_fxtr.config.set('snapshot_dir', self.snapshot_dir)
+        config_fxtr.config.set('snapshot_cache_size', cache_size)
+        config_fxtr.config.get('diskimages').get_one(
+            'name', 'test_diskimage').set('base_elements', ['element1'])
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        return app.App(config_path=config_fxtr.path)
+
+    def test_seed_from_snapshot(self):
+        d2c = self._snapshot_app()
+        self.image_data = b'root filesystem'
+        first = d2c.build('test_diskimage', blocking=True)
+        self.assertFalse(first.snapshot['hit'])
+        self.assertEqual(['disk-image-create', '-t', 'tar', '-o',
+                          os.path.join(first.dest_dir,
+                                       '%s.snapshot' % first.uuid),
+                          'element1'], self.spawn_cmds[0])
+        self.assertEqual(first.dib_cmd, self.spawn_cmds[1])
+        self.assertEqual(first.snapshot['path'],
+                         self.spawn_env['DIB_LOCAL_IMAGE'])
+        with gzip.open(first.snapshot['path'], 'rb') as fh:
+            self.assertEqual(b'root filesystem', fh.read())
+        self.assertFalse(os.path.exists(os.path.join(
+            first.dest_dir, '%s.snapshot.tar' % first.uuid)))
+        self.assertEqual((True, None), first.succeeded())
+
+        self.spawn_cmds = []
+        second = d2c.build('test_diskimage', blocking=True)
+        self.assertTrue(second.snapshot['hit'])
+        self.assertEqual([second.dib_cmd], self.spawn_cmds)
+        self.assertEqual(first.snapshot['path'],
+                         self.spawn_env['DIB_LOCAL_IMAGE'])
+
+    def test_lru_eviction(self):
+        cache = snapshot.SnapshotCache(
+            self.useFixture(fixtures.TempDir()).path, 0)
+        tar_path = os.path.join(cache.path, 'root.tar')
+        with open(tar_path, 'wb') as fh:
+            fh.write(os.urandom(1024))
+        # Room for two snapshots
+        cache.max_bytes = 2 * os.path.getsize(cache.add('old', tar_path))
+        cache.add('used', tar_path)
+        self.assertIsNotNone(cache.get('old'))
+        # 'used' is now the least recently used and has to go to make room
+        cache.add('new', tar_path)
+        self.assertIsNotNone(cache.get('old'))
+        self.assertIsNone(cache.get('used'))
+        self.assertFalse(os.path.exists(cache.snapshot_path('used')))
+        self.assertIsNotNone(cache.get('new'))
+
+    def test_pinned_not_evicted(self):
+        cache = snapshot.SnapshotCache(
+            self.useFixture(fixtures.TempDir()).path, 0)
+        tar_path = os.path.join(cache.path, 'root.tar')
+        with open(tar_path, 'wb') as fh:
+            fh.write(os.urandom(1024))
+        # Room for one snapshot
+        cache.max_bytes = os.path.getsize(cache.add('seed', tar_path,
+                                                    'build-uuid'))
+        cache.add('new', tar_path)
+        self.assertTrue(os.path.exists(cache.snapshot_path('seed')))
+        cache.release('build-uuid')
+        cache.add('newer', tar_path)
+        self.assertFalse(os.path.exists(cache.snapshot_path('seed')))
+
+    def test_upstream_change_misses(self):
+        d2c = self._snapshot_app()
+        base_image = os.path.join(self.snapshot_dir, 'base.img')
+        with open(base_image, 'w') as fh:
+            fh.write('base')
+        d2c.config.set('cache_artifacts', [{'url': 'file://%s' % base_image}])
+        first = d2c.build('test_diskimage', blocking=True)
+        self.assertFalse(first.snapshot['hit'])
+        # Released once the build was done with it
+        index = util.read_locked_json(d2c.snapshot_cache.index_path)
+        self.assertEqual({}, index[first.snapshot['key']]['users'])
+
+        old = time.time() - 3600
+        os.utime(base_image, (old, old))
+        second = d2c.build('test_diskimage', blocking=True)
+        self.assertFalse(second.snapshot['hit'])
+        self.assertNotEqual(first.snapshot['key'], second.snapshot['key'])
+
+    def test_element_change_misses(self):
+        d2c = self._snapshot_app()
+        elements = self.useFixture(fixtures.TempDir()).path
+        for name in ('element1', 'element2', 'dep1'):
+            os.makedirs(os.path.join(elements, name, 'install.d'))
+            self._write_hook(elements, name, name)
+        with open(os.path.join(elements, 'element1', 'element-deps'),
+                  'w') as fh:
+            fh.write('dep1\n')
+        d2c.config.set('elements_path', [elements])
+        first = d2c.build('test_diskimage', blocking=True)
+        # element2 is not in the snapshot's layer
+        self._write_hook(elements, 'element2', 'changed')
+        second = d2c.build('test_diskimage', blocking=True)
+        self.assertTrue(second.snapshot['hit'])
+        # but what element1 depends on is
+        self._write_hook(elements, 'dep1', 'changed')
+        third = d2c.build('test_diskimage', blocking=True)
+        self.assertFalse(third.snapshot['hit'])
+        self.assertNotEqual(first.snapshot['key'], third.snapshot['key'])
+
+    def _write_hook(self, elements, name, contents):
+        with open(os.path.join(elements, name, 'install.d', '50-hook'),
+                  'w') as fh:
+            fh.write(contents)
+
+
+class TestDibCache(AppTestCase):
+    def setUp(self):
+        super(TestDibCache, self).setUp()
+        self.mirror = self.useFixture(fixtures.TempDir()).path
+        for name in ('base.img', 'packages.idx'):
+            with open(os.path.join(self.mirror, name), 'w') as fh:
+                fh.write(name)
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+
+    def _url(self, name):
+        return 'file://%s/%s' % (self.mirror, name)
+
+    def _cache_app(self):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        config_fxtr.config.set('dib_cache_dir', self.cache_dir)
+        config_fxtr.config.set('cache_artifacts',
+                               [{'url': self._url('base.img')}])
+        config_fxtr.config.get('diskimages').get_one(
+            'name', 'test_diskimage').set('cache_artifacts', [
+                {'url': self._url('packages.idx'),
+                 'path': 'indexes/packages.idx'}])
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        return app.App(config_path=config_fxtr.path)
+
+    def test_warm_cache(self):
+        d2c = self._cache_app()
+        self.assertEqual([
+            {'url': self._url('base.img'),
+             'path': os.path.join(self.cache_dir, 'base.img'),
+             'fetched': True},
+            {'url': self._url('packages.idx'),
+             'path': os.path.join(self.cache_dir, 'indexes/packages.idx'),
+             'fetched': True}], d2c.warm_cache())
+        with open(os.path.join(self.cache_dir, 'base.img')) as fh:
+            self.assertEqual('base.img', fh.read())
+
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(self.cache_dir, self.spawn_env['DIB_IMAGE_CACHE'])
+        self.assertEqual([False, False],
+                         [x['fetched'] for x in build.cache_fetches])
+
+    def test_stale_artifact_refetched(self):
+        cache = dibcache.DibCache(self.cache_dir, max_age=60)
+        artifact = {'url': self._url('base.img')}
+        self.assertTrue(cache.fetch(artifact))
+        self.assertFalse(cache.fetch(artifact))
+        old = time.time() - 120
+        os.utime(cache.artifact_path(artifact), (old, old))
+        self.assertTrue(cache.fetch(artifact))
+
+    def test_one_fetch_for_concurrent_builds(self):
+        real_urlopen = dibcache.urllib_request.urlopen
+
+        def slow_urlopen(url, timeout=None):
+            time.sleep(.2)
+            return real_urlopen(url, timeout=timeout)
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.dibcache.urllib_request.urlopen', slow_urlopen))
+        cache = dibcache.DibCache(self.cache_dir)
+        artifact = {'url': self._url('base.img')}
+        recv, send = multiprocessing.Pipe()
+
+        def fetch():
+            send.send(cache.fetch(artifact))
+
+        for _ in range(4):
+            process.PythonProcess(fetch).start()
+        results = [recv.recv() for _ in range(4)]
+        self.assertEqual(1, results.count(True))
+
+    def test_fetch_timeout(self):
+        timeouts = []
+
+        def urlopen(url, timeout=None):
+            timeouts.append(timeout)
+            raise socket.timeout('timed out')
+
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.dibcache.urllib_request.urlopen', urlopen))
+        d2c = self._app(dib_cache_dir=self.cache_dir, dib_cache_timeout=5)
+        artifact = {'url': self._url('base.img')}
+        self.assertRaises(socket.timeout, d2c.dib_cache.fetch, artifact)
+        self.assertEqual([5], timeouts)
+        self.assertFalse(os.path.exists(d2c.dib_cache.artifact_path(
+            artifact)))
+
+
+class TestCompression(AppTestCase):
+    uploaded_path = 'http://image.example.com/v2/images/1234/file'
+
+    def _build(self, method, accept_compressed=False):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        config_fxtr.config.set('compress_outputs', method)
+        config_fxtr.config.get('providers').get_one(
+            'name', 'test_provider').set('accept_compressed',
+                                         accept_compressed)
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        d2c = app.App(config_path=config_fxtr.path)
+        self.image_data = b'image data' * 10000
+        return d2c, d2c.build('test_diskimage', blocking=True)
+
+    def test_compressed_at_rest(self):
+        d2c, build = self._build('gzip')
+        self.assertEqual('gzip', build.compression)
+        self.assertTrue(build.dest_paths[0].endswith('.qcow2.gz'))
+        self.assertFalse(os.path.exists(build.raw_path_for_format('qcow2')))
+        self.assertTrue(os.path.getsize(build.dest_paths[0]) < 10000)
+        self.assertEqual(len(self.image_data), build.output_bytes)
+        self.assertEqual((True, None), d2c.get_builds()[0].succeeded())
+
+    def test_upload_decompresses(self):
+        d2c, build = self._build('gzip')
+        d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual(self.image_data,
+                         FakeSession.uploaded[self.uploaded_path])
+        self.assertEqual('bare', FakeSession.created['container_format'])
+
+    def test_upload_compressed(self):
+        d2c, build = self._build('gzip', accept_compressed=True)
+        d2c.upload(build.uuid, 'test_provider', blocking=True)
+        with open(build.dest_paths[0], 'rb') as fh:
+            self.assertEqual(fh.read(),
+                             FakeSession.uploaded[self.uploaded_path])
+        self.assertEqual('compressed',
+                         FakeSession.created['container_format'])
+
+    def test_zstd_round_trip(self):
+        if not compression.which('zstd'):
+            self.skipTest('zstd is not installed')
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path, 'img')
+        with open(path, 'wb') as fh:
+            fh.write(b'image data' * 10000)
+        path = compression.compress_in_place(path, 'zstd')
+        with compression.open_decompressed(path, 'zstd') as fh:
+            self.assertEqual(b'image data' * 10000, fh.read())
+
+
+MIRROR_FAILURE_LOG = '''\
+%(time)s | dib-run-parts Running /tmp/%(tmp)s/in_target.d/install.d/50-foo
+%(time)s | + apt-get install -y foo
+%(time)s | E: Failed to fetch http://mirror.example.com/foo_%(version)s.deb \
+404 Not Found
+%(time)s | + cleanup
+'''
+
+
+class TestFailure(AppTestCase):
+    def _failing_build(self, d2c, log_output):
+        self.image_data = None
+        self.log_output = log_output
+        return d2c.build('test_diskimage', blocking=True)
+
+    def test_extract(self):
+        log_path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                'build.log')
+        with open(log_path, 'w') as fh:
+            fh.write('noise\n' * 10000)
+            fh.write(MIRROR_FAILURE_LOG % {'time': '2016-10-19 12:00:01.123',
+                                           'tmp': 'tmp.abc123',
+                                           'version': '1.2.3'})
+        summary = failure.extract(log_path)
+        self.assertEqual('install.d/50-foo', summary['script'])
+        self.assertIn('E: Failed to fetch', summary['error'])
+        self.assertEqual('E: Failed to fetch '
+                         'http://mirror.example.com/foo_<n>.<n>.<n>.deb '
+                         '<n> Not Found', summary['cause'])
+        self.assertEqual(failure.TAIL_LINES, len(summary['tail']))
+
+    def test_group_by_cause(self):
+        d2c = self._app()
+        mirror_builds = [
+            self._failing_build(d2c, MIRROR_FAILURE_LOG % {
+                'time': '2016-10-19 12:0%d:00' % i, 'tmp': 'tmp.%d' % i,
+                'version': '1.%d' % i})
+            for i in range(2)]
+        other = self._failing_build(d2c, 'Something else broke\n')
+        self.assertEqual(mirror_builds[0].failure['fingerprint'],
+                         mirror_builds[1].failure['fingerprint'])
+        self.assertEqual('error', cmd.dib_summary_dict(other)['status'])
+
+        groups = d2c.failure_groups()
+        self.assertEqual([2, 1], [x['count'] for x in groups])
+        self.assertEqual(sorted(x.uuid for x in mirror_builds),
+                         groups[0]['builds'])
+        self.assertEqual('install.d/50-foo', groups[0]['script'])
+        self.assertEqual([other.uuid], groups[1]['builds'])
+
+        d2c.delete_build(other.uuid)
+        self.assertEqual([2], [x['count'] for x in d2c.failure_groups()])
+        self.assertEqual([], d2c.failure_groups(name='other'))
+
+
+class TestStaleness(AppTestCase):
+    def setUp(self):
+        super(TestStaleness, self).setUp()
+        self.elements = self.useFixture(fixtures.TempDir()).path
+        for name in ('element1', 'element2', 'dep1'):
+            os.makedirs(os.path.join(self.elements, name, 'install.d'))
+            self._write_hook(name, name)
+        with open(os.path.join(self.elements, 'element1',
+                               'element-deps'), 'w') as fh:
+            fh.write('dep1\n')
+        mirror = self.useFixture(fixtures.TempDir()).path
+        self.base_image = os.path.join(mirror, 'base.img')
+        with open(self.base_image, 'w') as fh:
+            fh.write('base')
+        self.d2c = self._app(
+            elements_path=[self.elements],
+            cache_artifacts=[{'url': 'file://%s' % self.base_image}])
+
+    def _write_hook(self, name, contents):
+        with open(os.path.join(self.elements, name, 'install.d',
+                               '50-hook'), 'w') as fh:
+            fh.write(contents)
+
+    def test_rebuild_only_stale(self):
+        self.assertEqual([['never built']],
+                         [x['reasons'] for x in self.d2c.stale()])
+        rebuilt = self.d2c.rebuild_stale(blocking=True)
+        self.assertEqual(1, len(self.spawn_cmds))
+        build = self.d2c.get_job(rebuilt[0]['build'])
+        self.assertEqual(['dep1', 'element1', 'element2'],
+                         sorted(build.inputs['elements']))
+
+        self.assertEqual([], self.d2c.rebuild_stale(blocking=True))
+        self.assertEqual(1, len(self.spawn_cmds))
+
+        self._write_hook('dep1', 'changed')
+        old = time.time() - 3600
+        os.utime(self.base_image, (old, old))
+        self.assertEqual([[
+            'element dep1 changed',
+            'upstream file://%s changed' % self.base_image
+        ]], [x['reasons'] for x in self.d2c.stale()])
+
+    def test_max_age(self):
+        build = self.d2c.build('test_diskimage', blocking=True)
+        build.created_at -= 7200
+        build.update_processfile()
+        self.assertEqual([], self.d2c.stale())
+        self.d2c.config.set('rebuild_max_age', 3600)
+        self.assertEqual([['older than 3600 seconds']],
+                         [x['reasons'] for x in self.d2c.stale()])
+
+    def test_old_records(self):
+        for _ in range(2):
+            build = self.d2c.build('test_diskimage', blocking=True)
+            record = process.load_record(build.processfile)
+            del record['created_at']
+            with open(build.processfile, 'w') as fh:
+                yaml.safe_dump(record, fh)
+        # Their age is unknown, so they are not taken for too old either
+        self.d2c.config.set('rebuild_max_age', 3600)
+        self.assertEqual([], self.d2c.stale())
+        self.assertEqual([], self.d2c.rebuild_stale(dry_run=True))
+
+    def test_config_changes(self):
+        self.d2c.build('test_diskimage', blocking=True)
+        diskimage = self.d2c.config.get('diskimages').get_one(
+            'name', 'test_diskimage')
+        diskimage.set('timeout', 3600)
+        diskimage.set('retention', {'keep_newest': 2})
+        self.assertEqual([], self.d2c.stale())
+        diskimage.set('env_vars', ['DIB_RELEASE=noble'])
+        self.assertEqual([['config changed']],
+                         [x['reasons'] for x in self.d2c.stale()])
+
+    def test_unresponsive_mirror(self):
+        # Accepts connections but never answers them
+        mirror = socket.socket()
+        self.addCleanup(mirror.close)
+        mirror.bind(('127.0.0.1', 0))
+        mirror.listen(1)
+        url = 'http://127.0.0.1:%d/base.img' % mirror.getsockname()[1]
+        start = time.time()
+        self.assertIsNone(staleness.upstream_stamp(url, timeout=0.2))
+        self.assertLess(time.time() - start, 5)
+
+    def test_running_builds_cap(self):
+        sleeps = []
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.app.App.running_builds', lambda x: 2 - len(sleeps)))
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', sleeps.append))
+        self.d2c.rebuild_stale(blocking=True)
+        self.assertEqual([app.REBUILD_POLL_INTERVAL], sleeps)
+        self.assertEqual(1, len(self.spawn_cmds))
+
+
+class FakeRecord(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeGlanceCloud(object):
+    endpoint = None
+    servers = []
+
+    def __init__(self, cloud=None):
+        self.cloud = cloud
+        self.keystone_session = requests.Session()
+
+    def get_session_endpoint(self, service_key):
+        return FakeGlanceCloud.endpoint
+
+    def list_servers(self):
+        return FakeGlanceCloud.servers
+
+
+class TestPruneUploads(AppTestCase):
+    def setUp(self):
+        super(TestPruneUploads, self).setUp()
+        self.glance = fakeglance.FakeGlance().start()
+        self.addCleanup(self.glance.stop)
+        self.useFixture(fixtures.MonkeyPatch('shade.openstack_cloud',
+                                             FakeGlanceCloud))
+        FakeGlanceCloud.endpoint = self.glance.endpoint
+        FakeGlanceCloud.servers = []
+        self.image_data = b'image data'
+
+    def test_prune_uploads(self):
+        d2c = self._app(upload_retention={'keep_newest': 2},
+                        prune_batch_size=2, upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        uploads = []
+        for age in range(4):
+            upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
+            upload.created_at -= age * 3600
+            upload.update_processfile()
+            uploads.append(upload)
+        self.assertEqual(4, len(self.glance.images))
+        self.assertEqual(len(self.image_data),
+                         self.glance.images[uploads[0].glance_uuid]['size'])
+        FakeGlanceCloud.servers = [{'image': {'id': uploads[3].glance_uuid}}]
+
+        pruned = d2c.prune_uploads()
+        self.assertEqual([(uploads[2].uuid, 'deleted')],
+                         [(x['id'], x['status']) for x in pruned])
+        kept = [uploads[0], uploads[1], uploads[3]]
+        self.assertEqual(sorted(x.glance_uuid for x in kept),
+                         sorted(self.glance.images))
+        self.assertEqual('not one of the newest 2',
+                         d2c.get_upload(uploads[2].uuid).deleted['reason'])
+        self.assertEqual([], d2c.prune_uploads())
+
+    def test_select(self):
+        now = time.time()
+        uploads = [FakeRecord(created_at=now - x * 86400, glance_uuid=x)
+                   for x in range(5)]
+        self.assertEqual([], retention.select(uploads, {}))
+        selected = retention.select(uploads, {'keep_newest': 1,
+                                              'keep_newer_than': 2.5 * 86400},
+                                    in_use=[4], now=now)
+        self.assertEqual([3], [x[0].glance_uuid for x in selected])
+
+    def test_old_records(self):
+        d2c = self._app(upload_retention={'keep_newer_than': 3600})
+        build = d2c.build('test_diskimage', blocking=True)
+        recent = self._write_old_upload(d2c, build, 'recent')
+        old = self._write_old_upload(d2c, build, 'old')
+        pf_dir = d2c.config.get('upload_processfile_dir')
+        long_ago = time.time() - 7200
+        os.utime(process.processfile_for_uuid(pf_dir, old),
+                 (long_ago, long_ago))
+        pruned = d2c.prune_uploads(dry_run=True)
+        self.assertEqual([old], [x['id'] for x in pruned])
+        self.assertNotIn(recent, [x['id'] for x in pruned])
+
+    def test_delete_errors(self):
+        def delete(image_id):
+            if image_id == 'bad':
+                raise RuntimeError('refused')
+
+        bucket = throttle.TokenBucket(
+            os.path.join(self.useFixture(fixtures.TempDir()).path, 'bucket'),
+            limit=1000)
+        self.assertEqual({'good': None, 'bad': 'refused'},
+                         retention.delete_batched(delete, ['good', 'bad'],
+                                                  batch_size=1,
+                                                  bucket=bucket))
+
+
+class TestBench(base.TestCase):
+    def test_bench_upload(self):
+        size = 256 * 1024
+        report = bench.run(size, ['sparse', 'compressible'], [64 * 1024],
+                           [1, 2])
+        self.assertEqual(size, report['image_size'])
+        self.assertEqual([('sparse', 1), ('sparse', 2),
+                          ('compressible', 1), ('compressible', 2)],
+                         [(x['image'], x['concurrency'])
+                          for x in report['results']])
+        for result in report['results']:
+            self.assertEqual(size * result['concurrency'], result['bytes'])
+            self.assertGreater(result['mb_per_second'], 0)
+            self.assertGreater(result['peak_rss'], 0)
+        # Each upload reads its image at least a chunk at a time
+        self.assertGreaterEqual(report['results'][0]['read_syscalls'], 4)
+
+
+FAKE_QEMU_IMG = '''#!%s
+import sys
+with open(sys.argv[0] + '.calls', 'a') as fh:
+    fh.write(' '.join(sys.argv[1:]) + '\\n')
+with open(sys.argv[-2], 'rb') as src:
+    data = src.read()
+with open(sys.argv[-1], 'wb') as dest:
+    dest.write(data[:len(data) // 2])
+''' % sys.executable
+
+
+class TestPrepare(AppTestCase):
+    def setUp(self):
+        super(TestPrepare, self).setUp()
+        self.qemu_img = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                     'qemu-img')
+        with open(self.qemu_img, 'w') as fh:
+            fh.write(FAKE_QEMU_IMG)
+        os.chmod(self.qemu_img, 0o755)
+        self.image_data = b'0123456789' * 100
+        FakeSession.uploaded = {}
+
+    def _calls(self):
+        with open(self.qemu_img + '.calls') as fh:
+            return fh.read().splitlines()
+
+    def test_prepared_once(self):
+        d2c = self._app(prepare_uploads='always', qemu_img=self.qemu_img,
+                        upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        first = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        second = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual([b'0123456789' * 50],
+                         list(FakeSession.uploaded.values()))
+        self.assertEqual([False, True],
+                         [x.prepared['cached'] for x in (first, second)])
+        self.assertEqual(1, len(self._calls()))
+        self.assertIn('-c', self._calls()[0].split())
+
+        d2c.delete_build(build.uuid)
+        self.assertFalse(os.path.exists(first.prepared['path']))
+
+    def test_auto_needs_slow_link(self):
+        d2c = self._app(prepare_uploads='auto', qemu_img=self.qemu_img)
+        build = d2c.build('test_diskimage', blocking=True)
+        # Nothing is known about the link yet
+        self.assertIsNone(d2c.upload(build.uuid, 'test_provider',
+                                     blocking=True).prepare)
+        self.assertFalse(prepare.worthwhile(10 ** 9, 10 ** 9, 10 ** 8, .5))
+        self.assertTrue(prepare.worthwhile(10 ** 9, 10 ** 6, 10 ** 8, .5))
+
+
+class TestFarm(AppTestCase):
+    def setUp(self):
+        super(TestFarm, self).setUp()
+        self.coordinator = farm.Coordinator(
+            self.useFixture(fixtures.TempDir()).path, max_attempts=2)
+        server = farm.make_server(self.coordinator, '127.0.0.1', 0, 'secret')
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % server.server_address[1]
+        self.client = farm.Client(self.url, 'secret')
+        self.publish_dir = self.useFixture(fixtures.TempDir()).path
+        self.log_output = 'building\n'
+
+    def _agent(self, worker):
+        return farm.Agent(self._app(), self.url, worker=worker,
+                          publish_dir=self.publish_dir, blocking=True,
+                          token='secret')
+
+    def _submit(self, name='test_diskimage'):
+        return self.client.request('/jobs', {'name': name})
+
+    def test_agents_share_queue(self):
+        jobs = [self._submit() for _ in range(3)]
+        first = self._agent('first')
+        second = self._agent('second')
+        for agent in (first, second, first):
+            agent.run_once()
+        done = self.client.request('/jobs')
+        self.assertEqual([x['id'] for x in jobs], [x['id'] for x in done])
+        self.assertEqual(['completed'] * 3, [x['state'] for x in done])
+        self.assertEqual(['first', 'second', 'first'],
+                         [x['result']['worker'] for x in done])
+        with open(self.coordinator.log_path(jobs[0]['id'])) as fh:
+            self.assertEqual('building\n', fh.read())
+        for job in done:
+            self.assertTrue(os.path.exists(job['result']['published'][0]))
+        self.assertEqual(
+            [], self.client.request('/lease', {'worker': 'first'}))
+
+    def test_lost_worker_requeued(self):
+        job = self._submit()
+        # This worker leases the job and then its host goes away
+        self.client.request('/lease', {'worker': 'gone'})
+        with util.locked_json(self.coordinator.state_path) as state:
+            state['jobs'][job['id']]['lease_expires'] = 0
+        self.assertRaises(farm.LeaseLostError, self.client.request,
+                          '/jobs/%s/heartbeat' % job['id'],
+                          {'worker': 'gone'})
+
+        self._agent('other').run_once()
+        job = self.client.request('/jobs')[0]
+        self.assertEqual(('completed', 2), (job['state'], job['attempts']))
+        self.assertEqual([('gone', 'lease expired'), ('other', 'completed')],
+                         [(x['worker'], x['result']) for x in job['history']])
+
+    def test_token_required(self):
+        self._submit()
+        for token in (None, 'wrong'):
+            client = farm.Client(self.url, token)
+            self.assertRaises(farm.UnauthorizedError, client.request,
+                              '/jobs')
+            self.assertRaises(farm.UnauthorizedError, client.request,
+                              '/lease', {'worker': 'intruder'})
+        self.assertEqual('queued', self.client.request('/jobs')[0]['state'])
+
+    def test_lease_lost_while_uploading(self):
+        cancelled = []
+
+        def cancel(d2c, job_uuid):
+            cancelled.append(job_uuid)
+            if job_uuid == build.uuid:
+                raise ValueError('%s has already been built' % job_uuid)
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.app.App.cancel',
+                                             cancel))
+        job = self._submit()
+        agent = self._agent('agent')
+        self.client.request('/lease', {'worker': 'agent'})
+        build = agent.app.build('test_diskimage', blocking=True)
+        build.upload_ids = ['upload-uuid']
+        build.update_processfile()
+        agent.running[job['id']] = {'build': build.uuid, 'log_offset': 0}
+        # Still chaining its uploads when the coordinator gives up on us
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.app.Build.is_running', lambda build: True))
+        with util.locked_json(self.coordinator.state_path) as state:
+            state['jobs'][job['id']]['lease_expires'] = 0
+        agent.run_once()
+        self.assertEqual([build.uuid, 'upload-uuid'], cancelled)
+        self.assertEqual({}, agent.running)
+
+    def test_wrong_token_stops_agent(self):
+        agent = farm.Agent(self._app(), self.url, worker='agent',
+                           token='wrong')
+        self.assertRaises(farm.UnauthorizedError, agent.serve_forever, 0)
+
+    def test_unknown_diskimage_fails_alone(self):
+        # Builds run in the background, as they do for farm-agent, forked
+        # rather than in a fresh worker so our fake DIB is used
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.app.Build._get_process',
+            lambda build, blocking=False: process.PythonProcess(build._job)))
+        typo = self._submit('typo')
+        job = self._submit()
+        agent = farm.Agent(self._app(), self.url, worker='agent', slots=2,
+                           publish_dir=self.publish_dir, token='secret')
+        deadline = time.time() + 30
+        while agent.running or not self.coordinator.jobs()[1]['result']:
+            self.assertLess(time.time(), deadline)
+            agent.run_once()
+            time.sleep(.1)
+        jobs = dict((x['id'], x) for x in self.client.request('/jobs'))
+        self.assertEqual('failed', jobs[typo['id']]['state'])
+        self.assertIn('ConfigItemNotFoundError',
+                      jobs[typo['id']]['result']['error'])
+        self.assertEqual('completed', jobs[job['id']]['state'])
+
+
+class TestTuning(AppTestCase):
+    def setUp(self):
+        super(TestTuning, self).setUp()
+        self.memory = 64 * 1024 ** 3
+        self.useFixture(fixtures.MonkeyPatch(
+            'dib2cloud.admission.read_meminfo',
+            lambda: {'MemAvailable': self.memory}))
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.tuning.cpu_count',
+                                             lambda: 8))
+
+    def test_env_vars(self):
+        d2c = self._app()
+        d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(('val1', 'val2'), (self.spawn_env['var1'],
+                                            self.spawn_env['var2']))
+        self.assertEqual({'DIB_RELEASE': 'xenial', 'EMPTY': ''},
+                         tuning.env_dict(['DIB_RELEASE=xenial', 'EMPTY=']))
+        self.assertRaises(config.ConfigKeyInvalidError, config.Diskimage,
+                          name='x', elements=[], env_vars=['DIB_RELEASE'])
+
+    def test_tuned(self):
+        d2c = self._app(dib_tuning='auto', compress_outputs='gzip')
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(('0', '-j8', 'val1'),
+                         (self.spawn_env['DIB_NO_TMPFS'],
+                          self.spawn_env['MAKEFLAGS'],
+                          self.spawn_env['var1']))
+        record = d2c.get_job(build.uuid)
+        self.assertEqual(8, record.tuning['host']['cpus'])
+        self.assertEqual(8, record.compress['threads'])
+
+        # Too little memory to build in tmpfs
+        self.memory = 4 * 1024 ** 3
+        d2c.build('test_diskimage', blocking=True)
+        self.assertEqual('1', self.spawn_env['DIB_NO_TMPFS'])
+
+    def test_env_vars_win(self):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        config_fxtr.config.set('dib_tuning', 'auto')
+        config_fxtr.config.get('diskimages').get_one(
+            'name', 'test_diskimage').set('env_vars', ['DIB_NO_TMPFS=1'])
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        d2c = app.App(config_path=config_fxtr.path)
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual('1', self.spawn_env['DIB_NO_TMPFS'])
+        self.assertEqual(['DIB_NO_TMPFS'],
+                         d2c.get_job(build.uuid).tuning['overridden'])
+
+
+class TestUploadQueue(AppTestCase):
+    def _upload(self, queue, priority=0, deadline=None):
+        pf_dir = queue.upload_pf_dir
+        upload = app.Upload(pf_dir, pf_dir, app.gen_uuid(), 'build', 'qcow2',
+                            'cloud', 'image', priority=priority,
+                            deadline=deadline, created_at=time.time())
+        queue.set_state(upload, 'queued')
+        return upload
+
+    def test_priority_goes_first(self):
+        queue = uploadqueue.UploadQueue(
+            self.useFixture(fixtures.TempDir()).path, slots=1)
+        nightly = self._upload(queue)
+        self.assertTrue(queue.acquire(nightly))
+        routine = self._upload(queue)
+        urgent = self._upload(queue, priority=10)
+        # A running upload keeps its slot whatever is waiting
+        self.assertFalse(queue.acquire(urgent))
+        self.assertEqual('running', nightly.queue['state'])
+
+        queue.set_state(nightly, 'done')
+        # routine is older but urgent goes first
+        self.assertFalse(queue.acquire(routine))
+        self.assertTrue(queue.acquire(urgent))
+        queue.set_state(urgent, 'done')
+        self.assertTrue(queue.acquire(routine))
+
+    def test_done_leaves_queue(self):
+        queue = uploadqueue.UploadQueue(
+            self.useFixture(fixtures.TempDir()).path, slots=1)
+        first = self._upload(queue)
+        second = self._upload(queue)
+        self.assertEqual(set([first.uuid, second.uuid]),
+                         set(util.read_locked_json(queue.index_path)))
+        queue.set_state(first, 'done')
+        self.assertEqual([second.uuid],
+                         list(util.read_locked_json(queue.index_path)))
+        self.assertEqual([second.uuid], [x['uuid'] for x in queue.entries()])
+
+    def test_plan(self):
+        def entry(uuid, state, priority=0, deadline=None, seconds=100):
+            return {'uuid': uuid, 'priority': priority, 'deadline': deadline,
+                    'created_at': 0, 'expected_seconds': seconds,
+                    'queue': {'state': state, 'since': 1000}}
+        entries = [entry('running', 'running'),
+                   entry('late', 'queued', deadline=1050),
+                   entry('later', 'queued', deadline=2000),
+                   entry('urgent', 'queued', priority=5),
+                   entry('unknown', 'queued', seconds=None)]
+        plan = uploadqueue.plan(entries, 2, now=1050)
+        self.assertEqual({
+            'urgent': {'position': 1, 'expected_start': 1050,
+                       'deadline_at_risk': False},
+            'late': {'position': 2, 'expected_start': 1100,
+                     'deadline_at_risk': True},
+            'later': {'position': 3, 'expected_start': 1150,
+                      'deadline_at_risk': False},
+            'unknown': {'position': 4, 'expected_start': 1200,
+                        'deadline_at_risk': False}}, plan)
+        # Both slots are taken by uploads of unknown duration by then
+        plan = uploadqueue.plan(entries + [
+            entry('last', 'queued', seconds=None),
+            entry('after', 'queued')], 2, 1050)
+        self.assertEqual(1250, plan['last']['expected_start'])
+        self.assertIsNone(plan['after']['expected_start'])
+
+    def test_blocking_upload_takes_slot(self):
+        FakeSession.uploaded = {}
+        d2c = self._app(upload_slots=1, upload_priority=3)
+        build = d2c.build('test_diskimage', blocking=True)
+        upload = d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual('1234', upload.glance_uuid)
+        self.assertEqual(3, upload.priority)
+        self.assertEqual('done', d2c.get_upload(upload.uuid).queue['state'])
+        self.assertEqual({}, d2c.upload_queue_plan())
+
+
+class TestTracing(AppTestCase):
+    def setUp(self):
+        super(TestTracing, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.tracing._hooks', []))
+        self.useFixture(fixtures.EnvironmentVariable(tracing.TRACE_ENV))
+        self.image_data = b'x' * 2048
+        FakeSession.uploaded = {}
+
+    def test_hooks(self):
+        events = []
+        tracing.add_hook(lambda event, args: events.append(event))
+        d2c = self._app(compress_outputs='gzip')
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(['build_start', 'prepare_build_start',
+                          'prepare_build_end', 'disk_image_create_start',
+                          'disk_image_create_end', 'compress_start',
+                          'compress_end', 'build_end'], events)
+        del events[:]
+        d2c.upload_chunk_size = 1024
+        d2c.upload(build.uuid, 'test_provider', blocking=True)
+        self.assertEqual('upload_start', events[0])
+        self.assertEqual('upload_end', events[-1])
+        self.assertIn('upload_chunk', events)
+
+    def test_chrome_trace(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'trace.json')
+        trace = tracing.enable(path, 'test')
+        self.addCleanup(trace.close)
+        self.assertEqual(path, os.environ[tracing.TRACE_ENV])
+        d2c = self._app(upload_chunk_size=1024, upload_stream=True)
+        build = d2c.build('test_diskimage', blocking=True)
+        d2c.upload(build.uuid, 'test_provider', blocking=True)
+        with open(path) as fh:
+            # Left open for appending, viewers close the array themselves
+            events = json.loads(fh.read().rstrip().rstrip(',') + ']')
+        self.assertEqual(('M', {'name': 'test'}),
+                         (events[0]['ph'], events[0]['args']))
+        spans = [(x['ph'], x['name']) for x in events if x['ph'] in 'BE']
+        self.assertEqual(('B', 'build'), spans[0])
+        self.assertEqual(('E', 'upload'), spans[-1])
+        chunks = [x for x in events if x['name'] == 'upload_chunk']
+        self.assertEqual([1024, 1024], [x['args']['bytes'] for x in chunks])
+        self.assertEqual(['X', 'X'], [x['ph'] for x in chunks])
+
+
+class TestScheduling(AppTestCase):
+    def _app(self, build_scheduling=None, diskimage_scheduling=None):
+        config_fxtr = self.useFixture(ConfigFixture('simple'))
+        if build_scheduling is not None:
+            config_fxtr.config.set('build_scheduling', build_scheduling)
+        if diskimage_scheduling is not None:
+            config_fxtr.config.get('diskimages').get_one(
+                'name', 'test_diskimage').set('scheduling',
+                                              diskimage_scheduling)
+        config_fxtr.config.to_yaml_file(config_fxtr.path)
+        return app.App(config_path=config_fxtr.path)
+
+    def test_command_prefix(self):
+        d2c = self._app({'nice': 10, 'ionice_class': 'idle'},
+                        {'cpu_affinity': '0-3', 'numa_node': 0,
+                         'ionice_class': 'best-effort', 'ionice_level': 7})
+        build = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual(['numactl', '--cpunodebind=0', '--membind=0',
+                          'taskset', '-c', '0-3',
+                          'ionice', '-c', 'best-effort', '-n', '7',
+                          'nice', '-n', '10'] + build.dib_cmd,
+                         self.spawn_cmd)
+
+    def test_invalid_settings(self):
+        d2c = self._app({'ionice_class': 'fast'})
+        self.assertRaises(scheduling.SchedulingError, d2c.build,
+                          'test_diskimage', blocking=True)
+
+    def test_cpu_sets_spread_over_running_builds(self):
+        d2c = self._app({'cpu_affinity': ['0-3', '4-7']})
+        first = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual('0-3', first.scheduling['cpu_affinity'])
+        # Pretend the first build is still running
+        first.pid = os.getpid()
+        first.update_processfile()
+        second = d2c.build('test_diskimage', blocking=True)
+        self.assertEqual('4-7', second.scheduling['cpu_affinity'])
+        self.assertEqual(['taskset', '-c', '4-7'], self.spawn_cmd[:3])
+
+
+class TestMetrics(AppTestCase):
+    def test_build_and_upload_metrics(self):
+        config_path = self.useFixture(ConfigFixture('simple')).path
+        d2c = app.App(config_path=config_path)
+        build = d2c.build('test_diskimage', blocking=True)
+        d2c.upload(build.uuid, 'test_provider', blocking=True)
+        text = d2c.metrics.render()
+        self.assertIn('dib2cloud_builds_total{diskimage="test_diskimage",'
+                      'status="completed"} 1.0', text)
+        self.assertIn('dib2cloud_uploads_total{diskimage="test_diskimage",'
+                      'provider="test_provider",status="completed"} 1.0',
+                      text)
+        self.assertIn('dib2cloud_running_builds{diskimage="test_diskimage"} '
+                      '0.0', text)
+        self.assertIn('dib2cloud_build_duration_seconds_count'
+                      '{diskimage="test_diskimage"} 1.0', text)
+
+    def test_build_exception_finishes(self):
+        def spawn(cmd, stdout=None, stderr=None, env=None, setsid=False):
+            raise OSError(errno.ENOENT, 'No such file or directory', cmd[0])
+        self.useFixture(fixtures.MonkeyPatch('dib2cloud.process.spawn',
+                                             spawn))
+        d2c = self._app()
+        self.assertRaises(OSError, d2c.build, 'test_diskimage',
+                          blocking=True)
+        text = d2c.metrics.render()
+        self.assertIn('dib2cloud_running_builds{diskimage="test_diskimage"} '
+                      '0.0', text)
+        self.assertIn('dib2cloud_builds_total{diskimage="test_diskimage",'
+                      'status="error"} 1.0', text)
+        build = d2c.get_builds()[0]
+        self.assertIsNotNone(build.failure['exception'])
+        self.assertIn("No such file or directory: 'disk-image-create'",
+                      build.failure['error'])
+        self.assertIsNotNone(build.resources['wall_time'])
+        self.assertEqual('error', cmd.dib_summary_dict(build)['status'])
+
+    def test_dead_worker_not_running(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'metrics.json')
+        store = metrics.MetricsStore(path)
+        store.build_started('img', 'build1')
+        store.upload_started('img', 'cloud', 'upload1')
+        self.assertIn('dib2cloud_running_uploads{diskimage="img",'
+                      'provider="cloud"} 1.0', store.render())
+        # The worker is killed, or its host rebooted, without finishing
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        with util.locked_json(path) as state:
+            state['running']['upload1']['pid'] = dead.pid
+        text = store.render()
+        self.assertIn('dib2cloud_running_builds{diskimage="img"} 1.0', text)
+        self.assertIn('dib2cloud_running_uploads{diskimage="img",'
+                      'provider="cloud"} 0.0', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'metrics.json')
+        store = metrics.MetricsStore(path)
+        store.build_started('img', 'build1')
+        store.build_finished('img', 'completed', 250, 100, 'build1')
+        self.assertIn('dib2cloud_images_dir_bytes 100.0', store.render())
+        store.build_deleted(100)
+        text = store.render()
+        self.assertIn('dib2cloud_images_dir_bytes 0.0', text)
+        self.assertIn('dib2cloud_build_duration_seconds_bucket'
+                      '{diskimage="img",le="60.0"} 0.0', text)
+        self.assertIn('dib2cloud_build_duration_seconds_bucket'
+                      '{diskimage="img",le="300.0"} 1.0', text)
+        self.assertIn('dib2cloud_build_duration_seconds_bucket'
+                      '{diskimage="img",le="+Inf"} 1.0', text)
+
+        textfile = os.path.join(os.path.dirname(path), 'dib2cloud.prom')
+        store.write_textfile(textfile)
+        with open(textfile) as fh:
+            self.assertEqual(text, fh.read())
+
+
+class TestThrottle(base.TestCase):
+    def setUp(self):
+        super(TestThrottle, self).setUp()
+        self.bucket_path = os.path.join(self.useFixture(
+            fixtures.TempDir()).path, 'test.bucket')
+
+    def test_limit_for_time_profiles(self):
+        profiles = [{'start': '22:00', 'end': '06:00', 'limit': None},
+                    {'start': '09:00', 'end': '17:00', 'limit': 100}]
+        night = time.strptime('23:30', '%H:%M')
+        early = time.strptime('05:59', '%H:%M')
+        day = time.strptime('12:00', '%H:%M')
+        evening = time.strptime('18:00', '%H:%M')
+        self.assertIsNone(throttle.limit_for_time(500, profiles, night))
+        self.assertIsNone(throttle.limit_for_time(500, profiles, early))
+        self.assertEqual(100, throttle.limit_for_time(500, profiles, day))
+        self.assertEqual(500, throttle.limit_for_time(500, profiles, evening))
+
+    def test_bucket_unlimited(self):
+        bucket = throttle.TokenBucket(self.bucket_path)
+        self.assertEqual(0, bucket.reserve(10 ** 9))
+
+    def test_bucket_shared_between_instances(self):
+        first = throttle.TokenBucket(self.bucket_path, limit=1000)
+        second = throttle.TokenBucket(self.bucket_path, limit=1000)
+        self.assertEqual(0, first.reserve(1000))
+        wait = second.reserve(500)
+        self.assertTrue(0.4 < wait <= 0.5, wait)
+
+    def test_bucket_shared_by_priority(self):
+        low = throttle.TokenBucket(self.bucket_path, limit=1000, owner='low',
+                                   weight=throttle.priority_weight(-5))
+        high = throttle.TokenBucket(self.bucket_path, limit=1000,
+                                    owner='high',
+                                    weight=throttle.priority_weight(3))
+        self.assertEqual(0, low.reserve(1000))
+        # While both draw, high gets 4/5 of the rate and low the rest
+        wait = high.reserve(1600)
+        self.assertTrue(0.9 < wait <= 1, wait)
+        wait = low.reserve(400)
+        self.assertTrue(1.9 < wait <= 2, wait)
+
+
+class TestCmdProcess(base.TestCase):
+    def test_blocking_records_usage(self):
+        with open(os.devnull, 'w') as devnull:
+            proc = process.CmdProcess(['sh', '-c', 'exit 3'],
+                                      stdout=devnull, stderr=devnull)
+            proc.start(blocking=True)
+        self.assertEqual(3, proc.exit_code)
+        self.assertEqual(3, proc.usage['exit_code'])
+        self.assertTrue(proc.usage['max_rss'] > 0)
+        self.assertTrue(proc.usage['wall_time'] >= 0)
+
+    def test_watchdog_stops_stalled_command(self):
+        with open(os.devnull, 'w') as devnull:
+            proc = process.CmdProcess(['sleep', '30'], stdout=devnull,
+                                      stderr=devnull, setsid=True)
+            dog = watchdog.Watchdog(stall_timeout=.3, progress=lambda: 0,
+                                    interval=.1)
+
+            def run():
+                with dog:
+                    proc.start(blocking=True)
+
+            start = time.time()
+            self.assertRaises(watchdog.Expired, run)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual('stalled', dog.expired.state)
+        self.assertEqual(-signal.SIGTERM, proc.exit_code)
+
+    def test_watchdog_timeout(self):
+        dog = watchdog.Watchdog(timeout=60, stall_timeout=30,
+                                progress=lambda: 0)
+        with dog:
+            self.assertIsNone(dog.check())
+            self.assertEqual('timeout',
+                             dog.check(time.time() + 61).state)
+        dog = watchdog.Watchdog(timeout=60, stall_timeout=30,
+                                progress=lambda: 0)
+        with dog:
+            self.assertEqual('stalled', dog.check(time.time() + 31).state)
+
+
+class FakeTracker(process.ProcessTracker):
+    process_properties = ['payload']
+
+    def __init__(self, uuid, pf_dir, pid=None, created_at=None,
+                 config_path=None, payload=None):
+        super(FakeTracker, self).__init__(uuid, pf_dir, pid, created_at,
+                                          config_path)
+        self.payload = payload
+
+
+class TestProcessTracker(base.TestCase):
+    def setUp(self):
+        super(TestProcessTracker, self).setUp()
+        self.pf_dir = self.useFixture(fixtures.TempDir()).path
+
+    def test_generation_increments(self):
+        tracker = FakeTracker('abc', self.pf_dir, payload='one')
+        tracker.update_processfile()
+        tracker.payload = 'two'
+        tracker.update_processfile()
+        loaded = process.ProcessTracker.from_uuid(FakeTracker, self.pf_dir,
+                                                  'abc')
+        self.assertEqual('two', loaded.payload)
+        self.assertEqual(2, loaded.generation)
+
+    def test_conditional_update_skips_newer_state(self):
+        tracker = FakeTracker('abc', self.pf_dir, payload='initial')
+        tracker.update_processfile()
+        other = process.ProcessTracker.from_uuid(FakeTracker, self.pf_dir,
+                                                 'abc')
+        other.payload = 'newer'
+        other.update_processfile()
+        tracker.payload = 'stale'
+        self.assertFalse(tracker.update_processfile(if_generation=1))
+        loaded = process.ProcessTracker.from_uuid(FakeTracker, self.pf_dir,
+                                                  'abc')
+        self.assertEqual('newer', loaded.payload)
+
+    def test_processfile_mode_follows_umask(self):
+        old_umask = os.umask(0o027)
+        self.addCleanup(os.umask, old_umask)
+        tracker = FakeTracker('abc', self.pf_dir, payload='x')
+        tracker.update_processfile()
+        self.assertEqual(0o640,
+                         stat.S_IMODE(os.stat(tracker.processfile).st_mode))
+
+    def test_readers_never_see_partial_records(self):
+        tracker = FakeTracker('abc', self.pf_dir, payload='x' * 10000)
+        tracker.update_processfile()
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                tracker.update_processfile()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            for _ in range(200):
+                loaded = process.ProcessTracker.get_all(FakeTracker,
+                                                        self.pf_dir)
+                self.assertEqual(1, len(loaded))
+                self.assertEqual('x' * 10000, loaded[0].payload)
+        finally:
+            stop.set()
+            writer.join()
 
 
 class TestPythonProcess(base.TestCase):
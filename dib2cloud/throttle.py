@@ -0,0 +1,104 @@
+import time
+
+from dib2cloud import util
+
+
+# Seconds after its last draw an owner stops taking a share of the bucket
+SHARE_IDLE = 5
+
+
+def minute_of_day(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def limit_for_time(limit, profiles, now=None):
+    """Return the bandwidth limit in effect at the given local time
+
+    Profiles are dicts with 'start' and 'end' keys in HH:MM local time and a
+    'limit' key. A profile may wrap around midnight and a limit of None means
+    unlimited. The first matching profile wins, otherwise limit is returned.
+    """
+    if now is None:
+        now = time.localtime()
+    minute = now.tm_hour * 60 + now.tm_min
+    for profile in profiles or []:
+        start = minute_of_day(profile['start'])
+        end = minute_of_day(profile['end'])
+        if start <= end:
+            matches = start <= minute < end
+        else:
+            matches = minute >= start or minute < end
+        if matches:
+            return profile.get('limit')
+    return limit
+
+
+def priority_weight(priority):
+    """Return the share of a bucket an upload of priority gets per owner
+
+    Everything at or below priority 0 gets the same share, so a low priority
+    upload slows down but never stops.
+    """
+    return 1 + max(0, priority or 0)
+
+
+class TokenBucket(object):
+    """A token bucket whose state lives in a file
+
+    Keeping the state on disk lets every upload process draw from the same
+    bucket so a limit holds across parallel uploads. Limits are in bytes per
+    second.
+
+    The rate is split between the owners which drew from the bucket in the
+    last SHARE_IDLE seconds by their weight, and each owner pays for what it
+    takes from its own share. Instances without an owner all draw from the
+    same share.
+    """
+
+    def __init__(self, path, limit=None, profiles=None, burst=None,
+                 owner=None, weight=1):
+        self.path = path
+        self.limit = limit
+        self.profiles = profiles or []
+        self.burst = burst
+        self.owner = owner or ''
+        self.weight = weight
+
+    def rate(self):
+        return limit_for_time(self.limit, self.profiles)
+
+    def reserve(self, amount):
+        """Take amount tokens and return how long to sleep to pay for them
+
+        The bucket is allowed to go into debt so large requests are not
+        starved by smaller ones.
+        """
+        rate = self.rate()
+        if not rate:
+            return 0
+        with util.locked_json(self.path) as state:
+            now = time.time()
+            shares = state.setdefault('shares', {})
+            for owner in [x for x in shares
+                          if shares[x]['until'] + SHARE_IDLE < now]:
+                del shares[owner]
+            share = shares.setdefault(self.owner, {'timestamp': now})
+            share['weight'] = self.weight
+            total = sum(x['weight'] for x in shares.values())
+            share_rate = rate * self.weight / float(total)
+            capacity = (self.burst or rate) * self.weight / float(total)
+            elapsed = max(0, now - share['timestamp'])
+            tokens = share.get('tokens', capacity)
+            tokens = min(capacity, tokens + elapsed * share_rate) - amount
+            wait = 0
+            if tokens < 0:
+                wait = -tokens / share_rate
+            share.update({'tokens': tokens, 'timestamp': now,
+                          'until': now + wait})
+        return wait
+
+    def consume(self, amount):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
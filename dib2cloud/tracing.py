@@ -0,0 +1,161 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Set for the processes we start so their spans land in the same trace
+TRACE_ENV = 'DIB2CLOUD_TRACE'
+PROFILE_ENV = 'DIB2CLOUD_PROFILE'
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Call hook(event, args) for every lifecycle event
+
+    Events are build_start, build_end, upload_start, upload_end and
+    upload_chunk, plus <name>_start and <name>_end for every span.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def emit(event, **args):
+    for hook in _hooks:
+        hook(event, args)
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    emit('%s_start' % name, **args)
+    try:
+        yield
+    finally:
+        emit('%s_end' % name, **args)
+
+
+class ChromeTrace(object):
+    """A hook writing events to a Chrome trace file
+
+    Every process appends to the same file so spans from a command and the
+    workers it starts share one timeline. The JSON array is deliberately
+    left open, which the trace viewers accept, so appends never need to
+    rewrite the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            pass
+        else:
+            os.write(fd, b'[\n')
+            os.close(fd)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+    def write(self, event):
+        event.setdefault('pid', os.getpid())
+        event.setdefault('tid', threading.current_thread().ident)
+        # A single write per event keeps concurrent appends whole
+        os.write(self._fd, ('%s,\n' % json.dumps(event)).encode('utf-8'))
+
+    def name_process(self, name):
+        self.write({'name': 'process_name', 'ph': 'M',
+                    'args': {'name': name}})
+
+    def __call__(self, event, args):
+        now = time.time()
+        record = {'cat': 'dib2cloud', 'ts': now * 1e6, 'args': args}
+        if event.endswith('_start'):
+            record.update({'name': event[:-len('_start')], 'ph': 'B'})
+        elif event.endswith('_end'):
+            record.update({'name': event[:-len('_end')], 'ph': 'E'})
+        elif 'duration' in args:
+            record.update({'name': event, 'ph': 'X',
+                           'ts': (now - args['duration']) * 1e6,
+                           'dur': args['duration'] * 1e6})
+        else:
+            record.update({'name': event, 'ph': 'i', 's': 't'})
+        self.write(record)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def enable(path, process_name=None):
+    """Trace this process and any it starts to path"""
+    os.environ[TRACE_ENV] = os.path.abspath(path)
+    trace = ChromeTrace(path)
+    if process_name:
+        trace.name_process(process_name)
+    add_hook(trace)
+    return trace
+
+
+def enable_from_environ(process_name=None):
+    path = os.environ.get(TRACE_ENV)
+    if path:
+        return enable(path, process_name)
+    return None
+
+
+@contextlib.contextmanager
+def profile(profile_dir, label):
+    """Profile what runs inside into profile_dir
+
+    cProfile stats are written to <label>-<pid>.prof, for pstats or
+    snakeviz, and the largest allocations still held at the end to
+    <label>-<pid>.memory.txt. Spans are traced to trace.json, including
+    those of workers started meanwhile, which profile themselves too.
+    """
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    os.environ[PROFILE_ENV] = os.path.abspath(profile_dir)
+    prefix = os.path.join(profile_dir, '%s-%d' % (label, os.getpid()))
+    if TRACE_ENV not in os.environ:
+        enable(os.path.join(profile_dir, 'trace.json'),
+               'dib2cloud %s' % label)
+    profiler = cProfile.Profile()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats('%s.prof' % prefix)
+        if tracemalloc is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            # Leave out what profiling itself allocated
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, tracemalloc.__file__)])
+            tracemalloc.stop()
+            with open('%s.memory.txt' % prefix, 'w') as fh:
+                fh.write('current=%d peak=%d\n' % (current, peak))
+                for stat in snapshot.statistics('lineno')[:50]:
+                    fh.write('%s\n' % stat)
+
+
+def profile_from_environ(label):
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if profile_dir:
+        return profile(profile_dir, label)
+    return _nothing()
+
+
+@contextlib.contextmanager
+def _nothing():
+    yield
@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+
+from dib2cloud import admission
+from dib2cloud import process
+
+
+def env_dict(env_vars):
+    """Return diskimage env_vars, a dict or NAME=value strings, as a dict"""
+    if isinstance(env_vars, dict):
+        return dict((str(k), str(v)) for k, v in env_vars.items())
+    ret = {}
+    for item in env_vars or []:
+        name, sep, value = str(item).partition('=')
+        if not sep:
+            raise ValueError('env_vars entry %s is not NAME=value' % item)
+        ret[name] = value
+    return ret
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def running_builds(build_pf_dir):
+    count = 0
+    if not os.path.exists(build_pf_dir):
+        return count
+    for pf in os.listdir(build_pf_dir):
+        if not pf.endswith('processfile'):
+            continue
+        record = process.load_record(os.path.join(build_pf_dir, pf))
+        if record is not None and process.pid_alive(record.get('pid')):
+            count += 1
+    return count
+
+
+class Tuner(object):
+    """Pick DIB performance settings for a build from what the host has
+
+    The host's CPUs and memory are shared evenly between the builds running
+    at once. A build runs in tmpfs when its share of memory holds both what
+    builds of the diskimage have used and the disk they have written, as
+    admission control estimates them, and otherwise on disk. Compression
+    and make get the build's share of CPUs. Settings given in a diskimage's
+    env_vars always win.
+    """
+
+    def __init__(self, config, build_pf_dir):
+        self.config = config
+        self.build_pf_dir = build_pf_dir
+        self._admission = admission.Admission(config, build_pf_dir)
+
+    def tune(self, name):
+        cpus = cpu_count()
+        # Including the build being tuned, which is already running
+        concurrent = max(1, running_builds(self.build_pf_dir))
+        available = admission.read_meminfo().get('MemAvailable', 0)
+        share = (available - self.config.get(
+            'admission_min_free_memory')) // concurrent
+        footprint = self._admission.estimate(name)
+        use_tmpfs = footprint['memory'] + footprint['disk'] <= share
+        threads = max(1, cpus // concurrent)
+        return {
+            'host': {'cpus': cpus, 'memory_available': available,
+                     'concurrent_builds': concurrent},
+            'footprint': footprint,
+            'env': {
+                'DIB_NO_TMPFS': '0' if use_tmpfs else '1',
+                'MAKEFLAGS': '-j%d' % threads
+            },
+            'compress_threads': threads
+        }
@@ -0,0 +1,147 @@
+import os
+import time
+
+from dib2cloud import process
+from dib2cloud import util
+
+
+# Queue states of an upload which holds or wants a slot
+WAITING = ('queued',)
+ACTIVE = WAITING + ('running',)
+
+
+def _rank(entry):
+    """Sort key putting the uploads which should start first
+
+    Higher priorities go first, then the earliest deadline and then age.
+    """
+    deadline = entry.get('deadline')
+    return (-(entry.get('priority') or 0),
+            deadline is None,
+            deadline or 0,
+            entry.get('created_at') or 0)
+
+
+def plan(entries, slots, now=None):
+    """Return where each waiting upload is in the queue and when it starts
+
+    Running uploads are expected to take their expected_seconds from when
+    they started and waiting uploads to take the first slot which frees up.
+    An expected start is None once it depends on an upload of unknown
+    duration.
+    """
+    if now is None:
+        now = time.time()
+    ranked = sorted(entries, key=_rank)
+    free_at = []
+    for entry in ranked:
+        if entry['queue']['state'] == 'running':
+            free_at.append(_finish(entry, entry['queue']['since'], now))
+    ret = {}
+    waiting = [x for x in ranked if x['queue']['state'] in WAITING]
+    for position, entry in enumerate(waiting, 1):
+        start = now
+        if slots and len(free_at) >= slots:
+            free_at.sort()
+            start = max(now, free_at.pop(0))
+        finish = _finish(entry, start, now)
+        free_at.append(finish)
+        deadline = entry.get('deadline')
+        ret[entry['uuid']] = {
+            'position': position,
+            'expected_start': start if start != float('inf') else None,
+            'deadline_at_risk': bool(deadline and finish > deadline)
+        }
+    return ret
+
+
+def _finish(entry, start, now):
+    seconds = entry.get('expected_seconds')
+    if seconds is None:
+        return float('inf')
+    return max(now, start + seconds)
+
+
+class UploadQueue(object):
+    """Share out upload slots by priority and deadline
+
+    Every upload on the host records its place in the queue in its
+    processfile and decides whether it may start, while holding the queue
+    lock, from the records of the others. An upload keeps its slot until it
+    is done: glance can't resume an upload, and one held open while it waits
+    would be dropped by idle timeouts, so a higher priority only goes ahead
+    of uploads which haven't started. slots of None leaves the number of
+    uploads sending at once unlimited.
+
+    The uploads in the queue are indexed so it can be read without loading
+    every upload ever made.
+    """
+
+    def __init__(self, upload_pf_dir, slots=None, poll_interval=5):
+        self.upload_pf_dir = upload_pf_dir
+        self.slots = slots
+        self.poll_interval = poll_interval
+
+    @property
+    def lock_path(self):
+        util.assert_dir(self.upload_pf_dir)
+        return os.path.join(self.upload_pf_dir, 'queue.lock')
+
+    @property
+    def index_path(self):
+        return os.path.join(self.upload_pf_dir, 'queue.json')
+
+    def entries(self):
+        """Return the records of the uploads waiting for or holding a slot"""
+        ret = []
+        for uuid in util.read_locked_json(self.index_path):
+            record = process.load_record(
+                process.processfile_for_uuid(self.upload_pf_dir, uuid))
+            queue = (record or {}).get('queue') or {}
+            # Uploads whose process went away without saying so hold nothing
+            if queue.get('state') in ACTIVE and process.pid_alive(
+                    queue.get('pid')):
+                ret.append(record)
+        return ret
+
+    def _replace(self, entries, upload):
+        others = [x for x in entries if x['uuid'] != upload.uuid]
+        return others + [upload.to_dict()]
+
+    def set_state(self, upload, state):
+        """Record upload's queue state, it leaves the queue once done"""
+        upload.queue = {'state': state, 'pid': os.getpid(),
+                        'since': time.time()}
+        upload.update_processfile()
+        util.assert_dir(self.upload_pf_dir)
+        with util.locked_json(self.index_path) as index:
+            if state in ACTIVE:
+                index[upload.uuid] = os.getpid()
+            else:
+                index.pop(upload.uuid, None)
+            # Uploads whose process went away without leaving
+            for uuid, pid in list(index.items()):
+                if not process.pid_alive(pid):
+                    del index[uuid]
+
+    def acquire(self, upload):
+        """Take a slot for upload, returning False if it has to wait"""
+        with process.LockedFile(self.lock_path):
+            if self.slots:
+                entries = self._replace(self.entries(), upload)
+                running = len([x for x in entries
+                               if x['queue']['state'] == 'running'])
+                waiting = sorted((x for x in entries
+                                  if x['queue']['state'] in WAITING),
+                                 key=_rank)
+                # Running uploads keep their slots, the best of the waiting
+                # ones get those left
+                if upload.uuid not in [x['uuid'] for x in
+                                       waiting[:max(0, self.slots - running)]]:
+                    return False
+            self.set_state(upload, 'running')
+        return True
+
+    def plan(self, now=None):
+        # No need for the queue lock, a slightly stale plan is only advice
+        return plan(self.entries(), self.slots, now)
@@ -1,4 +1,7 @@
+import contextlib
 import errno
+import fcntl
+import json
 import os
 
 
@@ -8,3 +11,51 @@ def assert_dir(path):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
+
+
+@contextlib.contextmanager
+def locked_json(path):
+    """Yield the dict stored as JSON at path and save it back on exit
+
+    The file is locked for the duration so concurrent processes can safely
+    read-modify-write the same state.
+    """
+    assert_dir(os.path.dirname(path))
+    with open(path, 'a+') as fh:
+        fcntl.lockf(fh, fcntl.LOCK_EX)
+        try:
+            fh.seek(0)
+            data = fh.read()
+            state = json.loads(data) if data else {}
+            yield state
+            fh.seek(0)
+            fh.truncate()
+            json.dump(state, fh)
+            fh.flush()
+        finally:
+            fcntl.lockf(fh, fcntl.LOCK_UN)
+
+
+def read_locked_json(path):
+    try:
+        fh = open(path, 'r')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+    with fh:
+        fcntl.lockf(fh, fcntl.LOCK_SH)
+        try:
+            data = fh.read()
+        finally:
+            fcntl.lockf(fh, fcntl.LOCK_UN)
+    return json.loads(data) if data else {}
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return 0
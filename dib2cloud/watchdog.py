@@ -0,0 +1,112 @@
+import contextlib
+import signal
+import time
+
+
+class Expired(Exception):
+    """Raised in the supervised process when the watchdog stops a job
+
+    state is one of 'timeout', 'stalled' or 'cancelled'.
+    """
+
+    def __init__(self, state, reason):
+        super(Expired, self).__init__(reason)
+        self.state = state
+        self.reason = reason
+
+    def to_dict(self):
+        return {'state': self.state, 'reason': self.reason,
+                'time': time.time()}
+
+
+class Watchdog(object):
+    """Interrupt a job which runs too long, stalls or is cancelled
+
+    While active, a SIGALRM timer fires every interval seconds and checks the
+    wall clock timeout and whether progress() has changed within the last
+    stall_timeout seconds. SIGTERM, which the cancel command sends, is turned
+    into an exception as well. Either way Expired is raised in the main
+    thread, interrupting whatever blocking call the job is in, so the job can
+    stop what it started and record why.
+    """
+
+    def __init__(self, timeout=None, stall_timeout=None, progress=None,
+                 interval=10):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.progress = progress
+        self.interval = interval
+        self.expired = None
+        self._paused = False
+        self._start_time = None
+        self._last_progress = None
+        self._last_progress_time = None
+        self._old_handlers = {}
+
+    def check(self, now=None):
+        """Return an Expired for the job, or None while it is healthy"""
+        if now is None:
+            now = time.time()
+        if self._paused:
+            return None
+        if self.timeout and now - self._start_time >= self.timeout:
+            return Expired('timeout', 'Did not finish within %d seconds' %
+                           self.timeout)
+        if self.stall_timeout and self.progress is not None:
+            progress = self.progress()
+            if progress != self._last_progress:
+                self._last_progress = progress
+                self._last_progress_time = now
+            elif now - self._last_progress_time >= self.stall_timeout:
+                return Expired('stalled', 'No progress for %d seconds' %
+                               self.stall_timeout)
+        return None
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Stop the clocks while the job waits its turn
+
+        Time spent paused counts neither towards the timeout nor as a stall.
+        Cancelling still works.
+        """
+        start = time.time()
+        self._paused = True
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self._start_time += elapsed
+            self._last_progress_time += elapsed
+            self._paused = False
+
+    def _expire(self, expired):
+        # Only interrupt the job once, it may take a while to clean up
+        if self.expired is None:
+            self.expired = expired
+            raise expired
+
+    def _handle_alarm(self, signum, frame):
+        expired = self.check()
+        if expired is not None:
+            self._expire(expired)
+
+    def _handle_term(self, signum, frame):
+        self._expire(Expired('cancelled', 'Cancelled'))
+
+    def __enter__(self):
+        self._start_time = time.time()
+        self._last_progress_time = self._start_time
+        if self.progress is not None:
+            self._last_progress = self.progress()
+        self._old_handlers = {
+            signal.SIGTERM: signal.signal(signal.SIGTERM, self._handle_term),
+            signal.SIGALRM: signal.signal(signal.SIGALRM, self._handle_alarm)
+        }
+        if self.timeout or self.stall_timeout:
+            signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        for signum, handler in self._old_handlers.items():
+            signal.signal(signum, handler)
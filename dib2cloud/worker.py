@@ -0,0 +1,21 @@
+import sys
+
+from dib2cloud import app
+from dib2cloud import tracing
+
+
+def main(argv=None):
+    argv = argv or sys.argv
+    if len(argv) != 4:
+        sys.stderr.write('usage: %s CONFIG_PATH build|upload UUID\n' %
+                         argv[0])
+        return 2
+    config_path, kind, job_uuid = argv[1:]
+    tracing.enable_from_environ('dib2cloud %s %s' % (kind, job_uuid))
+    with tracing.profile_from_environ('%s-%s' % (kind, job_uuid)):
+        app.App(config_path=config_path).run_job(kind, job_uuid)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())